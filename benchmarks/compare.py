@@ -0,0 +1,38 @@
+"""
+Compares two benchmark result files written by :mod:`benchmarks.run`.
+
+Usage::
+
+    python -m benchmarks.compare before.json after.json
+"""
+import json
+import sys
+
+METRICS = ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'errors')
+
+
+def load(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compare(before, after):
+    lines = ['%-8s %-8s %12s %12s %9s' % (
+        'phase', 'metric', before['commit'], after['commit'], 'change')]
+    for phase in sorted(set(before['results']) & set(after['results'])):
+        for metric in METRICS:
+            old = before['results'][phase].get(metric)
+            new = after['results'][phase].get(metric)
+            if old is None or new is None:
+                continue
+            change = ''
+            if old:
+                change = '%+.1f%%' % ((new - old) * 100.0 / old,)
+            lines.append('%-8s %-8s %12.2f %12.2f %9s' % (
+                phase, metric, old, new, change))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    before, after = sys.argv[1:3]
+    print(compare(load(before), load(after)))
@@ -0,0 +1,222 @@
+"""
+Load test for the shortener service.
+
+Starts a :class:`shortener.api.ShortenerServiceApp` in-process against the
+given database, drives ``/api/create``, ``/<short_url>`` and
+``/api/handler/dump`` over HTTP with a fixed number of concurrent clients and
+a Zipf distributed mix of short urls, and writes requests per second and
+latency percentiles for each phase as JSON.
+
+Usage::
+
+    python -m benchmarks.run --connection-string sqlite:// --concurrency 20
+    python -m benchmarks.compare benchmarks/results/a.json \
+        benchmarks/results/b.json
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import treq
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.python import usage
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+from shortener.api import ShortenerServiceApp
+
+from benchmarks.zipf import ZipfSampler
+
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["connection-string", None, "sqlite://", "Database to run against"],
+        ["concurrency", "c", 10, "Concurrent clients", int],
+        ["urls", "u", 1000, "Number of urls to create", int],
+        ["requests", "n", 10000, "Number of redirects to request", int],
+        ["dumps", None, 1000, "Number of dump requests", int],
+        ["zipf", "s", 1.1, "Zipf exponent of the redirect key mix", float],
+        ["seed", None, 1234, "Random seed for the key mix", int],
+        ["db-pool-size", None, 4, "Database worker threads", int],
+        ["redirect-cache-size", None, 0, "Redirect cache size", int],
+        ["output", "o", DEFAULT_RESULTS_DIR,
+         "Directory to save the JSON results in"],
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(samples, percent):
+    rank = max(int(round(percent / 100.0 * len(samples))), 1)
+    return samples[rank - 1]
+
+
+def summarise(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else None,
+    }
+    if latencies:
+        for percent in (50, 95, 99):
+            summary['p%s_ms' % (percent,)] = (
+                percentile(latencies, percent) * 1000)
+        summary['max_ms'] = latencies[-1] * 1000
+    return summary
+
+
+class Benchmark(object):
+    def __init__(self, reactor, options):
+        self.reactor = reactor
+        self.options = options
+        self.account = 'bench%s' % (int(time.time()),)
+        self.config = {
+            'host_domain': 'http://bench.example.org',
+            'account': self.account,
+            'connection_string': options['connection-string'],
+            # The carbon client is never started, metrics stay queued.
+            'graphite_endpoint': 'tcp:localhost:2003',
+            'graphite_max_queue_size': 1000,
+            'db_pool_size': options['db-pool-size'],
+            'redirect_cache_size': options['redirect-cache-size'],
+            'handlers': [
+                {'dump': 'shortener.handlers.dump.Dump'},
+            ],
+        }
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = options['concurrency']
+
+    def start(self):
+        self.app = ShortenerServiceApp(
+            reactor=self.reactor, config=self.config)
+        site = Site(self.app.resource())
+        self.listener = self.reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.base_url = 'http://127.0.0.1:%s' % (self.listener.getHost().port,)
+
+    @inlineCallbacks
+    def stop(self):
+        yield self.app.hits.flush()
+        yield self.pool.closeCachedConnections()
+        yield self.listener.stopListening()
+        self.app.engine.stop()
+
+    @inlineCallbacks
+    def run_phase(self, requests):
+        """
+        Runs the request callables with ``concurrency`` clients and returns
+        the phase summary.
+        """
+        latencies = []
+        errors = [0]
+        requests = iter(requests)
+
+        @inlineCallbacks
+        def timed(request):
+            started = time.time()
+            try:
+                resp = yield request()
+                yield resp.content()
+                if resp.code >= 400:
+                    errors[0] += 1
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.time() - started)
+
+        def client():
+            for request in requests:
+                yield timed(request)
+
+        started = time.time()
+        yield gatherResults([
+            task.cooperate(client()).whenDone()
+            for _ in xrange(self.options['concurrency'])])
+        returnValue(summarise(latencies, time.time() - started, errors[0]))
+
+    def put(self, path, payload):
+        return lambda: treq.put(
+            self.base_url + path, data=json.dumps(payload),
+            allow_redirects=False, pool=self.pool)
+
+    def get(self, path):
+        return lambda: treq.get(
+            self.base_url + path, allow_redirects=False, pool=self.pool)
+
+    @inlineCallbacks
+    def run(self):
+        self.start()
+        try:
+            resp = yield treq.get(self.base_url + '/api/init', pool=self.pool)
+            yield resp.content()
+
+            results = {}
+            urls = ['http://example.org/bench/%s' % (i,)
+                    for i in xrange(self.options['urls'])]
+            results['create'] = yield self.run_phase(
+                self.put('/api/create', {'long_url': url}) for url in urls)
+
+            short_urls = yield self.app.shorten_urls(
+                [(url, None) for url in urls])
+            codes = [str(url).rsplit('/', 1)[-1] for url in short_urls]
+            sampler = ZipfSampler(
+                len(codes), self.options['zipf'],
+                rng=random.Random(self.options['seed']))
+
+            results['resolve'] = yield self.run_phase(
+                self.get('/%s' % (codes[sampler.sample()],))
+                for _ in xrange(self.options['requests']))
+            results['dump'] = yield self.run_phase(
+                self.get('/api/handler/dump?url=%s' % (
+                    codes[sampler.sample()],))
+                for _ in xrange(self.options['dumps']))
+            returnValue(results)
+        finally:
+            yield self.stop()
+
+
+def save_results(report, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s-%s.json' % (
+        time.strftime('%Y%m%dT%H%M%S', time.gmtime(report['timestamp'])),
+        report['commit']))
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    return path
+
+
+@inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+
+    benchmark = Benchmark(reactor, options)
+    results = yield benchmark.run()
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'options': dict(
+            (k, v) for k, v in options.items() if k != 'output'),
+        'results': results,
+    }
+    path = save_results(report, options['output'])
+    print(json.dumps(report, indent=2, sort_keys=True))
+    print('Results saved to %s' % (path,))
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
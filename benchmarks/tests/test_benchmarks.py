@@ -0,0 +1,48 @@
+import random
+
+from twisted.trial.unittest import TestCase
+
+from benchmarks.compare import compare
+from benchmarks.zipf import ZipfSampler
+
+
+class TestZipfSampler(TestCase):
+    timeout = 5
+
+    def test_samples_in_range(self):
+        sampler = ZipfSampler(10, rng=random.Random(1))
+        samples = [sampler.sample() for _ in range(1000)]
+        self.assertTrue(all(0 <= k < 10 for k in samples))
+        # Lower indexes are picked more often.
+        self.assertTrue(samples.count(0) > samples.count(1) > samples.count(9))
+
+    def test_reproducible(self):
+        samples = [
+            [ZipfSampler(100, rng=random.Random(7)).sample()
+             for _ in range(10)]
+            for _ in range(2)]
+        self.assertEqual(samples[0], samples[1])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ZipfSampler, 0)
+
+
+class TestCompare(TestCase):
+    timeout = 5
+
+    def test_compare(self):
+        before = {'commit': 'aaa', 'results': {
+            'redirect': {'rps': 100.0, 'p50_ms': 2.0, 'errors': 0},
+            'create': {'rps': 50.0},
+        }}
+        after = {'commit': 'bbb', 'results': {
+            'redirect': {'rps': 150.0, 'p50_ms': 1.0, 'errors': 0},
+        }}
+        lines = compare(before, after).splitlines()
+        self.assertEqual(lines[0].split(), [
+            'phase', 'metric', 'aaa', 'bbb', 'change'])
+        self.assertEqual([line.split() for line in lines[1:]], [
+            ['redirect', 'rps', '100.00', '150.00', '+50.0%'],
+            ['redirect', 'p50_ms', '2.00', '1.00', '-50.0%'],
+            ['redirect', 'errors', '0.00', '0.00'],
+        ])
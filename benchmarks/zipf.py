@@ -0,0 +1,24 @@
+import bisect
+import random
+
+
+class ZipfSampler(object):
+    """
+    Picks indexes in ``range(n)`` with a Zipf distribution, index ``k`` being
+    picked with probability proportional to ``1 / (k + 1) ** s``.
+    """
+
+    def __init__(self, n, s=1.1, rng=None):
+        if n <= 0:
+            raise ValueError('n must be positive')
+        self.rng = rng or random.Random()
+        self.cumulative = []
+        total = 0.0
+        for k in xrange(1, n + 1):
+            total += 1.0 / k ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        return bisect.bisect_left(
+            self.cumulative, self.rng.random() * self.total)
@@ -0,0 +1,130 @@
+# -*- test-case-name: shortener.tests.test_accounts -*-
+"""
+Serving several accounts from one process.
+
+Without an ``accounts`` list in the config, the service serves
+``config['account']`` alone. With one, each entry gets its own
+:class:`shortener.api.ShortenerServiceApp`, with its own caches, hit counts
+and metrics namespace, and requests are routed to them by their ``Host``
+header or by the first segment of their path, depending on
+``account_routing``. Each entry is merged over the rest of the config, so
+any setting can be overridden per account. Accounts using the same
+``connection_string`` share a database engine, as do accounts reading from
+the same replicas or sharing shards, and all of them share one carbon
+connection.
+"""
+from urlparse import urljoin, urlparse
+
+from aludel.service import APIError, format_error
+from twisted.web.resource import Resource
+
+from shortener.api import ShortenerServiceApp, make_engine, make_shards
+from shortener.metrics import ShortenerMetrics
+
+ROUTE_BY_HOST = 'host'
+ROUTE_BY_PATH = 'path'
+
+
+def _host(request):
+    host = (request.getHeader('host') or '').lower()
+    # Drop the port, if any, taking care of IPv6 addresses.
+    if host.rfind(':') > host.rfind(']'):
+        host = host[:host.rfind(':')]
+    return host
+
+
+class AccountRouter(Resource):
+    """
+    Passes each request on to the resource of the account it's for, found
+    by ``Host`` header in :data:`ROUTE_BY_HOST` mode. In
+    :data:`ROUTE_BY_PATH` mode the first path segment names the account,
+    and is moved to the request's ``prepath`` before passing it on.
+    """
+    isLeaf = True
+
+    def __init__(self, routing, resources):
+        Resource.__init__(self)
+        self.routing = routing
+        self.resources = resources
+
+    def render(self, request):
+        if self.routing == ROUTE_BY_PATH:
+            key = request.postpath[0] if request.postpath else ''
+        else:
+            key = _host(request)
+        resource = self.resources.get(key)
+        if resource is None:
+            return format_error(APIError('Unknown account', 404), request)
+        if self.routing == ROUTE_BY_PATH:
+            request.prepath.append(request.postpath.pop(0))
+        return resource.render(request)
+
+
+def account_configs(config):
+    """
+    Returns ``(routing, configs)``, where ``configs`` has a
+    ``(key, account_config)`` pair for each of ``config['accounts']``, and
+    ``key`` is what :class:`AccountRouter` routes it by. Accounts routed by
+    host have one pair per host.
+    """
+    routing = config.get('account_routing', ROUTE_BY_HOST)
+    if routing not in (ROUTE_BY_HOST, ROUTE_BY_PATH):
+        raise ValueError('Unknown account_routing: %r' % (routing,))
+    base = dict((k, v) for k, v in config.items() if k != 'accounts')
+    configs = []
+    for entry in config['accounts']:
+        account_config = dict(base, **entry)
+        account = account_config['account']
+        if routing == ROUTE_BY_PATH:
+            if 'host_domain' not in entry:
+                account_config['host_domain'] = urljoin(
+                    base['host_domain'], account + '/')
+            keys = [account]
+        else:
+            if 'host_domain' not in entry:
+                raise ValueError(
+                    'Account %r needs its own host_domain' % (account,))
+            keys = [host.lower() for host in (
+                account_config.pop('hosts', None) or
+                [urlparse(account_config['host_domain']).hostname])]
+        for key in keys:
+            configs.append((key, account_config))
+    return routing, configs
+
+
+def make_apps(reactor, config):
+    """
+    Builds the apps for every account the service serves.
+
+    Returns ``(resource, metrics, apps)``: the site's root resource, the
+    metrics to flush and publish, which include every app's, and the apps.
+    """
+    if not config.get('accounts'):
+        app = ShortenerServiceApp(reactor=reactor, config=config)
+        return app.resource(), app.metrics, [app]
+
+    routing, configs = account_configs(config)
+    metrics = ShortenerMetrics(reactor, config)
+    engines = {}
+    apps = {}
+    resources = {}
+
+    def shared_engine(connection_string):
+        engine = engines.get(connection_string)
+        if engine is None:
+            engine = engines[connection_string] = make_engine(
+                reactor, config, connection_string)
+        return engine
+
+    for key, account_config in configs:
+        if key in resources:
+            raise ValueError('More than one account routed to %r' % (key,))
+        app = apps.get(account_config['account'])
+        if app is None:
+            app = apps[account_config['account']] = ShortenerServiceApp(
+                reactor, account_config,
+                metrics=metrics.for_account(account_config),
+                shards=make_shards(account_config, shared_engine))
+        resources[key] = app.resource()
+    return (AccountRouter(routing, resources), metrics,
+            sorted(apps.values(), key=lambda app: app.config['account']))
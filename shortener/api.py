@@ -1,26 +1,204 @@
 # -*- test-case-name: shortener.tests.test_api -*-
+from datetime import datetime
+from functools import partial
+from itertools import chain
 from urlparse import urljoin, urlparse
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed, gatherResults,
+    DeferredList, FirstError)
+from twisted.python import log
 from twisted.web import http
 
-from aludel.database import get_engine
-from aludel.service import service, handler, get_json_params, APIError
+from aludel.database import CollectionMissingError
+from aludel.service import (
+    service, handler, get_json_params, get_params, format_error, APIError,
+    BadRequestParams)
+from sqlalchemy.exc import IntegrityError
 
-from shortener.models import ShortenerTables, NoShortenerTables
-from shortener.keygen import generate_token
+from shortener.bloom import (
+    ShortUrlFilter, DEFAULT_ERROR_RATE, DEFAULT_REPORT_INTERVAL)
+from shortener.cache import LRUCache
+from shortener.database import (
+    get_engine, ReplicaPool, DEFAULT_POOL_SIZE, DEFAULT_MAX_OVERFLOW,
+    ROUND_ROBIN)
+from shortener.hilo import IdAllocator, DEFAULT_BLOCK_SIZE, DEFAULT_BLOCK_TTL
+from shortener.hits import (
+    HitAggregator, UnwrittenHits, DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_PENDING)
+from shortener.models import (
+    ShortenerTables, NoShortenerTables, ShortenerDBError, MAX_ROW_ID)
+from shortener.keygen import decode_token
 from shortener.metrics import ShortenerMetrics
+from shortener.migrations import (
+    migrate, get_schema_version, ID_COUNTER_VERSION, HIT_ROLLUPS_VERSION)
+from shortener.redirect import RedirectResource
+from shortener.shared_cache import cache_key, make_shared_cache
+from shortener.sharding import Shard, shard_for_hash, shard_for_id
+from shortener.singleflight import SingleFlight
+from shortener.timing import QueryTimer, timed, get_request_timer
 
 DEFAULT_USER_TOKEN = 'generic-user-token'
+DEFAULT_REDIRECT_CACHE_TTL = 300
+DEFAULT_CREATE_CACHE_TTL = 3600
+DEFAULT_MAX_BATCH_SIZE = 10000
 
 
+def gather(ds):
+    '''
+    Like :func:`gatherResults`, but fails with the first failure itself
+    rather than a :class:`FirstError`.
+    '''
+    d = gatherResults(ds, consumeErrors=True)
+
+    def unwrap(failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+    return d.addErrback(unwrap)
+
+
+def raw_handler(*args, **kw):
+    '''
+    Like aludel's ``handler``, for methods that write their own response
+    rather than returning a JSON body. Takes the same parameters as Klein's
+    ``route()``, and the class must also be decorated with
+    :func:`raw_handlers`.
+    '''
+    def deco(func):
+        func._raw_handler_args = (args, kw)
+        return func
+    return deco
+
+
+def raw_handlers(service_class):
+    '''
+    Routes the :func:`raw_handler` methods of ``service_class``, which must
+    already have been decorated with aludel's ``service``.
+    '''
+    for func in vars(service_class).values():
+        if hasattr(func, '_raw_handler_args'):
+            args, kw = func._raw_handler_args
+            service_class.app.route(*args, **kw)(func)
+    return service_class
+
+
+def make_engine(reactor, config, connection_string):
+    return get_engine(
+        connection_string, reactor,
+        pool_size=config.get('db_pool_size', DEFAULT_POOL_SIZE),
+        max_overflow=config.get('db_max_overflow', DEFAULT_MAX_OVERFLOW))
+
+
+def make_read_engine(config, engine, make_engine):
+    '''
+    Returns the engine to send reads to: a :class:`ReplicaPool` of engines
+    made with ``make_engine(connection_string)`` for each of
+    ``config['read_connection_strings']``, or ``engine`` if there are none.
+    '''
+    connection_strings = config.get('read_connection_strings')
+    if not connection_strings:
+        return engine
+    return ReplicaPool(
+        [make_engine(connection_string)
+         for connection_string in connection_strings],
+        policy=config.get('read_replica_policy', ROUND_ROBIN))
+
+
+def make_shards(config, make_engine):
+    '''
+    Returns a :class:`Shard` for each of ``config['shards']``, or just one
+    for ``config['connection_string']`` if the account isn't sharded. Each
+    shard is a connection string, or a dict with a ``connection_string``
+    and ``read_connection_strings`` of its own, and its engines are made
+    with ``make_engine(connection_string)``.
+    '''
+    shard_configs = config.get('shards') or [config]
+    shards = []
+    for index, shard_config in enumerate(shard_configs):
+        if not isinstance(shard_config, dict):
+            shard_config = {'connection_string': shard_config}
+        shard_config = dict(shard_config)
+        shard_config.setdefault(
+            'read_replica_policy',
+            config.get('read_replica_policy', ROUND_ROBIN))
+        engine = make_engine(shard_config['connection_string'])
+        shards.append(Shard(
+            index, len(shard_configs), engine,
+            make_read_engine(shard_config, engine, make_engine)))
+    return shards
+
+
+@raw_handlers
 @service
 class ShortenerServiceApp(object):
 
-    def __init__(self, reactor, config):
+    def __init__(self, reactor, config, metrics=None, shards=None):
+        '''
+        Serves ``config['account']`` from ``shards``, which are made with
+        :func:`make_shards` by default. Apps serving several accounts from
+        one process share their shards' engines, and get their ``metrics``
+        from :meth:`shortener.metrics.ShortenerMetrics.for_account`.
+        '''
         self.config = config
-        self.engine = get_engine(config['connection_string'], reactor)
-        self.metrics = ShortenerMetrics(reactor, config)
+        self.clock = reactor
+        if shards is None:
+            shards = make_shards(
+                config, lambda connection_string: make_engine(
+                    reactor, config, connection_string))
+        self.shards = shards
+        # The only engine, unless the account is sharded.
+        self.engine = shards[0].engine
+        if metrics is None:
+            metrics = ShortenerMetrics(reactor, config)
+        self.metrics = metrics
+        # Built once, and copied onto each connection by get_tables().
+        self.tables = ShortenerTables(config['account'], None)
+        self.timing_metrics = None
+        self.query_timer = None
+        if config.get('timing_metrics'):
+            self.timing_metrics = self.metrics
+            self.query_timer = QueryTimer(self.metrics)
+        self.server_timing = config.get('server_timing', False)
+        self.redirect_cache = LRUCache(
+            config.get('redirect_cache_size', 0),
+            config.get('redirect_cache_ttl', DEFAULT_REDIRECT_CACHE_TTL),
+            clock=reactor)
+        self.create_cache = LRUCache(
+            config.get('create_cache_size', 0),
+            config.get('create_cache_ttl', DEFAULT_CREATE_CACHE_TTL),
+            clock=reactor)
+        self.shared_cache = make_shared_cache(reactor, config)
+        self.lookups = SingleFlight()
+        self.creates = SingleFlight()
+        self.hits = HitAggregator(
+            reactor, self.flush_hits,
+            interval=config.get('hits_flush_interval', DEFAULT_FLUSH_INTERVAL),
+            max_pending=config.get('hits_max_pending', DEFAULT_MAX_PENDING),
+            flush_rollups=(
+                self.flush_rollups if config.get('hit_rollups') else None))
+        # Once an account has an id counter every process has to reserve
+        # ids from it, or the ids the database assigns would collide with
+        # reserved ones.
+        block_size = config.get('id_block_size') or DEFAULT_BLOCK_SIZE
+        block_ttl = config.get('id_block_ttl', DEFAULT_BLOCK_TTL)
+        for shard in shards:
+            shard.id_allocator = IdAllocator(
+                reactor, partial(self.reserve_ids, shard), block_size,
+                block_ttl=block_ttl)
+        self.short_url_filter = None
+        if config.get('bloom_capacity'):
+            self.short_url_filter = ShortUrlFilter(
+                reactor, self.load_short_urls, self.load_id_ceiling,
+                config['bloom_capacity'],
+                error_rate=config.get('bloom_error_rate', DEFAULT_ERROR_RATE),
+                report_fill_ratio=self.metrics.publish_bloom_fill_ratio,
+                report_interval=config.get(
+                    'bloom_report_interval', DEFAULT_REPORT_INTERVAL),
+                # Twice the block ttl leaves time for inserts of the last
+                # ids handed out from a block, or assigned by the database
+                # before an account is migrated, to finish.
+                settle_delay=2 * block_ttl,
+                load_settled_id=self.load_settled_id,
+                save_settled_id=self.save_settled_id)
         self.load_handlers()
 
     def load_handlers(self):
@@ -33,9 +211,15 @@ class ShortenerServiceApp(object):
             handler_module = __import__(module, fromlist=[class_name])
             handler_class = getattr(handler_module, class_name)
             handler = handler_class(self.config, self.engine)
+            handler.clock = self.clock
+            handler.read_engine = self.shards[0].read_engine
+            handler.shards = self.shards
+            handler.tables = self.tables
+            handler.query_timer = self.query_timer
             self.handlers[name] = handler
 
     @handler('/api/create', methods=['PUT'])
+    @timed('create')
     @inlineCallbacks
     def create_url(self, request):
         props = get_json_params(
@@ -43,29 +227,94 @@ class ShortenerServiceApp(object):
         long_url = props['long_url']
         user_token = props.get('user_token', None)
 
-        short_url = yield self.shorten_url(long_url, user_token)
+        short_url = yield self.shorten_url(
+            long_url, user_token, get_request_timer(request))
         yield request.setResponseCode(http.CREATED)
         returnValue({'short_url': short_url})
 
+    @handler('/api/create/batch', methods=['PUT'])
+    @timed('create_batch')
+    @inlineCallbacks
+    def create_url_batch(self, request):
+        props = get_json_params(request, ['urls'])
+        urls = props['urls']
+        if not isinstance(urls, list):
+            raise BadRequestParams("'urls' must be a list")
+        max_batch_size = self.config.get(
+            'max_batch_size', DEFAULT_MAX_BATCH_SIZE)
+        if len(urls) > max_batch_size:
+            raise BadRequestParams(
+                'At most %s urls may be shortened at once' % max_batch_size)
+
+        entries = []
+        for url in urls:
+            if not isinstance(url, dict):
+                raise BadRequestParams("'urls' must be a list of objects")
+            url = get_params(url, ['long_url'], ['user_token'])
+            if not isinstance(url['long_url'], basestring):
+                raise BadRequestParams("'long_url' must be a string")
+            user_token = url.get('user_token', None)
+            if user_token is not None and not isinstance(
+                    user_token, basestring):
+                raise BadRequestParams("'user_token' must be a string")
+            entries.append((url['long_url'], user_token))
+
+        short_urls = yield self.shorten_urls(
+            entries, get_request_timer(request))
+        yield request.setResponseCode(http.CREATED)
+        returnValue({'short_urls': short_urls})
+
     @handler('/api/init', methods=['GET'])
+    @timed('init')
     @inlineCallbacks
     def init_account(self, request):
         '''
         Initializes the account and creates the database tables
         '''
-        conn = yield self.engine.connect()
+        created = False
+        for shard in self.shards:
+            conn = yield shard.engine.connect()
+            tables = self.get_tables(conn, get_request_timer(request))
+            try:
+                already_exists = yield tables.exists()
+                if not already_exists:
+                    yield tables.create_tables()
+                    created = True
+            finally:
+                yield conn.close()
+
+        returnValue({'created': created})
+
+    @handler('/api/migrate', methods=['PUT'])
+    @timed('migrate')
+    @inlineCallbacks
+    def migrate_account(self, request):
+        '''
+        Upgrades the account's tables to the latest schema version
+        '''
         account = self.config['account']
-        tables = ShortenerTables(account, conn)
-        try:
-            already_exists = yield tables.exists()
-            if not already_exists:
-                yield tables.create_tables()
-        finally:
-            yield conn.close()
+        versions = []
+        for shard in self.shards:
+            conn = yield shard.engine.connect()
+            try:
+                tables = self.get_tables(conn, get_request_timer(request))
+                exists = yield tables.exists()
+                if not exists:
+                    raise APIError(
+                        'Account "%s" does not exist' % account, 404)
+                shard_versions = yield migrate(tables)
+                versions.append(shard_versions)
+            finally:
+                yield conn.close()
 
-        returnValue({'created': not already_exists})
+        from_versions, to_versions = zip(*versions)
+        returnValue({
+            'from_version': min(from_versions),
+            'to_version': max(to_versions),
+        })
 
     @handler('/api/handler/<string:handler_name>', methods=['GET'])
+    @timed('handler')
     @inlineCallbacks
     def run_handler(self, request, handler_name):
         handler = self.handlers.get(handler_name)
@@ -76,70 +325,569 @@ class ShortenerServiceApp(object):
             response = yield handler.render(request)
             returnValue(response)
 
+    @raw_handler('/api/handler/<string:handler_name>/export', methods=['GET'])
+    def export_handler(self, request, handler_name):
+        '''
+        Streams a handler's export. Routed with :func:`raw_handler` rather
+        than ``@handler``, which only deals in JSON bodies.
+        '''
+        handler = self.handlers.get(handler_name)
+        if not handler:
+            return format_error(
+                APIError('Unknown handler: %s' % handler_name, 404), request)
+        d = maybeDeferred(handler.export, request)
+        return d.addErrback(self._export_failed, request)
+
+    def _export_failed(self, failure, request):
+        error = failure.value
+        if failure.check(NoShortenerTables, CollectionMissingError):
+            error = APIError(
+                'Account "%s" does not exist' % self.config['account'], 404)
+        elif not failure.check(APIError):
+            log.err(failure)
+            error = APIError('Internal server error.')
+        return format_error(error, request)
+
     @handler('/<string:short_url>', methods=['GET'])
+    @timed('resolve')
     @inlineCallbacks
     def resolve_url(self, request, short_url):
-        row = yield self.get_row_by_short_url(short_url)
+        '''
+        Only reached with HEAD requests when served by :meth:`resource`,
+        which handles GETs itself.
+        '''
+        row = yield self.get_row_by_short_url(
+            short_url, get_request_timer(request))
+        self.set_redirect(request, row)
+        returnValue({})
+
+    def set_redirect(self, request, row):
+        '''
+        Sets the response code and headers for a short url that was looked
+        up as ``row``, or that wasn't found if it's ``None``.
+        '''
         if row and row['long_url']:
             request.setResponseCode(http.MOVED_PERMANENTLY)
             request.setHeader(b"location", row['long_url'].encode('utf-8'))
-            yield self.metrics.publish_expanded_url_metrics()
+            self.metrics.publish_expanded_url_metrics()
         else:
             request.setResponseCode(http.NOT_FOUND)
-            yield self.metrics.publish_invalid_url_metrics()
-        returnValue({})
+            self.metrics.publish_invalid_url_metrics()
 
-    @inlineCallbacks
-    def shorten_url(self, long_url, user_token=None):
+    def resource(self):
+        '''
+        Returns the service's root resource, which serves redirects directly
+        and everything else with :attr:`app`.
+        '''
+        return RedirectResource(self, self.app.resource())
+
+    def shorten_url(self, long_url, user_token=None, timer=None):
+        '''
+        Returns the short url for ``long_url``, creating it if need be.
+        Concurrent calls for the same url share one lookup or create.
+        '''
         if not user_token:
             user_token = DEFAULT_USER_TOKEN
+        cached = self.create_cache.get(
+            (urlparse(long_url).netloc, user_token, long_url))
+        if cached is not None:
+            return succeed(
+                urljoin(self.config['host_domain'], cached['short_url']))
+        return self.creates.run(
+            (user_token, long_url), self._shorten_url, long_url, user_token,
+            timer)
 
-        row = yield self.get_or_create_row(long_url, user_token)
+    @inlineCallbacks
+    def _shorten_url(self, long_url, user_token, timer):
+        row, created = yield self.get_or_create_short_url(
+            long_url, user_token, timer)
         short_url = row['short_url']
-        if not row['short_url']:
-            short_url = generate_token(row['id'])
-            yield self.update_short_url(row['id'], short_url)
+        if created:
             yield self.metrics.publish_created_url_metrics()
+        self.add_to_filter(short_url)
+        self.cache_redirect(row['id'], short_url, long_url)
         returnValue(urljoin(self.config['host_domain'], short_url))
 
     @inlineCallbacks
-    def get_or_create_row(self, url, user_token):
-        account = self.config['account']
+    def shorten_urls(self, entries, timer=None):
+        '''
+        Shortens a list of ``(long_url, user_token)`` tuples, returning the
+        short urls in the same order.
+        '''
+        if not entries:
+            returnValue([])
+        urls = [(urlparse(long_url).netloc,
+                 user_token or DEFAULT_USER_TOKEN,
+                 long_url)
+                for long_url, user_token in entries]
+
+        rows = [self.create_cache.get(url) for url in urls]
+        missing = [url for url, row in zip(urls, rows) if row is None]
+        created = 0
+        if missing:
+            found, created = yield self.get_or_create_short_urls(
+                missing, timer)
+            found = iter(found)
+            rows = [next(found) if row is None else row for row in rows]
+        if created:
+            yield self.metrics.publish_created_url_metrics(created)
+        short_urls = []
+        for (domain, user_token, long_url), row in zip(urls, rows):
+            self.cache_create(domain, user_token, row)
+            self.add_to_filter(row['short_url'])
+            self.cache_redirect(row['id'], row['short_url'], row['long_url'])
+            short_urls.append(
+                urljoin(self.config['host_domain'], row['short_url']))
+        returnValue(short_urls)
+
+    def add_to_filter(self, short_url):
+        if self.short_url_filter is not None:
+            self.short_url_filter.add(short_url)
+
+    def cache_create(self, domain, user_token, row):
+        '''
+        Remembers ``row`` as the short url for ``(domain, user_token,
+        long_url)``, so that shortening it again needn't look it up.
+        '''
+        if row['short_url']:
+            self.create_cache.set((domain, user_token, row['long_url']), {
+                'id': row['id'],
+                'short_url': row['short_url'],
+                'long_url': row['long_url'],
+            })
+
+    def cache_redirect(self, row_id, short_url, long_url):
+        self.redirect_cache.set(short_url, {
+            'id': row_id,
+            'short_url': short_url,
+            'long_url': long_url,
+        })
+
+    def get_tables(self, conn, timer=None):
+        '''
+        Returns the account's tables on ``conn``, with their statements
+        timed by ``timer``, or by :attr:`query_timer` outside of requests.
+        '''
+        return self.tables.with_connection(
+            conn, query_timer=timer or self.query_timer)
+
+    @inlineCallbacks
+    def allocate_ids(self, shard, count):
+        sequences = yield shard.id_allocator.allocate(count)
+        if sequences is None:
+            if len(self.shards) > 1:
+                raise APIError(
+                    'Account "%s" needs migrating before it can be sharded' % (
+                        self.config['account'],), 500)
+            returnValue(None)
+        returnValue([shard.row_id(sequence) for sequence in sequences])
+
+    def release_unused_ids(self, shard, row_ids, rows):
+        if row_ids:
+            used = set(row['id'] for row in rows)
+            shard.id_allocator.release([
+                shard.sequence(row_id)
+                for row_id in row_ids if row_id not in used])
+
+    def short_url_key(self, short_url):
+        return cache_key(self.config['account'], 'short', short_url)
+
+    def hash_key(self, hashkey):
+        return cache_key(self.config['account'], 'hash', hashkey)
+
+    def get_shared(self, keys):
+        '''
+        Looks ``keys`` up in the shared cache, returning a Deferred that
+        fires with a dict of the ones found.
+        '''
+        if self.shared_cache is None:
+            return succeed({})
+        return self.shared_cache.get_many(keys)
+
+    def share_rows(self, rows, hash_keys=()):
+        '''
+        Fills the shared cache with ``rows``, by short url and, for rows
+        that were just created or looked up by long url, by ``hash_keys``.
+        '''
+        if self.shared_cache is None:
+            return
+        values = {}
+        if not hash_keys:
+            hash_keys = [None] * len(rows)
+        for row, key in zip(rows, hash_keys):
+            value = {
+                'id': row['id'],
+                'short_url': row['short_url'],
+                'long_url': row['long_url'],
+            }
+            values[self.short_url_key(row['short_url'])] = value
+            if key is not None:
+                values[key] = value
+        # Not waited for, and the backends never fail.
+        self.shared_cache.set_many(values)
+
+    @inlineCallbacks
+    def get_or_create_short_url(self, url, user_token, timer=None):
         domain = urlparse(url).netloc
-        conn = yield self.engine.connect()
-        try:
-            tables = ShortenerTables(account, conn)
+        hashkey = self.tables.hash_url(domain, user_token, url)
+        hash_key = self.hash_key(hashkey)
+        shared = yield self.get_shared([hash_key])
+        if hash_key in shared:
+            self.cache_create(domain, user_token, shared[hash_key])
+            returnValue((shared[hash_key], False))
 
-            row = yield tables.get_or_create_row(
+        @inlineCallbacks
+        def create(tables, row_ids):
+            row, created = yield tables.get_or_create_short_url(
                 domain,
                 user_token,
-                url
+                url,
+                row_ids[0] if row_ids else None
             )
-            returnValue(row)
-        except NoShortenerTables:
-            raise APIError('Account "%s" does not exist' % account, 200)
+            returnValue(([row], created))
+
+        shard = shard_for_hash(self.shards, hashkey)
+        [row], created = yield self._create_rows(shard, 1, create, timer)
+        self.share_rows([row], [hash_key])
+        self.cache_create(domain, user_token, row)
+        returnValue((row, created))
+
+    @inlineCallbacks
+    def get_or_create_short_urls(self, urls, timer=None):
+        hashkeys = [self.tables.hash_url(*url) for url in urls]
+        hash_keys = [self.hash_key(hashkey) for hashkey in hashkeys]
+        shared = yield self.get_shared(hash_keys)
+        missing = {}
+        for url, hashkey, key in zip(urls, hashkeys, hash_keys):
+            if key not in shared:
+                shard = shard_for_hash(self.shards, hashkey)
+                missing.setdefault(shard.index, []).append((url, key))
+        if not missing:
+            returnValue(([shared[key] for key in hash_keys], 0))
+
+        shards = [self.shards[index] for index in sorted(missing)]
+        results = yield gather([
+            self._create_short_urls(
+                shard, [url for url, key in missing[shard.index]], timer)
+            for shard in shards])
+        created = 0
+        for shard, (rows, shard_created) in zip(shards, results):
+            missing_keys = [key for url, key in missing[shard.index]]
+            self.share_rows(rows, missing_keys)
+            shared.update(zip(missing_keys, rows))
+            created += shard_created
+        returnValue(([shared[key] for key in hash_keys], created))
+
+    def _create_short_urls(self, shard, urls, timer):
+        return self._create_rows(
+            shard, len(urls),
+            lambda tables, row_ids: tables.get_or_create_short_urls(
+                urls, row_ids),
+            timer)
+
+    @inlineCallbacks
+    def _create_rows(self, shard, count, create, timer):
+        '''
+        Returns what ``create(tables, row_ids)`` does, ``(rows, created)``,
+        with ``count`` ids reserved on ``shard``. The ids are reserved
+        before connecting, since reserving them takes a connection too.
+
+        If the ids turn out to be taken by rows that weren't given them by
+        the counter, they're dropped rather than released and ``create`` is
+        tried once more with new ones.
+        '''
+        account = self.config['account']
+        for retry in (False, True):
+            try:
+                row_ids = yield self.allocate_ids(shard, count)
+                conn = yield shard.engine.connect()
+                try:
+                    rows, created = yield create(
+                        self.get_tables(conn, timer), row_ids)
+                finally:
+                    yield conn.close()
+            except NoShortenerTables:
+                raise APIError('Account "%s" does not exist' % account, 200)
+            except IntegrityError:
+                if retry or not row_ids:
+                    raise
+                continue
+            self.release_unused_ids(shard, row_ids, rows)
+            returnValue((rows, created))
+
+    def get_row_by_short_url(self, short_url, timer=None):
+        cached = self.get_cached_row(short_url)
+        if cached is not None:
+            return succeed(cached)
+        return self.fetch_row(short_url, timer)
+
+    def get_cached_row(self, short_url):
+        '''
+        Returns the cached row for ``short_url``, recording a hit, or
+        ``None`` if it isn't cached.
+        '''
+        cached = self.redirect_cache.get(short_url)
+        if cached is not None:
+            self.hits.record_hit(cached['id'])
+        return cached
+
+    def fetch_row(self, short_url, timer=None):
+        '''
+        Looks up ``short_url`` in the shared cache, if there is one, and
+        then the database, recording a hit and caching it if it's found.
+        The database lookup goes to a read replica, if there are any, and
+        then the primary if the replica fails or doesn't have it. Concurrent
+        lookups of the same short url share one query.
+        '''
+        # Short URLs are generated from row ids, so malformed or out of range
+        # tokens can be rejected before going anywhere near the database.
+        try:
+            row_id = decode_token(short_url, max_counter=MAX_ROW_ID)
+        except ValueError:
+            return succeed(None)
+        if (self.short_url_filter is not None and
+                self.short_url_filter.definitely_missing(short_url, row_id)):
+            return succeed(None)
+
+        d = self.lookups.run(
+            short_url, self._lookup_row, row_id, short_url, timer)
+        return d.addCallback(self._record_hit)
+
+    def _record_hit(self, row):
+        if row:
+            self.hits.record_hit(row['id'])
+        return row
+
+    @inlineCallbacks
+    def _lookup_row(self, row_id, short_url, timer):
+        key = self.short_url_key(short_url)
+        shared = yield self.get_shared([key])
+        row = shared.get(key)
+        if row is None:
+            shard = shard_for_id(self.shards, row_id)
+            row = yield shard.read(self._select_row, row_id, short_url, timer)
+            if row and row['long_url']:
+                self.share_rows([row])
+                self.cache_create(row['domain'], row['user_token'], row)
+
+        if row and row['long_url']:
+            self.cache_redirect(row['id'], row['short_url'], row['long_url'])
+        returnValue(row)
+
+    def _select_row(self, conn, row_id, short_url, timer):
+        return self.get_tables(conn, timer).get_row_by_id(
+            row_id, short_url, increment=False)
+
+    @inlineCallbacks
+    def warm_up(self, count, window=None):
+        '''
+        Loads up to ``count`` of the most hit urls into the redirect cache,
+        ranked by lifetime hits or, if ``window`` is given and the account
+        has hit rollups, by hits in the last ``window`` seconds. Returns the
+        number of urls loaded.
+        '''
+        count = min(count, self.redirect_cache.max_size)
+        if count <= 0:
+            returnValue(0)
+        results = yield gather([
+            self._get_hot_urls(shard, count, window)
+            for shard in self.shards])
+        rows = sorted(chain(*results), key=lambda row: row['hits'],
+                      reverse=True)[:count]
+        # The hottest urls go in last, so they're the last to be evicted.
+        for row in reversed(rows):
+            self.cache_redirect(row['id'], row['short_url'], row['long_url'])
+        returnValue(len(rows))
+
+    @inlineCallbacks
+    def _get_hot_urls(self, shard, count, window):
+        conn = yield shard.read_engine.connect()
+        try:
+            tables = self.get_tables(conn)
+
+            since = None
+            if window is not None:
+                version = yield get_schema_version(tables)
+                if version >= HIT_ROLLUPS_VERSION:
+                    since = datetime.utcfromtimestamp(
+                        self.clock.seconds() - window)
+            rows = yield tables.get_hot_urls(count, since)
         finally:
             yield conn.close()
+        returnValue(rows)
 
     @inlineCallbacks
-    def update_short_url(self, row_id, short_url):
-        account = self.config['account']
-        conn = yield self.engine.connect()
+    def load_short_urls(self, after_id, limit):
+        pages = yield gather([
+            self._load_short_urls(shard, after_id, limit)
+            for shard in self.shards])
+        returnValue(sorted(chain(*pages))[:limit])
+
+    @inlineCallbacks
+    def _load_short_urls(self, shard, after_id, limit):
+        conn = yield shard.engine.connect()
         try:
-            tables = ShortenerTables(account, conn)
+            tables = self.get_tables(conn)
 
-            yield tables.update_short_url(row_id, short_url)
+            rows = yield tables.get_short_urls(after_id, limit)
         finally:
             yield conn.close()
+        returnValue(rows)
 
     @inlineCallbacks
-    def get_row_by_short_url(self, short_url):
+    def reserve_ids(self, shard, count):
+        '''
+        Reserves ``count`` url sequence numbers on ``shard``, returning the
+        first one.
+        '''
         account = self.config['account']
-        conn = yield self.engine.connect()
+        conn = yield shard.engine.connect()
+        try:
+            tables = self.get_tables(conn)
+
+            version = yield get_schema_version(tables)
+            if version < ID_COUNTER_VERSION:
+                # Not migrated yet, the database assigns ids.
+                returnValue(None)
+            first = yield tables.reserve_ids(count)
+        except CollectionMissingError:
+            raise NoShortenerTables(account)
+        finally:
+            yield conn.close()
+        if shard.row_id(first + count - 1) > MAX_ROW_ID:
+            raise ShortenerDBError('Out of url ids')
+        returnValue(first)
+
+    @inlineCallbacks
+    def load_id_ceiling(self):
+        '''
+        Returns the highest id below which every id has been reserved, or
+        assigned by the database for accounts without an id counter, on
+        whichever shard it belongs to.
+        '''
+        ceilings = yield gather([
+            self._load_sequence_ceiling(shard) for shard in self.shards])
+        returnValue((min(ceilings) + 1) * len(self.shards) - 1)
+
+    @inlineCallbacks
+    def _load_sequence_ceiling(self, shard):
+        conn = yield shard.engine.connect()
+        try:
+            tables = self.get_tables(conn)
+
+            version = yield get_schema_version(tables)
+            if version < ID_COUNTER_VERSION:
+                ceiling = yield tables.get_max_id()
+            else:
+                ceiling = yield tables.get_id_counter()
+        finally:
+            yield conn.close()
+        returnValue(ceiling)
+
+    @inlineCallbacks
+    def load_settled_id(self):
+        '''
+        Returns the highest id below which every url has been inserted, as
+        last recorded with :meth:`save_settled_id`, or ``None`` if there's
+        no record of one on some shard.
+        '''
+        settled = yield gather([
+            self._with_shard_tables(shard, self._get_settled_sequence)
+            for shard in self.shards])
+        if None in settled:
+            returnValue(None)
+        returnValue((min(settled) + 1) * len(self.shards) - 1)
+
+    def save_settled_id(self, row_id):
+        '''
+        Records that every url up to ``row_id`` has been inserted.
+        '''
+        sequence = (row_id + 1) // len(self.shards) - 1
+        return gather([
+            self._with_shard_tables(
+                shard, self._set_settled_sequence, sequence)
+            for shard in self.shards])
+
+    @inlineCallbacks
+    def _with_shard_tables(self, shard, f, *args):
+        conn = yield shard.engine.connect()
+        try:
+            tables = self.get_tables(conn)
+
+            result = yield f(tables, *args)
+        finally:
+            yield conn.close()
+        returnValue(result)
+
+    @inlineCallbacks
+    def _get_settled_sequence(self, tables):
+        version = yield get_schema_version(tables)
+        if version < ID_COUNTER_VERSION:
+            returnValue(None)
+        settled = yield tables.get_settled_id()
+        returnValue(settled)
+
+    @inlineCallbacks
+    def _set_settled_sequence(self, tables, sequence):
+        version = yield get_schema_version(tables)
+        if version >= ID_COUNTER_VERSION:
+            yield tables.set_settled_id(sequence)
+
+    def flush_hits(self, hits):
+        return self._flush_by_shard(hits, self._flush_hits)
+
+    def flush_rollups(self, hits):
+        return self._flush_by_shard(
+            hits, self._flush_rollups, url_id=lambda key: key[0])
+
+    @inlineCallbacks
+    def _flush_by_shard(self, counts, flush, url_id=lambda key: key):
+        '''
+        Writes ``counts`` to the shards their urls are on with
+        ``flush(shard, counts)``, raising :class:`UnwrittenHits` with the
+        counts for any shards that fail.
+        '''
+        groups = {}
+        for key, count in counts.iteritems():
+            shard = shard_for_id(self.shards, url_id(key))
+            groups.setdefault(shard.index, {})[key] = count
+        if len(groups) == 1:
+            [(index, group)] = groups.items()
+            yield flush(self.shards[index], group)
+            return
+
+        groups = sorted(groups.items())
+        results = yield DeferredList([
+            flush(self.shards[index], group) for index, group in groups],
+            consumeErrors=True)
+        unwritten = {}
+        for (index, group), (success, result) in zip(groups, results):
+            if not success:
+                log.err(result, 'Failed to write hits to shard %s.' % (index,))
+                unwritten.update(group)
+        if unwritten:
+            raise UnwrittenHits(unwritten)
+
+    @inlineCallbacks
+    def _flush_hits(self, shard, hits):
+        conn = yield shard.engine.connect()
+        try:
+            tables = self.get_tables(conn)
+
+            yield tables.update_hits(hits)
+        finally:
+            yield conn.close()
+
+    @inlineCallbacks
+    def _flush_rollups(self, shard, hits):
+        conn = yield shard.engine.connect()
         try:
-            tables = ShortenerTables(account, conn)
+            tables = self.get_tables(conn)
 
-            row = yield tables.get_row_by_short_url(short_url)
-            returnValue(row)
+            version = yield get_schema_version(tables)
+            if version < HIT_ROLLUPS_VERSION:
+                # Not migrated yet, there's nowhere to keep them.
+                returnValue(None)
+            yield tables.update_hit_rollups(hits)
         finally:
             yield conn.close()
@@ -0,0 +1,208 @@
+import hashlib
+import math
+import struct
+
+from twisted.application.service import Service
+from twisted.internet.defer import (
+    CancelledError, Deferred, inlineCallbacks, maybeDeferred)
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.python import log
+
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_LOAD_PAGE_SIZE = 10000
+DEFAULT_REPORT_INTERVAL = 60
+
+
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter of strings.
+
+    Sized for ``capacity`` items at a false positive rate of ``error_rate``.
+    Adding more items than that keeps working, but the false positive rate
+    goes up, which :meth:`fill_ratio` gives an idea of. There are never any
+    false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=DEFAULT_ERROR_RATE):
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(
+            int(round(float(self.num_bits) / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._bits_set = 0
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64 bit halves of one digest.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                self._bits_set += 1
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def fill_ratio(self):
+        return float(self._bits_set) / self.num_bits
+
+
+class ShortUrlFilter(Service):
+    """
+    Knows which short urls definitely haven't been issued, so that lookups
+    for them don't need to go to the database.
+
+    When the service starts, every issued short url is loaded into a
+    :class:`BloomFilter` a page at a time with ``load_short_urls(after_id,
+    limit)``, which returns ``(id, short_url)`` pairs ordered by id. Short
+    urls created later should be passed to :meth:`add`.
+
+    Urls aren't necessarily inserted in id order, whether their ids are
+    reserved in blocks (see :mod:`shortener.hilo`) or assigned by the
+    database to transactions that commit out of order, so the largest id
+    seen while loading says nothing about the ones below it. Instead,
+    ``load_id_ceiling()`` is called before loading to get the last id
+    handed out so far, and loading waits ``settle_delay`` seconds for the
+    inserts of every id up to it to finish. The filter is then trusted for
+    ids up to that ceiling, which is passed to ``save_settled_id`` if it's
+    given. Other processes may create newer urls this one never hears
+    about, so lookups for anything above it still go to the database, as
+    do all lookups until loading has finished.
+
+    If ``load_settled_id()`` is given and returns an id saved before, urls
+    are loaded straight away and the filter is trusted for ids up to that
+    one while it waits, after which only the urls above it are loaded
+    again. :attr:`ready_d` fires once the filter is trusted for whatever
+    ids it can be before the wait, or once loading has failed.
+
+    The filter's fill ratio is passed to ``report_fill_ratio`` every
+    ``report_interval`` seconds.
+    """
+
+    def __init__(self, clock, load_short_urls, load_id_ceiling, capacity,
+                 error_rate=DEFAULT_ERROR_RATE,
+                 page_size=DEFAULT_LOAD_PAGE_SIZE,
+                 report_fill_ratio=None,
+                 report_interval=DEFAULT_REPORT_INTERVAL,
+                 settle_delay=0, load_settled_id=None,
+                 save_settled_id=None):
+        self.clock = clock
+        self._load_short_urls = load_short_urls
+        self._load_id_ceiling = load_id_ceiling
+        self._load_settled_id = load_settled_id
+        self._save_settled_id = save_settled_id
+        self.settle_delay = settle_delay
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.page_size = page_size
+        self._report_fill_ratio = report_fill_ratio
+        self.report_interval = report_interval
+        self.max_id = None
+        self.load_d = None
+        self.ready_d = None
+        self._settling = None
+        self._loop = None
+
+    @property
+    def loaded(self):
+        return self.max_id is not None
+
+    def add(self, short_url):
+        self.bloom.add(short_url)
+
+    def definitely_missing(self, short_url, row_id):
+        """
+        Returns ``True`` if ``short_url``, which decodes to ``row_id``,
+        can't exist. ``False`` means it may or may not exist.
+        """
+        if not self.loaded or row_id > self.max_id:
+            return False
+        return short_url not in self.bloom
+
+    @inlineCallbacks
+    def load(self):
+        settled = None
+        if self._load_settled_id is not None:
+            settled = yield self._load_settled_id()
+        ceiling = yield self._load_id_ceiling()
+        after_id = None
+        if settled is not None:
+            yield self._load_pages(None)
+            if not self.running:
+                return
+            self.max_id = settled
+            after_id = settled
+        self._ready(None)
+        if self.settle_delay:
+            self._settling = deferLater(
+                self.clock, self.settle_delay, lambda: None)
+            yield self._settling
+            self._settling = None
+        yield self._load_pages(after_id)
+        if not self.running:
+            return
+        self.max_id = ceiling
+        self.report()
+        if self._save_settled_id is not None:
+            yield maybeDeferred(self._save_settled_id, ceiling).addErrback(
+                log.err, 'Failed to save the settled id ceiling.')
+
+    @inlineCallbacks
+    def _load_pages(self, after_id):
+        while self.running:
+            rows = yield self._load_short_urls(after_id, self.page_size)
+            for row_id, short_url in rows:
+                self.bloom.add(short_url)
+            if rows:
+                after_id = rows[-1][0]
+            if len(rows) < self.page_size:
+                break
+
+    def _ready(self, result):
+        if not self.ready_d.called:
+            self.ready_d.callback(None)
+        return result
+
+    def _load_failed(self, failure):
+        if failure.check(CancelledError):
+            return
+        log.err(failure, 'Failed to load short urls, not filtering lookups.')
+
+    def report(self):
+        if self._report_fill_ratio is not None:
+            self._report_fill_ratio(self.bloom.fill_ratio())
+
+    def startService(self):
+        Service.startService(self)
+        self.ready_d = Deferred()
+        self.load_d = self.load().addErrback(self._load_failed)
+        self.load_d.addBoth(self._ready)
+        self._loop = LoopingCall(self.report)
+        self._loop.clock = self.clock
+        self._loop.start(self.report_interval, now=False)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._settling is not None:
+            self._settling.cancel()
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
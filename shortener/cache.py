@@ -0,0 +1,127 @@
+import time
+
+
+class _Entry(object):
+    __slots__ = ('key', 'value', 'expires', 'prev', 'next')
+
+    def __init__(self, key, value, expires):
+        self.key = key
+        self.value = value
+        self.expires = expires
+        self.prev = None
+        self.next = None
+
+
+class LRUCache(object):
+    """
+    A bounded, in-process least-recently-used cache with a per-entry TTL.
+
+    Entries are kept in a dict for lookups and a doubly linked list for
+    recency so that ``get``, ``set`` and evictions are all O(1). A
+    ``max_size`` of ``0`` disables the cache entirely.
+
+    :param int max_size: Maximum number of entries to hold.
+    :param float ttl:
+        Number of seconds an entry stays valid for. ``None`` means entries
+        never expire and are only removed when evicted.
+    :param clock:
+        Provider of :meth:`seconds`, usually the reactor. Defaults to
+        :func:`time.time` when ``None``.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        # Sentinel node; _head.next is the most recently used entry and
+        # _head.prev the least recently used one.
+        self._head = _Entry(None, None, None)
+        self._head.prev = self._head.next = self._head
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def _now(self):
+        if self._clock is None:
+            return time.time()
+        return self._clock.seconds()
+
+    def _expired(self, entry):
+        return entry.expires is not None and entry.expires <= self._now()
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _push_front(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if self._expired(entry):
+            self._remove(entry)
+            self.evictions += 1
+            self.misses += 1
+            return default
+        self._unlink(entry)
+        self._push_front(entry)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self._now() + self.ttl
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.value = value
+            entry.expires = expires
+            self._unlink(entry)
+            self._push_front(entry)
+            return
+
+        while len(self._entries) >= self.max_size:
+            self._remove(self._head.prev)
+            self.evictions += 1
+
+        entry = _Entry(key, value, expires)
+        self._entries[key] = entry
+        self._push_front(entry)
+
+    def delete(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+
+    def clear(self):
+        self._entries.clear()
+        self._head.prev = self._head.next = self._head
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
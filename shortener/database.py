@@ -0,0 +1,362 @@
+import time
+from collections import deque
+
+from alchimia.engine import (
+    TwistedEngine, TwistedConnection, TwistedResultProxy)
+from alchimia.strategy import TwistedEngineStrategy
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from twisted.internet.defer import DeferredSemaphore, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+POOLED_STRATEGY = '_shortener_pooled'
+DEFAULT_POOL_SIZE = 4
+# Connections opened beyond the pool size under load. Once there are this
+# many more, further connects wait for a connection to be closed. They wait
+# in the reactor rather than on a worker thread, where they could deadlock
+# if the close is queued up behind them on the same thread.
+DEFAULT_MAX_OVERFLOW = 16
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LOADED = 'least_loaded'
+
+
+class _ThreadLane(object):
+    """
+    A single database worker thread.
+
+    A connection and everything done with it (queries, transactions, result
+    fetches and closing it) runs on the lane it was opened on. Connections
+    never hop threads, which keeps SQLite's same-thread checks and the
+    non-thread-safe SQLAlchemy connection objects happy, while separate
+    connections run concurrently on separate lanes.
+    """
+
+    def __init__(self, reactor, name):
+        self._reactor = reactor
+        self._threadpool = ThreadPool(1, 1, name)
+        self.pending = 0
+        self.connections = 0
+
+    def _start(self):
+        self._threadpool.start()
+        self._reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._threadpool.started:
+            self._threadpool.stop()
+
+    def _finished(self, result):
+        self.pending -= 1
+        return result
+
+    def run(self, f, *args, **kw):
+        if not self._threadpool.started:
+            self._start()
+        self.pending += 1
+        d = deferToThreadPool(
+            self._reactor, self._threadpool, f, *args, **kw)
+        return d.addBoth(self._finished)
+
+
+class _LaneBoundEngine(object):
+    """
+    Engine proxy handed to alchimia's connection, transaction and result
+    wrappers so that they all defer to the connection's lane.
+    """
+
+    def __init__(self, engine, lane):
+        self._pooled_engine = engine
+        self._lane = lane
+
+    def _defer_to_thread(self, f, *args, **kw):
+        return self._lane.run(f, *args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self._pooled_engine, name)
+
+
+class TimedResult(TwistedResultProxy):
+    """
+    alchimia's result proxy, with ``queue_time``, how long the statement
+    waited for the connection's thread, and ``execute_time``, how long it
+    took to run there, both in seconds.
+    """
+    queue_time = None
+    execute_time = None
+
+
+class BufferedResult(object):
+    """
+    A query result whose rows were all fetched on the connection's thread as
+    soon as the query ran, for in-memory SQLite databases.
+
+    All their connections share one DBAPI connection, so the rows could
+    otherwise be lost when another connection commits before they're read.
+    Has the same interface as :class:`TimedResult`, whose ``execute_time``
+    here includes fetching the rows. Every row is held in memory, which is
+    fine for the tests and benchmarks in-memory databases are used for.
+    """
+
+    def __init__(self, result_proxy):
+        self._result_proxy = result_proxy
+        self.queue_time = None
+        self.execute_time = None
+        self.returns_rows = result_proxy.returns_rows
+        self.rowcount = result_proxy.rowcount
+        self._keys = []
+        self._rows = deque()
+        if self.returns_rows:
+            self._keys = result_proxy.keys()
+            self._rows.extend(result_proxy.fetchall())
+
+    def fetchone(self):
+        if self._rows:
+            return succeed(self._rows.popleft())
+        return succeed(None)
+
+    def fetchall(self):
+        rows = list(self._rows)
+        self._rows.clear()
+        return succeed(rows)
+
+    def first(self):
+        d = self.fetchone()
+        self._rows.clear()
+        return d
+
+    def scalar(self):
+        return self.first().addCallback(
+            lambda row: row[0] if row is not None else None)
+
+    def keys(self):
+        return succeed(self._keys)
+
+
+class PooledConnection(TwistedConnection):
+    def __init__(self, connection, engine, lane):
+        super(PooledConnection, self).__init__(
+            connection, _LaneBoundEngine(engine, lane))
+        self._lane = lane
+        self._slots = engine._slots
+        self._released = False
+
+    def _release(self, result):
+        if not self._released:
+            self._released = True
+            self._lane.connections -= 1
+            if self._slots is not None:
+                self._slots.release()
+        return result
+
+    def _timed(self, connection, queued_at, args, kw):
+        started = time.time()
+        result_proxy = connection.execute(*args, **kw)
+        if self._engine.buffer_results:
+            result = BufferedResult(result_proxy)
+        else:
+            result = TimedResult(result_proxy, self._engine)
+        result.queue_time = started - queued_at
+        result.execute_time = time.time() - started
+        return result
+
+    def _execute(self, queued_at, *args, **kw):
+        return self._timed(self._connection, queued_at, args, kw)
+
+    def execute(self, *args, **kw):
+        return self._lane.run(self._execute, time.time(), *args, **kw)
+
+    def _execute_autocommit(self, queued_at, *args, **kw):
+        connection = self._connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        return self._timed(connection, queued_at, args, kw)
+
+    def execute_autocommit(self, *args, **kw):
+        """
+        Executes a statement outside of any transaction, for statements such
+        as PostgreSQL's ``CREATE INDEX CONCURRENTLY`` that refuse to run in
+        one. Only for dialects that support the ``AUTOCOMMIT`` isolation
+        level.
+        """
+        return self._lane.run(
+            self._execute_autocommit, time.time(), *args, **kw)
+
+    def close(self, *args, **kw):
+        d = super(PooledConnection, self).close(*args, **kw)
+        return d.addBoth(self._release)
+
+
+class PooledTwistedEngine(TwistedEngine):
+    """
+    An alchimia engine that runs database work on its own set of worker
+    threads instead of the reactor's shared thread pool.
+
+    Each new connection gets a lane of its own, so that a statement waiting
+    on a lock can never hold up the commit that would release it. Up to
+    ``lanes`` lanes are started as they're needed, or any number if it's
+    ``None``; past that, connections share the lane with the fewest open
+    connections and pending operations. With ``max_connections``, at most
+    that many connections are open at once, and :meth:`connect` waits for
+    one to be closed before opening another. With ``buffer_results``, every
+    result's rows are fetched as soon as its query runs.
+    """
+
+    def __init__(self, pool, dialect, url, reactor=None, lanes=1,
+                 max_connections=None, buffer_results=False, **kw):
+        super(PooledTwistedEngine, self).__init__(
+            pool, dialect, url, reactor=reactor, **kw)
+        self.buffer_results = buffer_results
+        self._max_lanes = lanes
+        self._lanes = []
+        self._slots = None
+        if max_connections is not None:
+            self._slots = DeferredSemaphore(max_connections)
+
+    def _add_lane(self):
+        lane = _ThreadLane(
+            self._reactor, 'shortener-db-%s' % (len(self._lanes),))
+        self._lanes.append(lane)
+        return lane
+
+    def _pick_lane(self):
+        if not self._lanes:
+            return self._add_lane()
+        return min(
+            self._lanes, key=lambda lane: (lane.connections, lane.pending))
+
+    def _connection_lane(self):
+        lane = self._pick_lane()
+        if lane.connections and (
+                self._max_lanes is None or
+                len(self._lanes) < self._max_lanes):
+            lane = self._add_lane()
+        return lane
+
+    def _defer_to_thread(self, f, *args, **kw):
+        return self._pick_lane().run(f, *args, **kw)
+
+    def connect(self):
+        if self._slots is None:
+            return self._connect()
+        d = self._slots.acquire()
+        return d.addCallback(lambda _: self._connect())
+
+    def _connect(self):
+        lane = self._connection_lane()
+        lane.connections += 1
+
+        def connection_failed(failure):
+            lane.connections -= 1
+            if self._slots is not None:
+                self._slots.release()
+            return failure
+
+        d = lane.run(self._engine.connect)
+        d.addCallbacks(
+            PooledConnection, connection_failed, callbackArgs=(self, lane))
+        return d
+
+    @property
+    def waiting(self):
+        """
+        The number of connects waiting for a connection to be closed.
+        """
+        if self._slots is None:
+            return 0
+        return len(self._slots.waiting)
+
+    @property
+    def pending(self):
+        return (sum(lane.pending for lane in self._lanes) +
+                self.waiting)
+
+    @property
+    def connections(self):
+        return sum(lane.connections for lane in self._lanes)
+
+    def stop(self):
+        for lane in self._lanes:
+            lane.stop()
+
+
+class ReplicaPool(object):
+    """
+    Spreads connections across the engines of a set of read replicas.
+
+    With the :data:`ROUND_ROBIN` policy each connection goes to the next
+    engine in turn, and with :data:`LEAST_LOADED` to the one with the
+    fewest open connections and pending operations. Has enough of an
+    engine's interface to be used in place of one for reads.
+    """
+
+    def __init__(self, engines, policy=ROUND_ROBIN):
+        if not engines:
+            raise ValueError('At least one replica is needed')
+        if policy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError('Unknown replica policy: %r' % (policy,))
+        self.engines = engines
+        self.policy = policy
+        self._next = 0
+
+    def pick(self):
+        if self.policy == LEAST_LOADED:
+            return min(self.engines, key=lambda engine: (
+                engine.connections, engine.pending))
+        engine = self.engines[self._next]
+        self._next = (self._next + 1) % len(self.engines)
+        return engine
+
+    def connect(self):
+        return self.pick().connect()
+
+    def stop(self):
+        for engine in self.engines:
+            engine.stop()
+
+
+class PooledEngineStrategy(TwistedEngineStrategy):
+    name = POOLED_STRATEGY
+    engine_cls = PooledTwistedEngine
+
+
+PooledEngineStrategy()
+
+
+def _is_memory_sqlite(url):
+    return (url.drivername.startswith('sqlite') and
+            url.database in (None, '', ':memory:'))
+
+
+def get_engine(conn_str, reactor, pool_size=DEFAULT_POOL_SIZE,
+               max_overflow=DEFAULT_MAX_OVERFLOW):
+    """
+    Returns a :class:`PooledTwistedEngine` that keeps ``pool_size`` pooled
+    connections, for databases that use a connection pool, and opens at
+    most ``pool_size + max_overflow`` at once, or any number if
+    ``max_overflow`` is negative. Every open connection has a worker thread
+    of its own.
+    """
+    url = make_url(conn_str)
+    kw = {}
+    lanes = None
+    if max_overflow >= 0:
+        lanes = pool_size + max_overflow
+        kw.update(max_connections=lanes)
+    if url.drivername.startswith('sqlite'):
+        # SQLite file databases don't pool connections, and every thread
+        # gets its own separate in-memory database.
+        if _is_memory_sqlite(url):
+            lanes = 1
+            # All connections share the thread's one DBAPI connection, so
+            # the rollback done when a connection is returned to the pool
+            # would roll back whatever transaction another connection has
+            # open at the time.
+            kw.update(pool_reset_on_return=None, buffer_results=True)
+            kw.pop('max_connections', None)
+    else:
+        kw.update(pool_size=pool_size, max_overflow=max_overflow)
+    return create_engine(
+        conn_str, reactor=reactor, strategy=POOLED_STRATEGY,
+        lanes=lanes, **kw)
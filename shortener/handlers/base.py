@@ -1,7 +1,29 @@
+from aludel.service import APIError
+from twisted.internet import reactor
+
+from shortener.models import ShortenerTables
+from shortener.sharding import Shard
+
+
 class BaseApiHandler(object):
     def __init__(self, config, db_engine):
         self.config = config
         self.engine = db_engine
+        # Replaced with the app's own once it has built the handler, so that
+        # handlers only need to take these two arguments.
+        self.clock = reactor
+        self.read_engine = db_engine
+        self.shards = [Shard(0, 1, db_engine)]
+        self.tables = ShortenerTables(config['account'], None)
+        self.query_timer = None
+
+    def get_tables(self, conn, timer=None):
+        """
+        Returns the account's tables on ``conn``, with their statements
+        timed by ``timer``, or by :attr:`query_timer` outside of requests.
+        """
+        return self.tables.with_connection(
+            conn, query_timer=timer or self.query_timer)
 
     def render(self):
         """
@@ -10,3 +32,12 @@ class BaseApiHandler(object):
         Should return a Dict
         """
         raise NotImplementedError('Subclasses should implement this.')
+
+    def export(self, request):
+        """
+        Writes a streaming response to the request.
+
+        Should return a Deferred that fires once the response has been
+        written, or a string to use as the response body.
+        """
+        raise APIError('Handler does not support exports', 404)
@@ -1,7 +1,58 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
-from shortener.handlers.base import BaseApiHandler
-from shortener.models import ShortenerTables
+import csv
+import json
+from cStringIO import StringIO
+
+from aludel.service import BadRequestParams, format_error
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed)
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
 from twisted.web import http
+from zope.interface import implementer
+
+from shortener.handlers.base import BaseApiHandler
+from shortener.keygen import decode_token
+from shortener.models import MAX_ROW_ID
+from shortener.sharding import shard_for_id
+from shortener.timing import get_request_timer
+
+DEFAULT_EXPORT_PAGE_SIZE = 1000
+EXPORT_FIELDS = [
+    'domain', 'user_token', 'short_url', 'long_url', 'created_at', 'hits']
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+@implementer(IPushProducer)
+class _ExportProducer(object):
+    """
+    Lets an export wait whenever the connection's write buffer is full, and
+    notices when the client goes away.
+    """
+
+    def __init__(self):
+        self.stopped = False
+        self._paused = None
+
+    def wait(self):
+        if self._paused is not None:
+            return self._paused
+        return succeed(None)
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = Deferred()
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
 
 
 class Dump(BaseApiHandler):
@@ -18,20 +69,108 @@ class Dump(BaseApiHandler):
     @inlineCallbacks
     def render(self, request):
         short_url = request.args.get('url')
-        conn = yield self.engine.connect()
+        if not short_url:
+            request.setResponseCode(http.BAD_REQUEST)
+            returnValue({'error': 'expected "?url=<short_url>"'})
+
+        try:
+            row_id = decode_token(short_url[0], max_counter=MAX_ROW_ID)
+        except ValueError:
+            row = None
+        else:
+            shard = shard_for_id(self.shards, row_id)
+            row = yield shard.read(
+                self._get_row, request, row_id, short_url[0])
+
+        if row:
+            returnValue(self._format(row, row))
+        else:
+            request.setResponseCode(http.NOT_FOUND)
+            returnValue({'error': 'short url not found'})
+
+    def _get_row(self, conn, request, row_id, short_url):
+        tables = self.get_tables(conn, get_request_timer(request))
+        return tables.get_row_with_hits(row_id, short_url)
+
+    def _format_ndjson(self, rows):
+        return ''.join(
+            json.dumps(self._format(row, row)) + '\n' for row in rows)
+
+    def _format_csv(self, rows, header=False):
+        output = StringIO()
+        writer = csv.writer(output)
+        if header:
+            writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            data = self._format(row, row)
+            writer.writerow([
+                unicode(data[field]).encode('utf-8')
+                for field in EXPORT_FIELDS])
+        return output.getvalue()
+
+    def export(self, request):
+        """
+        Streams every short url and its hit count as NDJSON or CSV, chosen
+        with ``?format=``.
+
+        The table is read a page of ``export_page_size`` rows at a time,
+        using the last id of each page to select the next one, and each page
+        is written out before the next is fetched. Reading pauses while the
+        client is behind.
+        """
+        export_format = request.args.get('format', ['ndjson'])[0]
+        if export_format not in EXPORT_CONTENT_TYPES:
+            return format_error(BadRequestParams(
+                'format must be one of: %s' % (
+                    ', '.join(sorted(EXPORT_CONTENT_TYPES)),)), request)
+        request.setHeader(
+            'Content-Type', EXPORT_CONTENT_TYPES[export_format])
+        return self._stream(request, export_format)
+
+    @inlineCallbacks
+    def _stream(self, request, export_format):
+        page_size = self.config.get(
+            'export_page_size', DEFAULT_EXPORT_PAGE_SIZE)
+        producer = _ExportProducer()
+        request.registerProducer(producer, True)
+        try:
+            header = True
+            # Sharded accounts are exported one shard after the other.
+            for shard in self.shards:
+                if producer.stopped:
+                    break
+                header = yield self._stream_shard(
+                    shard, request, producer, export_format, page_size,
+                    header)
+        except Exception:
+            if not request.startedWriting:
+                raise
+            # The status and part of the body have been sent already, so the
+            # only way left to tell the client that the export is incomplete
+            # is to drop the connection before the response is finished.
+            log.err(None, 'Export failed.')
+            request.transport.abortConnection()
+        finally:
+            request.unregisterProducer()
+
+    @inlineCallbacks
+    def _stream_shard(self, shard, request, producer, export_format,
+                      page_size, header):
+        conn = yield shard.read_engine.connect()
         try:
-            tables = ShortenerTables(self.config['account'], conn)
-            if not short_url:
-                request.setResponseCode(http.BAD_REQUEST)
-                returnValue({'error': 'expected "?url=<short_url>"'})
-            else:
-                row = yield tables.get_row_by_short_url(short_url[0], False)
-
-                if row:
-                    audit = yield tables.get_audit_row(row['id'])
-                    returnValue(self._format(row, audit))
+            tables = self.get_tables(conn)
+            after_id = None
+            while not producer.stopped:
+                rows = yield tables.get_rows_with_hits(after_id, page_size)
+                if export_format == 'csv':
+                    request.write(self._format_csv(rows, header=header))
                 else:
-                    request.setResponseCode(http.NOT_FOUND)
-                    returnValue({'error': 'short url not found'})
+                    request.write(self._format_ndjson(rows))
+                header = False
+                if len(rows) < page_size:
+                    break
+                after_id = rows[-1]['id']
+                yield producer.wait()
         finally:
             yield conn.close()
+        returnValue(header)
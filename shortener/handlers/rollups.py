@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web import http
+
+from shortener.handlers.base import BaseApiHandler
+from shortener.keygen import decode_token
+from shortener.models import MAX_ROW_ID, ROLLUP_RESOLUTIONS
+from shortener.sharding import shard_for_id
+from shortener.timing import get_request_timer
+
+DEFAULT_ROLLUP_BUCKETS = {
+    'minute': 60,
+    'hour': 24,
+}
+MAX_ROLLUP_BUCKETS = 1440
+
+
+class Rollups(BaseApiHandler):
+    """
+    Returns a short url's hits per minute or per hour, for the most recent
+    ``?buckets=`` minutes or hours, oldest first. Buckets without hits are
+    included with a count of 0. Hits are only counted once they've been
+    flushed, every ``hits_flush_interval`` seconds.
+    """
+
+    def _error(self, request, message, code=http.BAD_REQUEST):
+        request.setResponseCode(code)
+        return {'error': message}
+
+    def _buckets(self, resolution, count):
+        seconds = ROLLUP_RESOLUTIONS[resolution]
+        until = datetime.utcfromtimestamp(
+            int(self.clock.seconds()) // seconds * seconds)
+        step = timedelta(seconds=seconds)
+        return [until - step * i for i in xrange(count - 1, -1, -1)]
+
+    @inlineCallbacks
+    def _get_hits(self, conn, request, row_id, short_url, resolution,
+                  buckets):
+        tables = self.get_tables(conn, get_request_timer(request))
+        row = yield tables.get_row_by_id(row_id, short_url, increment=False)
+        if not row:
+            returnValue(None)
+        hits = yield tables.get_hit_rollups(
+            row_id, resolution, buckets[0], buckets[-1])
+        returnValue(hits)
+
+    @inlineCallbacks
+    def render(self, request):
+        short_url = request.args.get('url', [None])[0]
+        if not short_url:
+            returnValue(self._error(request, 'expected "?url=<short_url>"'))
+        resolution = request.args.get('resolution', ['hour'])[0]
+        if resolution not in ROLLUP_RESOLUTIONS:
+            returnValue(self._error(
+                request, 'resolution must be one of: %s' % (
+                    ', '.join(sorted(ROLLUP_RESOLUTIONS)),)))
+        try:
+            count = int(request.args.get(
+                'buckets', [DEFAULT_ROLLUP_BUCKETS[resolution]])[0])
+        except ValueError:
+            count = 0
+        if not 0 < count <= MAX_ROLLUP_BUCKETS:
+            returnValue(self._error(
+                request, 'buckets must be between 1 and %s' % (
+                    MAX_ROLLUP_BUCKETS,)))
+
+        try:
+            row_id = decode_token(short_url, max_counter=MAX_ROW_ID)
+        except ValueError:
+            returnValue(self._error(
+                request, 'short url not found', http.NOT_FOUND))
+
+        buckets = self._buckets(resolution, count)
+        shard = shard_for_id(self.shards, row_id)
+        hits = yield shard.read(
+            self._get_hits, request, row_id, short_url,
+            ROLLUP_RESOLUTIONS[resolution], buckets)
+        if hits is None:
+            returnValue(self._error(
+                request, 'short url not found', http.NOT_FOUND))
+
+        hits = dict(hits)
+        returnValue({
+            'short_url': short_url,
+            'resolution': resolution,
+            'buckets': [
+                {'start': bucket.isoformat(), 'hits': hits.get(bucket, 0)}
+                for bucket in buckets],
+        })
@@ -0,0 +1,137 @@
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+DEFAULT_BLOCK_SIZE = 1000
+DEFAULT_BLOCK_TTL = 60
+
+
+class IdAllocator(object):
+    """
+    Hands out url ids from blocks reserved in the database, so that a url's
+    id and short url are known before it is inserted.
+
+    ``reserve_ids(count)`` reserves ``count`` consecutive ids and returns
+    the first one, or ``None`` if the account's schema doesn't support
+    reserving ids yet, in which case :meth:`allocate` returns ``None`` too
+    and the database assigns ids as it inserts. That is checked again at
+    most once every ``block_ttl`` seconds.
+
+    Ids left in a block ``block_ttl`` seconds after it was reserved are
+    thrown away rather than used. Anything that needs to know which ids
+    may still be inserted, like :class:`shortener.bloom.ShortUrlFilter`,
+    can rely on that. So that a quiet process doesn't throw away most of
+    every block, blocks are halved each time ids expire unused, down to a
+    single id, and doubled again up to ``block_size`` each time one is used
+    up.
+    """
+
+    def __init__(self, clock, reserve_ids, block_size=DEFAULT_BLOCK_SIZE,
+                 block_ttl=DEFAULT_BLOCK_TTL):
+        self.clock = clock
+        self._reserve_ids = reserve_ids
+        self.block_size = block_size
+        self.block_ttl = block_ttl
+        # The number of ids to reserve next.
+        self._size = block_size
+        # [next id, end id, time reserved] for each range of ids left.
+        self._blocks = deque()
+        # (first id, end id, time reserved) for every block that hasn't
+        # expired yet, to tell how old released ids are.
+        self._recent_blocks = deque()
+        self._unsupported_until = None
+        self._reserving = None
+        self._waiting = []
+
+    def _expired(self, reserved_at):
+        return reserved_at + self.block_ttl <= self.clock.seconds()
+
+    def _expire(self):
+        blocks = deque(
+            block for block in self._blocks if not self._expired(block[2]))
+        if len(blocks) < len(self._blocks):
+            self._size = max(1, self._size // 2)
+        self._blocks = blocks
+        while (self._recent_blocks and
+               self._expired(self._recent_blocks[0][2])):
+            self._recent_blocks.popleft()
+
+    def _available(self):
+        return sum(end - start for start, end, _ in self._blocks)
+
+    def _take(self, count):
+        ids = []
+        while len(ids) < count:
+            block = self._blocks[0]
+            take = min(count - len(ids), block[1] - block[0])
+            ids.extend(xrange(block[0], block[0] + take))
+            block[0] += take
+            if block[0] == block[1]:
+                self._blocks.popleft()
+                self._size = min(self.block_size, self._size * 2)
+        return ids
+
+    def allocate(self, count=1):
+        """
+        Returns a Deferred that fires with a list of ``count`` unused ids,
+        or ``None`` if ids can't be reserved.
+        """
+        if (self._unsupported_until is not None and
+                self.clock.seconds() < self._unsupported_until):
+            return succeed(None)
+        self._expire()
+        if self._available() >= count:
+            return succeed(self._take(count))
+
+        d = Deferred()
+        self._waiting.append((count, d))
+        self._reserve()
+        return d
+
+    def _reserve(self):
+        if self._reserving is not None or not self._waiting:
+            return
+        needed = sum(count for count, _ in self._waiting) - self._available()
+        count = max(self._size, needed)
+        self._reserving = maybeDeferred(self._reserve_ids, count)
+        self._reserving.addCallbacks(
+            self._reserved, self._reserve_failed, callbackArgs=(count,))
+
+    def _reserved(self, start, count):
+        self._reserving = None
+        waiting, self._waiting = self._waiting, []
+        if start is None:
+            self._unsupported_until = self.clock.seconds() + self.block_ttl
+            for _, d in waiting:
+                d.callback(None)
+            return
+        self._unsupported_until = None
+        self._expire()
+        now = self.clock.seconds()
+        self._blocks.append([start, start + count, now])
+        self._recent_blocks.append((start, start + count, now))
+        for i, (count, d) in enumerate(waiting):
+            if self._available() < count:
+                # More ids were asked for while reserving, or some expired.
+                self._waiting = waiting[i:] + self._waiting
+                self._reserve()
+                return
+            d.callback(self._take(count))
+
+    def _reserve_failed(self, failure):
+        self._reserving = None
+        waiting, self._waiting = self._waiting, []
+        for _, d in waiting:
+            d.errback(failure)
+
+    def release(self, ids):
+        """
+        Returns allocated ids that weren't used. They're handed out again
+        before any others, until their block expires.
+        """
+        self._expire()
+        for row_id in sorted(ids, reverse=True):
+            for start, end, reserved_at in self._recent_blocks:
+                if start <= row_id < end:
+                    self._blocks.appendleft([row_id, row_id + 1, reserved_at])
+                    break
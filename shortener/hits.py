@@ -0,0 +1,162 @@
+from twisted.application.service import Service
+from twisted.internet.defer import gatherResults, maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_MAX_PENDING = 10000
+
+
+class UnwrittenHits(Exception):
+    """
+    Raised by a flush that only wrote some of the hits it was given, with
+    the ``counts`` it didn't write, so that only those are retried.
+    """
+
+    def __init__(self, counts):
+        Exception.__init__(
+            self, 'Failed to write hits for %s urls' % (len(counts),))
+        self.counts = counts
+
+
+class HitAggregator(Service):
+    """
+    Counts redirects per url id in memory and writes them out in batches.
+
+    ``flush_hits`` is called with a dict mapping url ids to the number of
+    hits seen since the last flush, every ``interval`` seconds while the
+    service is running and whenever more than ``max_pending`` distinct url
+    ids are waiting to be written. Hits from a failed flush are kept and
+    retried with the next one, or just the ones it raises
+    :class:`UnwrittenHits` with. Flushes for ``max_pending`` aren't started
+    while another flush is still running, or for ``interval`` seconds after
+    one fails, so that a database outage doesn't set off a failing flush
+    for every redirect, and a flush every ``interval`` is skipped while the
+    last one is still running. Stopping the service waits for running
+    flushes and then flushes whatever is left.
+
+    If ``flush_rollups`` is given, hits are also counted per minute, and it
+    is called alongside ``flush_hits`` with a dict mapping
+    ``(url_id, minute)`` to counts, where ``minute`` is the timestamp the
+    minute starts at. Hits are counted for the current minute only, which
+    is closed at every flush and, while the service is running, at the end
+    of each minute.
+    """
+
+    def __init__(self, clock, flush_hits, interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING, flush_rollups=None):
+        self.clock = clock
+        self._flush_hits = flush_hits
+        self._flush_rollups = flush_rollups
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.pending_rollups = {}
+        self._minute = self._current_minute()
+        self._minute_hits = {}
+        self._flushing = set()
+        self._failed_at = None
+        self._loop = None
+        self._minute_call = None
+
+    def record_hit(self, url_id, count=1):
+        self.pending[url_id] = self.pending.get(url_id, 0) + count
+        if self._flush_rollups is not None:
+            self._minute_hits[url_id] = (
+                self._minute_hits.get(url_id, 0) + count)
+        if (len(self.pending) >= self.max_pending and not self._flushing and
+                not self._backing_off()):
+            self.flush()
+
+    def _backing_off(self):
+        return (self._failed_at is not None and
+                self.clock.seconds() < self._failed_at + self.interval)
+
+    def _current_minute(self):
+        return int(self.clock.seconds()) // 60 * 60
+
+    def _close_minute(self):
+        for url_id, count in self._minute_hits.iteritems():
+            key = (url_id, self._minute)
+            self.pending_rollups[key] = (
+                self.pending_rollups.get(key, 0) + count)
+        self._minute_hits = {}
+        self._minute = self._current_minute()
+
+    def _minute_ended(self):
+        self._close_minute()
+        self._schedule_minute_end()
+
+    def _schedule_minute_end(self):
+        self._minute_call = self.clock.callLater(
+            self._current_minute() + 60 - self.clock.seconds(),
+            self._minute_ended)
+
+    def _written(self, result):
+        self._failed_at = None
+
+    def _requeue(self, failure, counts, attr):
+        log.err(failure, 'Failed to flush hits, retrying with next flush.')
+        self._failed_at = self.clock.seconds()
+        if failure.check(UnwrittenHits):
+            counts = failure.value.counts
+        pending = getattr(self, attr)
+        for key, count in counts.iteritems():
+            pending[key] = pending.get(key, 0) + count
+
+    def _write(self, write, attr):
+        counts = getattr(self, attr)
+        if not counts:
+            return succeed(None)
+        setattr(self, attr, {})
+        d = maybeDeferred(write, counts)
+        return d.addCallbacks(
+            self._written, self._requeue, errbackArgs=(counts, attr))
+
+    def flush(self):
+        """
+        Write out all pending hits. Returns a Deferred that fires once the
+        write has completed.
+        """
+        if self._flush_rollups is not None:
+            self._close_minute()
+        if not (self.pending or self.pending_rollups):
+            return succeed(None)
+
+        ds = [self._write(self._flush_hits, 'pending')]
+        if self._flush_rollups is not None:
+            ds.append(self._write(self._flush_rollups, 'pending_rollups'))
+        d = gatherResults(ds)
+        self._flushing.add(d)
+
+        def done(result):
+            self._flushing.discard(d)
+            return None
+        return d.addBoth(done)
+
+    def _flush_loop(self):
+        # Errors are dealt with in flush(), so the loop never stops. A flush
+        # still running from the last interval is left to finish first, so
+        # that two flushes never update the same rows at once.
+        if not self._flushing:
+            self.flush()
+
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self._flush_loop)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+        if self._flush_rollups is not None:
+            self._close_minute()
+            self._schedule_minute_end()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self._minute_call is not None and self._minute_call.active():
+            self._minute_call.cancel()
+        self._minute_call = None
+        d = gatherResults(list(self._flushing))
+        return d.addCallback(lambda _: self.flush())
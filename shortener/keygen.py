@@ -1,9 +1,17 @@
+import numbers
 import random
 import string
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEFAULT_ALPHABET = string.digits + string.ascii_letters
 SHORT_URL_OFFSET = 4000
 SHUFFLE_SEED = 1234
+# Digit permutations for tokens up to this length are computed at import.
+PRECOMPUTED_TOKEN_LENGTH = 12
 
 
 def shuffle(items):
@@ -23,15 +31,55 @@ def shuffle(items):
     return random.Random(SHUFFLE_SEED).sample(items, len(items))
 
 
+_alphabets = {}
+_permutations = {}
+
+
+def _shuffled_alphabet(alphabet):
+    """
+    Returns the shuffled alphabet and a map of characters to digit values.
+    """
+    try:
+        return _alphabets[alphabet]
+    except KeyError:
+        shuffled = shuffle(alphabet)
+        values = dict((char, i) for i, char in enumerate(shuffled))
+        _alphabets[alphabet] = (shuffled, values)
+        return shuffled, values
+
+
+def _permutation(length):
+    """
+    Returns the positions :func:`shuffle` takes the digits of a token of the
+    given length from. :meth:`random.Random.sample` picks positions without
+    looking at the values, so this is the same for every token of a length.
+
+    Only lengths up to ``PRECOMPUTED_TOKEN_LENGTH`` are cached, so that odd
+    token lengths can't grow the cache without bound.
+    """
+    try:
+        return _permutations[length]
+    except KeyError:
+        permutation = shuffle(range(length))
+        if length <= PRECOMPUTED_TOKEN_LENGTH:
+            _permutations[length] = permutation
+        return permutation
+
+
+_shuffled_alphabet(DEFAULT_ALPHABET)
+for _length in range(PRECOMPUTED_TOKEN_LENGTH + 1):
+    _permutation(_length)
+
+
 def generate_token(counter, alphabet=DEFAULT_ALPHABET):
     """
     Generates a short url token using the given counter from the alphabet
     min_length: 3 (using SHORT_URL_OFFSET)
     """
-    if not isinstance(counter, int):
+    if not isinstance(counter, numbers.Integral):
         raise TypeError('an integer is required')
 
-    alphabet = shuffle(alphabet)
+    alphabet, _ = _shuffled_alphabet(alphabet)
     base = len(alphabet)
     counter += SHORT_URL_OFFSET
 
@@ -40,4 +88,92 @@ def generate_token(counter, alphabet=DEFAULT_ALPHABET):
         digits.append(alphabet[counter % base])
         counter = counter // base
 
-    return ''.join(shuffle(digits))
+    return ''.join([digits[i] for i in _permutation(len(digits))])
+
+
+def generate_tokens(start, count, alphabet=DEFAULT_ALPHABET):
+    """
+    Generates the tokens for ``count`` consecutive counters beginning at
+    ``start``, the same as calling :func:`generate_token` for each of them.
+
+    The encoding is vectorised with NumPy when it is installed.
+    """
+    if not isinstance(start, numbers.Integral):
+        raise TypeError('an integer is required')
+    if count <= 0:
+        return []
+    if numpy is None or start + count + SHORT_URL_OFFSET >= 2 ** 62:
+        return [generate_token(counter, alphabet)
+                for counter in xrange(start, start + count)]
+    return _generate_tokens_numpy(start, count, alphabet)
+
+
+def _generate_tokens_numpy(start, count, alphabet):
+    shuffled, _ = _shuffled_alphabet(alphabet)
+    base = len(shuffled)
+    chars = numpy.array(shuffled, dtype='S1')
+    values = numpy.arange(
+        start + SHORT_URL_OFFSET, start + count + SHORT_URL_OFFSET,
+        dtype=numpy.int64)
+
+    # digits[:, i] is the i-th least significant digit of each value.
+    digits = []
+    remaining = values
+    while remaining.any():
+        digits.append(remaining % base)
+        remaining = remaining // base
+    digits = numpy.column_stack(digits)
+    lengths = numpy.zeros(count, dtype=numpy.int64)
+    threshold = 1
+    for length in range(1, digits.shape[1] + 1):
+        lengths[values >= threshold] = length
+        threshold *= base
+
+    tokens = numpy.empty(count, dtype=object)
+    for length in numpy.unique(lengths):
+        rows = lengths == length
+        token_chars = chars[digits[rows][:, _permutation(int(length))]]
+        tokens[rows] = numpy.ascontiguousarray(token_chars).view(
+            'S%d' % (length,)).ravel()
+    return [str(token) for token in tokens]
+
+
+def decode_token(token, alphabet=DEFAULT_ALPHABET, max_counter=None):
+    """
+    Reverses :func:`generate_token`, returning the counter the token was
+    generated from.
+
+    The digit shuffle applied by :func:`generate_token` only depends on the
+    length of the token, so it can be undone by shuffling the digit positions
+    the same way.
+
+    Raises :class:`ValueError` for tokens that :func:`generate_token` could
+    not have produced, or whose counter is larger than ``max_counter``.
+    Tokens longer than the token for ``max_counter`` are rejected before
+    any decoding is done.
+    """
+    if (max_counter is not None and
+            len(token) > len(generate_token(max_counter, alphabet))):
+        raise ValueError('token out of range: %r' % (token[:32],))
+
+    shuffled_alphabet, values = _shuffled_alphabet(alphabet)
+    base = len(shuffled_alphabet)
+
+    digits = [None] * len(token)
+    for char, position in zip(token, _permutation(len(token))):
+        digits[position] = char
+
+    counter = 0
+    for digit in reversed(digits):
+        if digit not in values:
+            raise ValueError('invalid token: %r' % (token,))
+        counter = counter * base + values[digit]
+    counter -= SHORT_URL_OFFSET
+
+    if counter < 0 or (max_counter is not None and counter > max_counter):
+        raise ValueError('token out of range: %r' % (token,))
+    # Tokens never start with a zero digit, so there's exactly one valid
+    # encoding per counter.
+    if generate_token(counter, alphabet) != token:
+        raise ValueError('invalid token: %r' % (token,))
+    return int(counter)
@@ -1,39 +1,120 @@
+import copy
+import cPickle as pickle
+import random
+import struct
 import time
+from collections import deque
 from urlparse import urlparse
 
+from twisted.application.service import Service
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import ClientFactory, Protocol
 from twisted.internet.endpoints import clientFromString
+from twisted.internet.task import LoopingCall
 
 from shortener.reconnecting_client import ReconnectingClientService
 
+# Number of samples kept per timer per flush interval for percentiles.
+MAX_TIMER_SAMPLES = 1024
+TIMER_PERCENTILES = (50, 95, 99)
+
+DEFAULT_MAX_QUEUE_SIZE = 100000
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+# Metrics per pickle message, carbon's receiver limits message size.
+PICKLE_BATCH_SIZE = 500
+
 
 class CarbonClientProtocol(Protocol):
+    def format_metrics(self, metrics):
+        return ''.join(
+            "%s %s %s\n" % (name, value, timestamp)
+            for name, value, timestamp in metrics)
+
     def publish_metric(self, name, value, timestamp):
-        self.transport.write("%s %s %s\n" % (name, value, timestamp))
+        self.publish_metrics([(name, value, timestamp)])
+
+    def publish_metrics(self, metrics):
+        self.transport.write(self.format_metrics(metrics))
+
+
+class CarbonPickleProtocol(CarbonClientProtocol):
+    """
+    Speaks carbon's pickle protocol: length-prefixed pickled lists of
+    ``(name, (timestamp, value))`` tuples.
+    """
+
+    def format_metrics(self, metrics):
+        messages = []
+        for i in xrange(0, len(metrics), PICKLE_BATCH_SIZE):
+            payload = pickle.dumps([
+                (name, (timestamp, value))
+                for name, value, timestamp in metrics[i:i + PICKLE_BATCH_SIZE]
+            ], protocol=2)
+            messages.append(struct.pack('!L', len(payload)) + payload)
+        return ''.join(messages)
 
 
 class CarbonClientFactory(ClientFactory):
     protocol = CarbonClientProtocol
 
 
+class CarbonPickleClientFactory(ClientFactory):
+    protocol = CarbonPickleProtocol
+
+
 class CarbonClientService(ReconnectingClientService):
-    def __init__(self, endpoint):
-        factory = CarbonClientFactory()
+    """
+    Sends metrics to carbon, queueing them while disconnected.
+
+    The queue holds at most ``max_queue_size`` metrics, which must be at
+    least 1. Once it is full either the oldest queued metric or the new one
+    is dropped, depending on ``drop_policy``, and :attr:`dropped` is
+    incremented. Queued metrics are sent in a single write when the
+    connection is (re)established.
+    """
+
+    def __init__(self, endpoint, max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 drop_policy=DROP_OLDEST, use_pickle=False):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError('Unknown drop policy: %r' % (drop_policy,))
+        if max_queue_size < 1:
+            raise ValueError(
+                'max_queue_size must be at least 1, not %r' % (
+                    max_queue_size,))
+        if use_pickle:
+            factory = CarbonPickleClientFactory()
+        else:
+            factory = CarbonClientFactory()
         ReconnectingClientService.__init__(self, endpoint, factory)
-        self._metrics_queue = []
+        self.max_queue_size = max_queue_size
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self._metrics_queue = deque()
         self.protocol_instance = None
         self.connect_d = Deferred()
 
+    def _enqueue(self, metric):
+        if len(self._metrics_queue) >= self.max_queue_size:
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return
+            self._metrics_queue.popleft()
+        self._metrics_queue.append(metric)
+
     def publish_metric(self, name, value, timestamp):
-        self._metrics_queue.append((name, value, timestamp))
+        self.publish_metrics([(name, value, timestamp)])
+
+    def publish_metrics(self, metrics):
+        for metric in metrics:
+            self._enqueue(metric)
         self._process_queue()
 
     def _process_queue(self):
-        if self.protocol_instance is not None:
-            while self._metrics_queue:
-                name, value, timestamp = self._metrics_queue.pop(0)
-                self.protocol_instance.publish_metric(name, value, timestamp)
+        if self.protocol_instance is not None and self._metrics_queue:
+            metrics = list(self._metrics_queue)
+            self._metrics_queue.clear()
+            self.protocol_instance.publish_metrics(metrics)
 
     def clientConnected(self, protocol):
         self.protocol_instance = protocol
@@ -48,13 +129,134 @@ class CarbonClientService(ReconnectingClientService):
         ReconnectingClientService.clientConnectionLost(self, reason)
 
 
+class Timer(object):
+    """
+    Latency samples for one metric over one flush interval.
+
+    Count, sum, min and max are exact. Percentiles are calculated from a
+    uniform reservoir sample of at most ``max_samples`` values.
+    """
+
+    def __init__(self, max_samples=MAX_TIMER_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def record(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < self.max_samples:
+                self.samples[i] = value
+
+    def merge(self, values):
+        """
+        Adds the values recorded by another timer, as returned by its
+        :meth:`to_dict`. Each timer's samples are kept in proportion to the
+        number of values it recorded.
+        """
+        count, samples = values['count'], values['samples']
+        if not count:
+            return
+        total = self.count + count
+        if len(self.samples) + len(samples) > self.max_samples:
+            keep = int(round(self.max_samples * float(self.count) / total))
+            keep = min(keep, len(self.samples))
+            self.samples = (
+                random.sample(self.samples, keep) +
+                random.sample(
+                    samples, min(self.max_samples - keep, len(samples))))
+        else:
+            self.samples.extend(samples)
+        self.count = total
+        self.sum += values['sum']
+        if self.min is None or values['min'] < self.min:
+            self.min = values['min']
+        if self.max is None or values['max'] > self.max:
+            self.max = values['max']
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'samples': self.samples,
+        }
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        # Nearest-rank percentile.
+        rank = max(int(round(percent / 100.0 * len(samples))), 1)
+        return samples[rank - 1]
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+        }
+        for percent in TIMER_PERCENTILES:
+            summary['p%s' % (percent,)] = self.percentile(percent)
+        return summary
+
+
 class ShortenerMetrics(object):
+    """
+    Publishes the service's metrics to carbon.
+
+    When ``metrics_interval`` is configured, counters, gauges and timers are
+    aggregated in memory and published once per interval by
+    :meth:`flush`, which :class:`MetricsFlushService` calls periodically.
+    Gauges publish the last value they were set to. Otherwise every update
+    is sent to carbon as it happens. Timer values are given in seconds and
+    published in milliseconds.
+    """
+
     def __init__(self, reactor, config):
         self.config = config
         self.domain = urlparse(config['host_domain']).netloc.replace('.', '')
+        self.flush_interval = config.get('metrics_interval')
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+
+        self._reported_drops = 0
 
         endpoint = clientFromString(reactor, config['graphite_endpoint'])
-        self.carbon_client = CarbonClientService(endpoint)
+        self.carbon_client = CarbonClientService(
+            endpoint,
+            max_queue_size=config.get(
+                'graphite_max_queue_size', DEFAULT_MAX_QUEUE_SIZE),
+            drop_policy=config.get('graphite_drop_policy', DROP_OLDEST),
+            use_pickle=config.get('graphite_protocol') == 'pickle')
+
+    def for_account(self, config):
+        """
+        Returns metrics for another account, named after its own
+        ``account`` and ``host_domain``, that are aggregated and published
+        along with these.
+        """
+        metrics = copy.copy(self)
+        metrics.config = config
+        metrics.domain = urlparse(
+            config['host_domain']).netloc.replace('.', '')
+        return metrics
+
+    @property
+    def aggregating(self):
+        return bool(self.flush_interval)
 
     def get_metric_name(self, metric):
         return '%(account)s.%(domain)s.%(metric)s' % {
@@ -63,14 +265,127 @@ class ShortenerMetrics(object):
             'metric': metric,
         }
 
-    def publish_created_url_metrics(self):
-        metric = self.get_metric_name('created.count')
-        return self.carbon_client.publish_metric(metric, 1, time.time())
+    def increment(self, metric, count=1):
+        name = self.get_metric_name(metric)
+        if not self.aggregating:
+            return self.carbon_client.publish_metric(name, count, time.time())
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def timing(self, metric, seconds):
+        name = self.get_metric_name(metric)
+        if not self.aggregating:
+            return self.carbon_client.publish_metric(
+                name, seconds * 1000, time.time())
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        timer.record(seconds * 1000)
+
+    def gauge(self, metric, value):
+        name = self.get_metric_name(metric)
+        if not self.aggregating:
+            return self.carbon_client.publish_metric(name, value, time.time())
+        self.gauges[name] = value
+
+    def _reset(self):
+        # Cleared in place, they're shared with for_account() copies.
+        counters, gauges, timers = (
+            dict(self.counters), dict(self.gauges), dict(self.timers))
+        self.counters.clear()
+        self.gauges.clear()
+        self.timers.clear()
+        return counters, gauges, timers
+
+    def snapshot(self):
+        """
+        Returns and resets everything aggregated since the last flush
+        without publishing it, as a JSON serialisable dict for
+        :meth:`merge`.
+        """
+        counters, gauges, timers = self._reset()
+        return {
+            'counters': counters,
+            'gauges': gauges,
+            'timers': dict(
+                (name, timer.to_dict()) for name, timer in timers.items()),
+        }
+
+    def merge(self, snapshot):
+        """
+        Adds a :meth:`snapshot` taken from another instance, usually in
+        another process, to what will be published by the next flush.
+        Counters are added up and gauges take the last value merged.
+        """
+        # Names decoded from JSON are unicode, carbon wants bytes.
+        for name, value in snapshot['counters'].items():
+            name = str(name)
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, value in snapshot['gauges'].items():
+            self.gauges[str(name)] = value
+        for name, values in snapshot['timers'].items():
+            name = str(name)
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer()
+            timer.merge(values)
+
+    def flush(self):
+        """
+        Publish and reset everything aggregated since the last flush.
+        """
+        counters, gauges, timers = self._reset()
+        timestamp = time.time()
+
+        dropped = self.carbon_client.dropped - self._reported_drops
+        if dropped:
+            self._reported_drops += dropped
+            name = self.get_metric_name('carbon.dropped')
+            counters[name] = counters.get(name, 0) + dropped
+
+        metrics = []
+        for name, value in sorted(counters.items()):
+            metrics.append((name, value, timestamp))
+        for name, value in sorted(gauges.items()):
+            metrics.append((name, value, timestamp))
+        for name, timer in sorted(timers.items()):
+            for stat, value in sorted(timer.summary().items()):
+                metrics.append(('%s.%s' % (name, stat), value, timestamp))
+        if metrics:
+            self.carbon_client.publish_metrics(metrics)
+
+    def publish_created_url_metrics(self, count=1):
+        return self.increment('created.count', count)
+
+    def publish_expanded_url_metrics(self, count=1):
+        return self.increment('expanded.count', count)
+
+    def publish_invalid_url_metrics(self, count=1):
+        return self.increment('invalid.count', count)
+
+    def publish_bloom_fill_ratio(self, fill_ratio):
+        return self.gauge('bloom.fill_ratio', fill_ratio)
+
+
+class MetricsFlushService(Service):
+    """
+    Flushes aggregated metrics every ``metrics.flush_interval`` seconds and
+    once more when stopped.
+    """
+
+    def __init__(self, clock, metrics):
+        self.clock = clock
+        self.metrics = metrics
+        self._loop = None
 
-    def publish_expanded_url_metrics(self):
-        metric = self.get_metric_name('expanded.count')
-        return self.carbon_client.publish_metric(metric, 1, time.time())
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self.metrics.flush)
+        self._loop.clock = self.clock
+        self._loop.start(self.metrics.flush_interval, now=False)
 
-    def publish_invalid_url_metrics(self):
-        metric = self.get_metric_name('invalid.count')
-        return self.carbon_client.publish_metric(metric, 1, time.time())
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.metrics.flush()
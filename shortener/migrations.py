@@ -0,0 +1,104 @@
+"""
+Schema migrations for existing accounts.
+
+An account's schema version is kept in its aludel collection metadata.
+Accounts created before versioning have no version, which counts as 0.
+:meth:`shortener.models.ShortenerTables.create_tables` creates new accounts
+at :data:`SCHEMA_VERSION`, and :func:`migrate` brings older ones up to it.
+
+Each migration is a ``(version, description, function)`` tuple. The function
+is called with the account's :class:`shortener.models.ShortenerTables` and
+should be safe to run again if it was interrupted part way through.
+"""
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+
+SCHEMA_VERSION_KEY = 'schema_version'
+
+# Processes that haven't noticed the url id counter yet keep inserting with
+# ids assigned by the database for up to ``id_block_ttl`` seconds after it's
+# created, so reserved ids start this far past the largest existing one.
+ID_COUNTER_GAP = 1000000
+
+
+@inlineCallbacks
+def create_indexes(tables):
+    # Tables created before this version have no indexes at all, because
+    # aludel doesn't create them with the table. They may also have
+    # duplicate urls, which the unique index can't be built over.
+    cleared = yield tables.clear_duplicate_hashes()
+    if cleared:
+        log.msg('Cleared the hashes of %s duplicate urls in %s.' % (
+            cleared, tables.name))
+    for index in tables.indexes():
+        yield tables.create_index(index, concurrently=True)
+
+
+@inlineCallbacks
+def create_id_counter(tables):
+    # aludel only creates the tables that don't exist yet.
+    yield tables._create_tables()
+    max_id = yield tables.get_max_id()
+    yield tables.create_id_counter(max_id + ID_COUNTER_GAP)
+
+
+@inlineCallbacks
+def create_hit_rollups(tables):
+    yield tables._create_tables()
+
+
+@inlineCallbacks
+def advance_id_counter(tables):
+    # Accounts served by processes that didn't reserve ids had them
+    # assigned by the database instead, without moving the counter.
+    max_id = yield tables.get_max_id()
+    counter = yield tables.get_id_counter()
+    if max_id > counter:
+        yield tables.set_id_counter(max_id + ID_COUNTER_GAP)
+
+
+MIGRATIONS = [
+    (1, 'Create indexes, including unique (domain, user_token, hash) '
+        'and audit.url_id', create_indexes),
+    (2, 'Create the counters table to reserve url ids from',
+        create_id_counter),
+    (3, 'Create the hit_rollups table for hits per minute and hour',
+        create_hit_rollups),
+    (4, 'Move the url id counter past ids assigned by the database',
+        advance_id_counter),
+]
+
+# Accounts at this version or later can have url ids reserved in blocks.
+ID_COUNTER_VERSION = 2
+
+# Accounts at this version or later have hits rolled up by time.
+HIT_ROLLUPS_VERSION = 3
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+@inlineCallbacks
+def get_schema_version(tables):
+    metadata = yield tables.get_metadata()
+    returnValue(metadata.get(SCHEMA_VERSION_KEY, 0))
+
+
+@inlineCallbacks
+def migrate(tables):
+    """
+    Applies every migration newer than the account's schema version, in
+    order, recording the new version after each one.
+
+    Returns ``(from_version, to_version)``.
+    """
+    metadata = yield tables.get_metadata()
+    from_version = version = metadata.get(SCHEMA_VERSION_KEY, 0)
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        log.msg('Migrating %s to schema version %s: %s' % (
+            tables.name, migration_version, description))
+        yield migration(tables)
+        version = metadata[SCHEMA_VERSION_KEY] = migration_version
+        yield tables.set_metadata(metadata)
+    returnValue((from_version, version))
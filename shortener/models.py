@@ -1,12 +1,81 @@
+import copy
 import hashlib
+import time
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, Text, DateTime
-from sqlalchemy.sql import and_
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql import and_, bindparam, case, func, select, text
+from sqlalchemy.sql.elements import _truncated_label
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python.failure import Failure
 
 from aludel.database import TableCollection, make_table, CollectionMissingError
 
+from shortener.keygen import generate_token, generate_tokens
+from shortener.migrations import SCHEMA_VERSION, SCHEMA_VERSION_KEY
+
+
+# urls.id is a 32-bit signed integer column.
+MAX_ROW_ID = 2 ** 31 - 1
+
+# Name of the counters row that url ids are reserved from.
+URL_ID_COUNTER = 'urls.id'
+# Name of the counters row holding the highest id known to have settled.
+SETTLED_ID_COUNTER = 'urls.id.settled'
+
+# Bucket lengths, in seconds, that hits are rolled up into.
+ROLLUP_RESOLUTIONS = {
+    'minute': 60,
+    'hour': 3600,
+}
+
+
+# Upper bound on bind parameters per statement. SQLite builds before 3.32
+# refuse statements with more than 999.
+MAX_BIND_PARAMS = {
+    'sqlite': 999,
+}
+DEFAULT_MAX_BIND_PARAMS = 32767
+
+
+INDEX_EXISTS_ERR_TEMPLATES = (
+    # SQLite
+    'index %(name)s already exists',
+    # PostgreSQL
+    'relation "%(name)s" already exists',
+)
+
+
+def index_name(index, dialect):
+    """
+    Returns the name ``index`` is created with on ``dialect``. Like
+    SQLAlchemy's DDL compiler, automatically generated names that are too
+    long for the dialect are truncated and given a hash suffix.
+    """
+    name = index.name
+    max_length = (
+        dialect.max_index_name_length or dialect.max_identifier_length)
+    if isinstance(name, _truncated_label) and len(name) > max_length:
+        name = '%s_%s' % (
+            name[:max_length - 8], hashlib.md5(name).hexdigest()[-4:])
+    return name
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _case(column, values):
+    """
+    Returns a CASE expression that maps each value of ``column`` in the
+    ``(key, value)`` pairs ``values`` to its value, for updating many rows
+    to different values in one statement.
+    """
+    return case(dict(values), value=column)
+
 
 class ShortenerDBError(Exception):
     pass
@@ -29,10 +98,242 @@ class ShortenerTables(TableCollection):
 
     audit = make_table(
         Column("id", Integer(), primary_key=True),
-        Column('url_id', Integer(), nullable=False),
+        Column('url_id', Integer(), nullable=False, index=True),
         Column("hits", Integer()),
     )
 
+    counters = make_table(
+        Column("name", String(255), primary_key=True),
+        Column("value", Integer(), nullable=False),
+    )
+
+    hit_rollups = make_table(
+        Column("url_id", Integer(), primary_key=True, autoincrement=False),
+        Column("resolution", Integer(), primary_key=True,
+               autoincrement=False),
+        Column("bucket", DateTime(timezone=False), primary_key=True),
+        Column("hits", Integer(), nullable=False),
+    )
+
+    def __init__(self, name, connection, collection_metadata=None,
+                 query_timer=None):
+        super(ShortenerTables, self).__init__(
+            name, connection, collection_metadata)
+        self.query_timer = query_timer
+        # Table names include the account name, so this is kept short enough
+        # for PostgreSQL's 63 character limit on identifiers.
+        Index('ix_%s_dut_hash' % (
+                  hashlib.md5(self.urls.name).hexdigest()[:12],),
+              self.urls.c.domain, self.urls.c.user_token, self.urls.c.hash,
+              unique=True)
+
+    def with_connection(self, connection, query_timer=None):
+        '''
+        Returns a copy of these tables that uses ``connection``.
+
+        The copy shares the table definitions and the cached existence
+        check, so it's much cheaper than building a new collection. Only
+        collections known to exist stay cached, others are checked again.
+        '''
+        collection_metadata = copy.copy(self._collection_metadata)
+        collection_metadata._conn = connection
+        # Make sure every copy shares the same cache.
+        cache = self._collection_metadata._existence_cache
+        collection_metadata._existence_cache_dict = cache
+        for name in [name for name, exists in cache.items() if not exists]:
+            del cache[name]
+
+        tables = copy.copy(self)
+        tables._conn = connection
+        tables._collection_metadata = collection_metadata
+        tables.query_timer = query_timer
+        return tables
+
+    def indexes(self):
+        return sorted(
+            (index for table in self._metadata.sorted_tables
+             for index in table.indexes),
+            key=lambda index: index.name)
+
+    @inlineCallbacks
+    def create_index(self, index, concurrently=False):
+        '''
+        Creates ``index`` unless it already exists.
+
+        With ``concurrently`` the index is built on PostgreSQL without
+        locking out writes to the table, outside of any transaction. This
+        needs a :class:`shortener.database.PooledConnection`.
+        '''
+        dialect = self._conn._engine.dialect
+        postgresql = dialect.name == 'postgresql'
+        statement = CreateIndex(index)
+        if concurrently and postgresql:
+            # Rather than setting the index's postgresql_concurrently
+            # option, which every copy of the tables shares.
+            statement = str(statement.compile(dialect=dialect)).replace(
+                ' INDEX ', ' INDEX CONCURRENTLY ', 1)
+            execute = self._conn.execute_autocommit
+        else:
+            execute = self._conn.execute
+        name = index_name(index, dialect)
+        try:
+            yield execute(statement)
+        except Exception as e:
+            # Like aludel's tables, indexes are created if they don't exist
+            # by ignoring the error if they do.
+            for err_template in INDEX_EXISTS_ERR_TEMPLATES:
+                if err_template % {'name': name} in str(e):
+                    break
+            else:
+                failure = Failure()
+                if postgresql:
+                    # A concurrent build that fails part way, on duplicate
+                    # rows for example, leaves an invalid index behind.
+                    yield self._drop_invalid_index(name, execute)
+                failure.raiseException()
+            if postgresql:
+                dropped = yield self._drop_invalid_index(name, execute)
+                if dropped:
+                    yield execute(statement)
+
+    @inlineCallbacks
+    def _drop_invalid_index(self, name, execute):
+        '''
+        Drops the PostgreSQL index ``name`` if it exists but isn't valid,
+        returning whether it did.
+        '''
+        result = yield self._conn.execute(text(
+            'SELECT i.indisvalid FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name').bindparams(name=name))
+        valid = yield result.scalar()
+        if valid is None or valid:
+            returnValue(False)
+        preparer = self._conn._engine.dialect.identifier_preparer
+        yield execute('DROP INDEX %s' % (preparer.quote(name),))
+        returnValue(True)
+
+    @inlineCallbacks
+    def clear_duplicate_hashes(self):
+        '''
+        Clears the hash of every url but the first with the same
+        ``(domain, user_token, hash)``, so that the unique index on them can
+        be built. The urls and their short urls are kept, but only the first
+        is found when the long url is shortened again.
+        '''
+        first_ids = select([func.min(self.urls.c.id)]).group_by(
+            self.urls.c.domain, self.urls.c.user_token, self.urls.c.hash)
+        result = yield self.execute_query(
+            self.urls.update().where(and_(
+                self.urls.c.hash.isnot(None),
+                ~self.urls.c.id.in_(first_ids),
+            )).values(hash=None))
+        returnValue(result.rowcount)
+
+    @inlineCallbacks
+    def create_tables(self, metadata=None):
+        '''
+        Creates the tables and their indexes, at the latest schema version.
+        '''
+        metadata = dict(metadata or {})
+        metadata[SCHEMA_VERSION_KEY] = SCHEMA_VERSION
+        yield super(ShortenerTables, self).create_tables(metadata)
+        # aludel only creates the tables themselves.
+        for index in self.indexes():
+            yield self.create_index(index)
+        yield self.create_id_counter(0)
+
+    @inlineCallbacks
+    def create_id_counter(self, value):
+        '''
+        Creates the url id counter, starting at ``value``, unless it already
+        exists.
+        '''
+        current = yield self.get_id_counter()
+        if current is None:
+            yield self.execute_query(self.counters.insert().values(
+                name=URL_ID_COUNTER, value=value))
+
+    def set_id_counter(self, value):
+        '''
+        Moves the url id counter on to ``value``, if it's behind it.
+        '''
+        return self.execute_query(self.counters.update().where(and_(
+            self.counters.c.name == URL_ID_COUNTER,
+            self.counters.c.value < value,
+        )).values(value=value))
+
+    def get_id_counter(self):
+        '''
+        Returns the last url id reserved, or ``None`` if there's no counter.
+        '''
+        return self._get_counter(URL_ID_COUNTER)
+
+    def get_settled_id(self):
+        '''
+        Returns the highest url id below which every url has been inserted,
+        or ``None`` if none has been recorded yet.
+        '''
+        return self._get_counter(SETTLED_ID_COUNTER)
+
+    @inlineCallbacks
+    def set_settled_id(self, value):
+        '''
+        Records that every url up to ``value`` has been inserted, unless a
+        higher id has been recorded already.
+        '''
+        current = yield self.get_settled_id()
+        if current is None:
+            try:
+                yield self.execute_query(self.counters.insert().values(
+                    name=SETTLED_ID_COUNTER, value=value))
+                return
+            except IntegrityError:
+                # Another process recorded one first.
+                pass
+        yield self.execute_query(self.counters.update().where(and_(
+            self.counters.c.name == SETTLED_ID_COUNTER,
+            self.counters.c.value < value,
+        )).values(value=value))
+
+    @inlineCallbacks
+    def _get_counter(self, name):
+        result = yield self.execute_query(
+            select([self.counters.c.value]).where(
+                self.counters.c.name == name))
+        value = yield result.scalar()
+        returnValue(value)
+
+    @inlineCallbacks
+    def get_max_id(self):
+        result = yield self.execute_query(select([func.max(self.urls.c.id)]))
+        max_id = yield result.scalar()
+        returnValue(max_id or 0)
+
+    @inlineCallbacks
+    def reserve_ids(self, count):
+        '''
+        Reserves ``count`` consecutive url ids that nothing else will be
+        given, in a transaction of its own, and returns the first one.
+        '''
+        trx = yield self._conn.begin()
+        try:
+            result = yield self.execute_query(
+                self.counters.update().where(
+                    self.counters.c.name == URL_ID_COUNTER
+                ).values(value=self.counters.c.value + count))
+            if result.rowcount != 1:
+                raise ShortenerDBError('No url id counter')
+            last_id = yield self.get_id_counter()
+            if last_id > MAX_ROW_ID:
+                raise ShortenerDBError('Out of url ids')
+            yield trx.commit()
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+        returnValue(last_id - count + 1)
+
     def _format_row(self, row, fields=None):
         if row is None:
             return None
@@ -43,24 +344,46 @@ class ShortenerTables(TableCollection):
 
     @inlineCallbacks
     def execute_query(self, query, *args, **kw):
+        '''
+        Runs ``query``, passing it to :attr:`query_timer`'s
+        ``record_query(query, result, elapsed)`` afterwards if there is one.
+        '''
+        started = time.time()
         try:
             result = yield super(ShortenerTables, self).execute_query(
                 query, *args, **kw)
         except CollectionMissingError:
             raise NoShortenerTables(self.name)
+        if self.query_timer is not None:
+            self.query_timer.record_query(
+                query, result, time.time() - started)
         returnValue(result)
 
-    @inlineCallbacks
-    def get_or_create_row(self, domain, user_token, long_url):
-        hashkey = hashlib.md5(''.join([
+    def hash_url(self, domain, user_token, long_url):
+        return hashlib.md5(''.join([
             domain, user_token, long_url
         ])).hexdigest()
+
+    def _inserted_id(self, result):
+        # alchimia doesn't proxy inserted_primary_key. SQLAlchemy fills it in
+        # from RETURNING on dialects that support it (PostgreSQL) and from
+        # the cursor's lastrowid otherwise (SQLite), so there's no extra
+        # round trip involved.
+        [row_id] = result._result_proxy.inserted_primary_key
+        return row_id
+
+    def _select_by_hash(self, domain, user_token, hashkey):
+        return self.urls.select().where(and_(
+            self.urls.c.domain == domain,
+            self.urls.c.user_token == user_token,
+            self.urls.c.hash == hashkey
+        )).limit(1)
+
+    @inlineCallbacks
+    def get_or_create_row(self, domain, user_token, long_url):
+        hashkey = self.hash_url(domain, user_token, long_url)
         result = yield self.execute_query(
-            self.urls.select().where(and_(
-                self.urls.c.domain == domain,
-                self.urls.c.user_token == user_token,
-                self.urls.c.hash == hashkey
-            )).limit(1))
+            self._select_by_hash(domain, user_token, hashkey))
         row = yield result.fetchone()
 
         if not row:
@@ -84,6 +407,198 @@ class ShortenerTables(TableCollection):
 
         returnValue(self._format_row(row))
 
+    @inlineCallbacks
+    def get_or_create_short_url(self, domain, user_token, long_url,
+                                row_id=None):
+        '''
+        Returns ``(row, created)`` for the given url, creating the row, its
+        short url and its audit row if they don't exist yet.
+
+        Everything happens in a single transaction on this connection: at
+        most a select, an insert, the short url update and the audit insert.
+        If ``row_id`` is one reserved with :meth:`reserve_ids`, a new row is
+        inserted with that id and its short url in one go, without the
+        update. If another connection inserts the same url first, the
+        transaction is retried once to pick up that row.
+        '''
+        try:
+            result = yield self._get_or_create_short_url(
+                domain, user_token, long_url, row_id)
+        except IntegrityError:
+            result = yield self._get_or_create_short_url(
+                domain, user_token, long_url, row_id)
+        returnValue(result)
+
+    @inlineCallbacks
+    def _get_or_create_short_url(self, domain, user_token, long_url,
+                                 row_id=None):
+        hashkey = self.hash_url(domain, user_token, long_url)
+        trx = yield self._conn.begin()
+        try:
+            result = yield self.execute_query(
+                self._select_by_hash(domain, user_token, hashkey))
+            row = yield result.fetchone()
+            row = self._format_row(row)
+            created = not (row and row['short_url'])
+
+            if row is None:
+                row = {
+                    'domain': domain,
+                    'user_token': user_token,
+                    'hash': hashkey,
+                    'long_url': long_url,
+                    'created_at': datetime.utcnow(),
+                }
+                if row_id is not None:
+                    row['id'] = row_id
+                    row['short_url'] = generate_token(row_id)
+                result = yield self.execute_query(
+                    self.urls.insert().values(**row))
+                if row_id is None:
+                    row['id'] = self._inserted_id(result)
+                yield self.execute_query(
+                    self.audit.insert().values(url_id=row['id'], hits=0))
+
+            if not row.get('short_url'):
+                row['short_url'] = generate_token(row['id'])
+                yield self.update_short_url(row['id'], row['short_url'])
+            yield trx.commit()
+        except Exception:
+            # The exception context doesn't survive the yield below.
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+        returnValue((row, created))
+
+    def _max_bind_params(self):
+        return MAX_BIND_PARAMS.get(
+            self._conn._engine.dialect.name, DEFAULT_MAX_BIND_PARAMS)
+
+    @inlineCallbacks
+    def _select_by_hashes(self, hashkeys):
+        rows = {}
+        for chunk in _chunks(hashkeys, self._max_bind_params()):
+            result = yield self.execute_query(
+                self.urls.select().where(self.urls.c.hash.in_(chunk)))
+            for row in (yield result.fetchall()):
+                key = (row['domain'], row['user_token'], row['hash'])
+                rows[key] = self._format_row(row)
+        returnValue(rows)
+
+    def _assign_tokens(self, rows):
+        # Rows inserted together usually have consecutive ids, which can be
+        # encoded in one go.
+        runs = []
+        for row in rows:
+            if runs and runs[-1][-1]['id'] + 1 == row['id']:
+                runs[-1].append(row)
+            else:
+                runs.append([row])
+        for run in runs:
+            tokens = generate_tokens(run[0]['id'], len(run))
+            for row, token in zip(run, tokens):
+                row['short_url'] = token
+
+    @inlineCallbacks
+    def get_or_create_short_urls(self, urls, row_ids=None):
+        '''
+        Bulk version of :meth:`get_or_create_short_url`.
+
+        Takes a list of ``(domain, user_token, long_url)`` tuples and returns
+        ``(rows, created)``, where ``rows`` are in the same order as ``urls``
+        and ``created`` is the number of new short urls.
+
+        Everything happens in a single transaction using multi-row inserts
+        and updates, so the number of statements grows with the
+        number of bind parameter sized chunks rather than with the number of
+        urls. If ``row_ids`` are given, at least one per url, new rows are
+        inserted complete with those ids and their short urls, and neither
+        selected again nor updated. Like :meth:`get_or_create_short_url`,
+        the transaction is retried once if another connection inserts one of
+        the urls first.
+        '''
+        try:
+            result = yield self._get_or_create_short_urls(urls, row_ids)
+        except IntegrityError:
+            result = yield self._get_or_create_short_urls(urls, row_ids)
+        returnValue(result)
+
+    @inlineCallbacks
+    def _get_or_create_short_urls(self, urls, row_ids=None):
+        keys = [
+            (domain, user_token, self.hash_url(domain, user_token, long_url))
+            for domain, user_token, long_url in urls]
+        new_urls = {}
+        for key, (domain, user_token, long_url) in zip(keys, urls):
+            new_urls.setdefault(key, {
+                'domain': domain,
+                'user_token': user_token,
+                'hash': key[2],
+                'long_url': long_url,
+            })
+        unique_keys = sorted(new_urls)
+
+        trx = yield self._conn.begin()
+        try:
+            rows = yield self._select_by_hashes(
+                sorted(set(key[2] for key in unique_keys)))
+            missing = [dict(new_urls[key]) for key in unique_keys
+                       if key not in rows]
+
+            if missing:
+                created_at = datetime.utcnow()
+                for row in missing:
+                    row['created_at'] = created_at
+                if row_ids is not None:
+                    for row, row_id in zip(missing, row_ids):
+                        row['id'] = row_id
+                    self._assign_tokens(missing)
+                per_insert = self._max_bind_params() // len(missing[0])
+                for chunk in _chunks(missing, per_insert):
+                    yield self.execute_query(
+                        self.urls.insert().values(chunk))
+
+                if row_ids is None:
+                    inserted = yield self._select_by_hashes(
+                        sorted(set(row['hash'] for row in missing)))
+                else:
+                    inserted = dict(
+                        ((row['domain'], row['user_token'], row['hash']), row)
+                        for row in missing)
+                inserted_keys = [
+                    (row['domain'], row['user_token'], row['hash'])
+                    for row in missing]
+                audits = []
+                for key in inserted_keys:
+                    rows[key] = inserted[key]
+                    audits.append({'url_id': rows[key]['id'], 'hits': 0})
+                for chunk in _chunks(audits, self._max_bind_params() // 2):
+                    yield self.execute_query(
+                        self.audit.insert().values(chunk))
+
+            unassigned = sorted(
+                (rows[key] for key in unique_keys
+                 if not rows[key]['short_url']),
+                key=lambda row: row['id'])
+            self._assign_tokens(unassigned)
+            short_urls = [(row['id'], row['short_url']) for row in unassigned]
+            # Each row takes a bind parameter in the IN clause and two in
+            # the CASE expression.
+            for chunk in _chunks(short_urls, self._max_bind_params() // 3):
+                yield self.execute_query(
+                    self.urls.update().where(
+                        self.urls.c.id.in_([row_id for row_id, _ in chunk])
+                    ).values(short_url=_case(self.urls.c.id, chunk)))
+            yield trx.commit()
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+        created = len(unassigned)
+        if row_ids is not None:
+            created += len(missing)
+        returnValue(([rows[key] for key in keys], created))
+
     @inlineCallbacks
     def update_short_url(self, row_id, short_url):
         yield self.execute_query(
@@ -100,13 +615,219 @@ class ShortenerTables(TableCollection):
         row = yield result.fetchone()
 
         if row and increment:
-            yield self.execute_query(
-                self.audit.update().where(
-                    self.audit.c.url_id == row['id']
-                ).values(hits=self.audit.c.hits + 1)
-            )
+            yield self.increment_hits(row['id'])
         returnValue(self._format_row(row))
 
+    @inlineCallbacks
+    def get_row_by_id(self, url_id, short_url=None, increment=True):
+        query = self.urls.select().where(self.urls.c.id == url_id)
+        if short_url is not None:
+            query = query.where(self.urls.c.short_url == short_url)
+        result = yield self.execute_query(query.limit(1))
+        row = yield result.fetchone()
+
+        if row and increment:
+            yield self.increment_hits(row['id'])
+        returnValue(self._format_row(row))
+
+    def _select_with_hits(self):
+        return select([self.urls, self.audit.c.hits]).select_from(
+            self.urls.outerjoin(
+                self.audit, self.audit.c.url_id == self.urls.c.id))
+
+    @inlineCallbacks
+    def get_row_with_hits(self, url_id, short_url=None):
+        '''
+        Returns the url row for ``url_id`` with its hit count in ``hits``.
+        '''
+        query = self._select_with_hits().where(self.urls.c.id == url_id)
+        if short_url is not None:
+            query = query.where(self.urls.c.short_url == short_url)
+        result = yield self.execute_query(query.limit(1))
+        row = yield result.fetchone()
+        returnValue(self._format_row(row))
+
+    @inlineCallbacks
+    def get_rows_with_hits(self, after_id=None, limit=1000):
+        '''
+        Returns up to ``limit`` url rows with their hit counts, ordered by id
+        and starting after ``after_id``.
+
+        Passing the last id of one page as ``after_id`` for the next walks
+        the whole table without offsets or a cursor held open between pages.
+        '''
+        query = self._select_with_hits()
+        if after_id is not None:
+            query = query.where(self.urls.c.id > after_id)
+        result = yield self.execute_query(
+            query.order_by(self.urls.c.id).limit(limit))
+        rows = yield result.fetchall()
+        returnValue([self._format_row(row) for row in rows])
+
+    @inlineCallbacks
+    def get_hot_urls(self, limit, since=None):
+        '''
+        Returns up to ``limit`` urls that have short urls, most hit first,
+        as rows with ``id``, ``short_url``, ``long_url`` and ``hits``. Urls
+        are ranked by their lifetime hits or, if ``since`` is given, by
+        their hits in the hour buckets starting then or later.
+        '''
+        columns = [self.urls.c.id, self.urls.c.short_url, self.urls.c.long_url]
+        if since is None:
+            hits = self.audit.c.hits
+            query = select(columns + [hits]).select_from(self.urls.join(
+                self.audit, self.audit.c.url_id == self.urls.c.id))
+        else:
+            rollups = self.hit_rollups
+            hits = func.sum(rollups.c.hits).label('hits')
+            query = select(columns + [hits]).select_from(self.urls.join(
+                rollups, rollups.c.url_id == self.urls.c.id)
+            ).where(and_(
+                rollups.c.resolution == ROLLUP_RESOLUTIONS['hour'],
+                rollups.c.bucket >= since,
+            )).group_by(*columns)
+        result = yield self.execute_query(
+            query.where(self.urls.c.short_url.isnot(None)).order_by(
+                hits.desc()).limit(limit))
+        rows = yield result.fetchall()
+        returnValue([self._format_row(row) for row in rows])
+
+    @inlineCallbacks
+    def get_short_urls(self, after_id=None, limit=1000):
+        '''
+        Returns up to ``limit`` ``(id, short_url)`` pairs for urls that have
+        a short url, ordered by id and starting after ``after_id``.
+        '''
+        query = select([self.urls.c.id, self.urls.c.short_url]).where(
+            self.urls.c.short_url.isnot(None))
+        if after_id is not None:
+            query = query.where(self.urls.c.id > after_id)
+        result = yield self.execute_query(
+            query.order_by(self.urls.c.id).limit(limit))
+        rows = yield result.fetchall()
+        returnValue([(row_id, short_url) for row_id, short_url in rows])
+
+    @inlineCallbacks
+    def increment_hits(self, url_id, count=1):
+        yield self.execute_query(
+            self.audit.update().where(
+                self.audit.c.url_id == url_id
+            ).values(hits=self.audit.c.hits + count)
+        )
+
+    @inlineCallbacks
+    def update_hits(self, hits):
+        '''
+        Adds a batch of hit counts, given as a dict mapping url ids to
+        counts, to the audit table with one multi-row UPDATE statement per
+        bind parameter sized chunk of urls.
+        '''
+        audit = self.audit
+        # Each url takes a bind parameter in the IN clause and two in the
+        # CASE expression.
+        for chunk in _chunks(sorted(hits.items()),
+                             self._max_bind_params() // 3):
+            yield self.execute_query(
+                audit.update().where(
+                    audit.c.url_id.in_([url_id for url_id, _ in chunk])
+                ).values(hits=audit.c.hits + _case(audit.c.url_id, chunk)))
+
+    @inlineCallbacks
+    def update_hit_rollups(self, hits):
+        '''
+        Adds hit counts, given as a dict mapping ``(url_id, timestamp)`` to
+        counts, to the buckets of every resolution that ``timestamp`` falls
+        in.
+
+        Existing buckets are incremented in one executemany statement and
+        new ones inserted in another, in a single transaction. If another
+        connection inserts one of the new buckets first, the transaction is
+        retried once to increment it instead.
+        '''
+        if not hits:
+            return
+        counts = {}
+        for (url_id, timestamp), count in hits.iteritems():
+            for resolution in ROLLUP_RESOLUTIONS.itervalues():
+                bucket = datetime.utcfromtimestamp(
+                    timestamp // resolution * resolution)
+                key = (url_id, resolution, bucket)
+                counts[key] = counts.get(key, 0) + count
+        try:
+            yield self._update_hit_rollups(counts)
+        except IntegrityError:
+            yield self._update_hit_rollups(counts)
+
+    @inlineCallbacks
+    def _update_hit_rollups(self, counts):
+        rollups = self.hit_rollups
+        url_ids = sorted(set(url_id for url_id, _, _ in counts))
+        since = min(bucket for _, _, bucket in counts)
+
+        trx = yield self._conn.begin()
+        try:
+            existing = set()
+            for chunk in _chunks(url_ids, self._max_bind_params() - 1):
+                result = yield self.execute_query(
+                    select([rollups.c.url_id, rollups.c.resolution,
+                            rollups.c.bucket]).where(and_(
+                                rollups.c.url_id.in_(chunk),
+                                rollups.c.bucket >= since)))
+                for row in (yield result.fetchall()):
+                    existing.add(tuple(row))
+
+            updates = []
+            inserts = []
+            for key in sorted(counts):
+                url_id, resolution, bucket = key
+                if key in existing:
+                    updates.append({
+                        'b_url_id': url_id,
+                        'b_resolution': resolution,
+                        'b_bucket': bucket,
+                        'b_hits': counts[key],
+                    })
+                else:
+                    inserts.append({
+                        'url_id': url_id,
+                        'resolution': resolution,
+                        'bucket': bucket,
+                        'hits': counts[key],
+                    })
+            if updates:
+                yield self.execute_query(
+                    rollups.update().where(and_(
+                        rollups.c.url_id == bindparam('b_url_id'),
+                        rollups.c.resolution == bindparam('b_resolution'),
+                        rollups.c.bucket == bindparam('b_bucket'),
+                    )).values(hits=rollups.c.hits + bindparam('b_hits')),
+                    updates)
+            for chunk in _chunks(inserts, self._max_bind_params() // 4):
+                yield self.execute_query(rollups.insert().values(chunk))
+            yield trx.commit()
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+
+    @inlineCallbacks
+    def get_hit_rollups(self, url_id, resolution, since, until):
+        '''
+        Returns ``(bucket, hits)`` pairs for the buckets of ``url_id`` at
+        ``resolution`` that start between ``since`` and ``until``,
+        inclusive, in order. Buckets without hits are left out.
+        '''
+        rollups = self.hit_rollups
+        result = yield self.execute_query(
+            select([rollups.c.bucket, rollups.c.hits]).where(and_(
+                rollups.c.url_id == url_id,
+                rollups.c.resolution == resolution,
+                rollups.c.bucket >= since,
+                rollups.c.bucket <= until,
+            )).order_by(rollups.c.bucket))
+        rows = yield result.fetchall()
+        returnValue([(row['bucket'], row['hits']) for row in rows])
+
     @inlineCallbacks
     def create_audit(self, url_id):
         result = yield self.execute_query(
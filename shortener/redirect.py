@@ -0,0 +1,67 @@
+# -*- test-case-name: shortener.tests.test_redirect -*-
+from aludel.service import APIError, format_error
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from shortener.timing import start_request_timer, finish_request_timer
+
+
+class RedirectResource(Resource):
+    """
+    The service's root resource.
+
+    Redirects, ``GET /<short_url>``, are by far the most common requests, so
+    they're handled here without going through Klein's routing or aludel's
+    JSON responses, and without a Deferred at all when the short url is in
+    the redirect cache. Their responses have an empty body. Every other
+    request is passed on to ``fallback``, the app's Klein resource.
+    """
+    isLeaf = True
+
+    def __init__(self, app, fallback):
+        Resource.__init__(self)
+        self.app = app
+        self.fallback = fallback
+
+    def render(self, request):
+        postpath = request.postpath
+        if request.method != 'GET' or len(postpath) != 1 or not postpath[0]:
+            return self.fallback.render(request)
+        short_url = postpath[0]
+
+        timer = start_request_timer(self.app, request, 'resolve')
+        row = self.app.get_cached_row(short_url)
+        if row is not None:
+            self.app.set_redirect(request, row)
+            if timer is not None:
+                finish_request_timer(self.app, request, timer)
+            return ''
+
+        # The client may go away while the row is being fetched, in which
+        # case this fails with the reason.
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+
+        d = self.app.fetch_row(short_url, timer)
+        d.addCallbacks(
+            self._found, self._failed,
+            callbackArgs=(request, timer, gone),
+            errbackArgs=(request, timer, gone))
+        return NOT_DONE_YET
+
+    def _found(self, row, request, timer, gone):
+        self.app.set_redirect(request, row)
+        self._finish(request, timer, gone, '')
+
+    def _failed(self, failure, request, timer, gone):
+        log.err(failure)
+        self._finish(request, timer, gone, format_error(
+            APIError('Internal server error.'), request))
+
+    def _finish(self, request, timer, gone, body):
+        if timer is not None:
+            finish_request_timer(self.app, request, timer)
+        if not gone:
+            request.write(body)
+            request.finish()
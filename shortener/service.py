@@ -1,12 +1,17 @@
 # -*- test-case-name: shortener.tests.test_shortener_service -*-
+import os
+
 import yaml
 
 from twisted.application import strports, service
+from twisted.application.service import IService
 from twisted.internet import reactor
 from twisted.python import usage
 from twisted.web import server
 
-from shortener.api import ShortenerServiceApp
+from shortener.accounts import make_apps
+from shortener.metrics import MetricsFlushService
+from shortener.warmup import warm_up_service
 
 DEFAULT_PORT = 'tcp:8080'
 
@@ -15,30 +20,63 @@ class Options(usage.Options):
     """Command line args when run as a twistd plugin"""
     optParameters = [
         ["config", "c", "shortener/config.yaml", "The service config file"],
+        ["workers", "w", 1, "Number of worker processes to serve with", int],
     ]
 
     def postOptions(self):
-        pass
+        if self['workers'] < 1:
+            raise usage.UsageError('--workers must be at least 1')
+
+
+def load_config(config_file):
+    with open(config_file, 'r') as fp:
+        return dict(yaml.safe_load(fp))
+
+
+def add_app_services(app, main_service):
+    """
+    Adds the services that do an app's background work: loading the short
+    url filter, connecting to the shared cache and writing out hits.
+    """
+    if app.short_url_filter is not None:
+        app.short_url_filter.setServiceParent(main_service)
+
+    if IService.providedBy(app.shared_cache):
+        app.shared_cache.setServiceParent(main_service)
+
+    # Pending hits are flushed to the database when this service stops.
+    app.hits.setServiceParent(main_service)
 
 
 def makeService(options):
     config_file = options['config']
-    with open(config_file, 'r') as fp:
-        config = dict(yaml.safe_load(fp))
+    config = load_config(config_file)
 
-    # NOTE: This sets the global reactor threadpool size to 1.
-    #       alchimia doesn't deal well with multiple threads yet.
-    reactor.suggestThreadPoolSize(1)
+    if options['workers'] > 1:
+        # Imported here, it imports this module.
+        from shortener.workers import WorkerSupervisor
+        return WorkerSupervisor(
+            reactor, os.path.abspath(config_file), config, options['workers'])
 
-    app = ShortenerServiceApp(reactor=reactor, config=config)
+    resource, metrics, apps = make_apps(reactor, config)
 
-    site = server.Site(app.app.resource())
+    site = server.Site(resource)
 
     main_service = service.MultiService()
 
-    app_service = strports.service(config.get('port', DEFAULT_PORT), site)
-    app_service.setServiceParent(main_service)
+    metrics.carbon_client.setServiceParent(main_service)
+    if metrics.aggregating:
+        # Services are stopped in reverse order, so the final flush happens
+        # before the carbon client disconnects.
+        MetricsFlushService(reactor, metrics).setServiceParent(main_service)
+
+    for app in apps:
+        add_app_services(app, main_service)
 
-    app.metrics.carbon_client.setServiceParent(main_service)
+    # Added last so that it starts listening after the apps' services have
+    # started, and stops listening before they stop.
+    app_service = strports.service(config.get('port', DEFAULT_PORT), site)
+    warm_up_service(reactor, config, apps, app_service).setServiceParent(
+        main_service)
 
     return main_service
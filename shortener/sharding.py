@@ -0,0 +1,85 @@
+# -*- test-case-name: shortener.tests.test_sharding -*-
+"""
+Spreading an account's urls across several databases.
+
+With ``n`` shards, a url's id is ``sequence * n + index``, where ``index``
+is the shard it's stored on and ``sequence`` comes from that shard's own id
+counter. Short urls are generated from ids, so a short url leads straight
+to its shard. New urls go to the shard picked by their
+``(domain, user_token, long_url)`` hash, which is where they are looked up
+again when they're shortened a second time. An account that isn't sharded
+is a single shard, whose ids and sequences are the same.
+"""
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+
+
+class Shard(object):
+    """
+    One of the ``count`` databases an account's urls are spread across,
+    with its ``engine`` for writes, its ``read_engine`` for reads and, once
+    the app has given it one, the
+    :class:`shortener.hilo.IdAllocator` for its id counter.
+    """
+
+    def __init__(self, index, count, engine, read_engine=None):
+        self.index = index
+        self.count = count
+        self.engine = engine
+        self.read_engine = engine if read_engine is None else read_engine
+        self.id_allocator = None
+
+    def row_id(self, sequence):
+        """
+        Returns the id of the url numbered ``sequence`` on this shard.
+        """
+        return sequence * self.count + self.index
+
+    def sequence(self, row_id):
+        """
+        Returns the number of the url with id ``row_id`` on this shard.
+        """
+        return row_id // self.count
+
+    @inlineCallbacks
+    def read(self, f, *args, **kw):
+        """
+        Returns what ``f(conn, *args, **kw)`` returns on a connection from
+        the read engine. If that's a replica and ``f`` fails there, or finds
+        nothing and returns ``None``, it's tried again on the primary, since
+        the replica may be down or not have caught up with new urls yet.
+        """
+        if self.read_engine is not self.engine:
+            try:
+                result = yield _with_connection(
+                    self.read_engine, f, *args, **kw)
+            except Exception:
+                log.err(None, 'Read from replica failed, trying primary.')
+            else:
+                if result is not None:
+                    returnValue(result)
+        result = yield _with_connection(self.engine, f, *args, **kw)
+        returnValue(result)
+
+
+@inlineCallbacks
+def _with_connection(engine, f, *args, **kw):
+    conn = yield engine.connect()
+    try:
+        result = yield f(conn, *args, **kw)
+    finally:
+        yield conn.close()
+    returnValue(result)
+
+
+def shard_for_id(shards, row_id):
+    return shards[row_id % len(shards)]
+
+
+def shard_for_hash(shards, hashkey):
+    """
+    Returns the shard for urls whose :meth:`ShortenerTables.hash_url` is
+    ``hashkey``.
+    """
+    return shards[int(hashkey, 16) % len(shards)]
+
@@ -0,0 +1,235 @@
+# -*- test-case-name: shortener.tests.test_shared_cache -*-
+"""
+Caches shared by every process serving an account.
+
+The redirect cache in :mod:`shortener.cache` is private to each process, so
+right after a deploy, or with many processes behind a load balancer, most
+lookups miss it. A shared cache sits between it and the database, and is
+filled whenever a url is created or looked up, so that one process's work
+warms every other's.
+
+Backends implement :meth:`get_many` and :meth:`set_many`. Both return
+Deferreds, and neither ever fails: a backend that can't be reached just
+misses.
+"""
+import hashlib
+import json
+from binascii import crc32
+
+from twisted.application.service import MultiService
+from twisted.internet.defer import succeed, gatherResults
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.memcache import MemCacheProtocol
+from twisted.python import log
+
+from shortener.cache import LRUCache
+from shortener.reconnecting_client import ReconnectingClientService
+
+MEMORY = 'memory'
+MEMCACHED = 'memcached'
+
+DEFAULT_SHARED_CACHE_SIZE = 100000
+DEFAULT_SHARED_CACHE_TTL = 3600
+DEFAULT_MEMCACHED_POOL_SIZE = 2
+DEFAULT_MEMCACHED_TIMEOUT = 1
+
+MAX_KEY_LENGTH = MemCacheProtocol.MAX_KEY_LENGTH
+
+
+def cache_key(*parts):
+    """
+    Joins ``parts`` into a key memcached accepts, hashing it if it's too
+    long or contains whitespace or control characters.
+    """
+    key = ':'.join(
+        part.encode('utf-8') if isinstance(part, unicode) else str(part)
+        for part in parts)
+    if len(key) > MAX_KEY_LENGTH or any(c <= ' ' or c == '\x7f' for c in key):
+        key = hashlib.sha1(key).hexdigest()
+    return key
+
+
+class MemoryCacheBackend(object):
+    """
+    A shared cache that is only shared within this process, for running
+    without memcached.
+    """
+
+    def __init__(self, max_size=DEFAULT_SHARED_CACHE_SIZE,
+                 ttl=DEFAULT_SHARED_CACHE_TTL, clock=None):
+        self._cache = LRUCache(max_size, ttl, clock=clock)
+
+    def get_many(self, keys):
+        values = {}
+        for key in keys:
+            value = self._cache.get(key)
+            if value is not None:
+                values[key] = value
+        return succeed(values)
+
+    def set_many(self, values):
+        for key, value in values.iteritems():
+            self._cache.set(key, value)
+        return succeed(None)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class MemcachedClientFactory(ClientFactory):
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def buildProtocol(self, addr):
+        protocol = MemCacheProtocol(timeOut=self.timeout)
+        protocol.factory = self
+        return protocol
+
+
+class MemcachedClientService(ReconnectingClientService):
+    """
+    One pooled connection to a memcached server, kept open while the
+    service is running.
+    """
+    initialDelay = 0.1
+    maxDelay = 10
+
+    def __init__(self, endpoint, timeout=DEFAULT_MEMCACHED_TIMEOUT):
+        ReconnectingClientService.__init__(
+            self, endpoint, MemcachedClientFactory(timeout))
+        self.protocol_instance = None
+
+    def clientConnected(self, protocol):
+        self.protocol_instance = protocol
+        ReconnectingClientService.clientConnected(self, protocol)
+
+    def clientConnectionLost(self, reason):
+        self.protocol_instance = None
+        ReconnectingClientService.clientConnectionLost(self, reason)
+
+
+class MemcachedBackend(MultiService):
+    """
+    A shared cache on one or more memcached servers.
+
+    Keys are spread across ``endpoints`` by hash, and each server gets a
+    pool of ``pool_size`` connections, used in turn. All the keys a call
+    needs from one server are fetched with a single multi-get, and sets are
+    pipelined without waiting for each other. Values are stored as JSON and
+    expire after ``ttl`` seconds. Requests time out after ``timeout``
+    seconds, and dropped connections are reopened in the background; in the
+    meantime their keys miss.
+    """
+
+    def __init__(self, endpoints, pool_size=DEFAULT_MEMCACHED_POOL_SIZE,
+                 ttl=DEFAULT_SHARED_CACHE_TTL,
+                 timeout=DEFAULT_MEMCACHED_TIMEOUT):
+        MultiService.__init__(self)
+        if not endpoints:
+            raise ValueError('At least one memcached server is needed')
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._pools = []
+        self._next = []
+        for endpoint in endpoints:
+            pool = [MemcachedClientService(endpoint, timeout)
+                    for _ in xrange(pool_size)]
+            for client in pool:
+                client.setServiceParent(self)
+            self._pools.append(pool)
+            self._next.append(0)
+
+    def _server(self, key):
+        return (crc32(key) & 0xffffffff) % len(self._pools)
+
+    def _connection(self, server):
+        """
+        Returns the next connected protocol in ``server``'s pool, or
+        ``None`` if none of them are connected.
+        """
+        pool = self._pools[server]
+        for _ in xrange(len(pool)):
+            client = pool[self._next[server]]
+            self._next[server] = (self._next[server] + 1) % len(pool)
+            if client.protocol_instance is not None:
+                return client.protocol_instance
+        return None
+
+    def _by_server(self, keys):
+        servers = {}
+        for key in keys:
+            servers.setdefault(self._server(key), []).append(key)
+        return servers
+
+    def _failed(self, failure, default):
+        self.errors += 1
+        log.err(failure, 'Shared cache request failed')
+        return default
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        ds = []
+        for server, server_keys in self._by_server(keys).iteritems():
+            protocol = self._connection(server)
+            if protocol is None:
+                continue
+            d = protocol.getMultiple(server_keys)
+            d.addErrback(self._failed, {})
+            ds.append(d)
+        d = gatherResults(ds)
+        d.addCallback(self._got_many, len(keys))
+        return d
+
+    def _got_many(self, results, count):
+        values = {}
+        for result in results:
+            for key, (flags, value) in result.iteritems():
+                if value is not None:
+                    values[key] = json.loads(value)
+        self.hits += len(values)
+        self.misses += count - len(values)
+        return values
+
+    def set_many(self, values):
+        ds = []
+        for server, keys in self._by_server(values).iteritems():
+            protocol = self._connection(server)
+            if protocol is None:
+                continue
+            for key in keys:
+                d = protocol.set(
+                    key, json.dumps(values[key]), expireTime=self.ttl)
+                d.addErrback(self._failed, False)
+                ds.append(d)
+        return gatherResults(ds).addCallback(lambda _: None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'errors': self.errors}
+
+
+def make_shared_cache(reactor, config):
+    """
+    Returns the shared cache ``config['shared_cache']`` asks for, or
+    ``None`` if it doesn't ask for one.
+    """
+    backend = config.get('shared_cache')
+    ttl = config.get('shared_cache_ttl', DEFAULT_SHARED_CACHE_TTL)
+    if not backend:
+        return None
+    if backend == MEMORY:
+        return MemoryCacheBackend(
+            config.get('shared_cache_size', DEFAULT_SHARED_CACHE_SIZE), ttl,
+            clock=reactor)
+    if backend == MEMCACHED:
+        return MemcachedBackend(
+            [clientFromString(reactor, server)
+             for server in config['memcached_servers']],
+            pool_size=config.get(
+                'memcached_pool_size', DEFAULT_MEMCACHED_POOL_SIZE),
+            ttl=ttl,
+            timeout=config.get('memcached_timeout', DEFAULT_MEMCACHED_TIMEOUT))
+    raise ValueError('Unknown shared_cache: %r' % (backend,))
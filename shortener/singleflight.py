@@ -0,0 +1,49 @@
+# -*- test-case-name: shortener.tests.test_singleflight -*-
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key.
+
+    :meth:`run` calls ``f`` for a key only if no earlier call for that key
+    is still in flight. Otherwise the caller gets a Deferred that fires with
+    the in-flight call's result, or failure, once it's done. So however many
+    callers ask for a key at once, there's only ever one call for it.
+
+    Every caller, the first one included, gets a Deferred of its own, so
+    cancelling one only cancels that caller's wait. The call itself keeps
+    going for the others.
+    """
+
+    def __init__(self):
+        self._waiting = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, key):
+        return key in self._waiting
+
+    def run(self, key, f, *args, **kw):
+        d = Deferred()
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            waiting.append(d)
+            return d
+        self._waiting[key] = [d]
+        maybeDeferred(f, *args, **kw).addBoth(self._done, key)
+        return d
+
+    def _done(self, result, key):
+        for d in self._waiting.pop(key):
+            if d.called:
+                # Cancelled while waiting.
+                continue
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
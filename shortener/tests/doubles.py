@@ -2,6 +2,8 @@ from twisted.internet.base import BaseConnector
 from twisted.internet.endpoints import _WrappingFactory
 from twisted.internet.error import ConnectionDone
 from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
 from twisted.python.failure import Failure
 from twisted.test.proto_helpers import StringTransport
 from zope.interface import implementer
@@ -54,3 +56,48 @@ class StringTransportClientEndpoint(object):
             self._string_transport, wf, self._reactor)
         connector.connect()
         return wf._onConnection
+
+
+class FakeMemcachedProtocol(LineReceiver):
+    """
+    Speaks just enough of memcached's text protocol for the shared cache:
+    ``get`` with any number of keys, and ``set``.
+    """
+
+    def connectionMade(self):
+        self._storing = None
+        self.factory.connections.append(self)
+
+    def lineReceived(self, line):
+        self.factory.commands.append(line)
+        if self.factory.silent:
+            return
+        if self._storing is not None:
+            key, flags = self._storing
+            self._storing = None
+            self.factory.values[key] = (flags, line)
+            self.sendLine('STORED')
+            return
+        parts = line.split()
+        if parts[0] == 'get':
+            for key in parts[1:]:
+                if key in self.factory.values:
+                    flags, value = self.factory.values[key]
+                    self.sendLine('VALUE %s %s %d' % (key, flags, len(value)))
+                    self.sendLine(value)
+            self.sendLine('END')
+        elif parts[0] == 'set':
+            self._storing = (parts[1], parts[2])
+        else:
+            self.sendLine('ERROR')
+
+
+class FakeMemcachedFactory(Factory):
+    protocol = FakeMemcachedProtocol
+    # Set to stop answering commands.
+    silent = False
+
+    def __init__(self):
+        self.values = {}
+        self.commands = []
+        self.connections = []
@@ -0,0 +1,200 @@
+import json
+import os
+import treq
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.test.requesthelper import DummyRequest
+
+from aludel.database import MetaData
+from shortener.accounts import (
+    AccountRouter, account_configs, make_apps, ROUTE_BY_HOST, ROUTE_BY_PATH)
+from shortener.models import ShortenerTables
+
+
+class FakeResource(Resource):
+    def __init__(self, name):
+        Resource.__init__(self)
+        self.name = name
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append((list(request.prepath), list(request.postpath)))
+        return self.name
+
+
+class TestAccountConfigs(TestCase):
+    timeout = 1
+
+    def make_config(self, **config):
+        config.setdefault('host_domain', 'http://wtxt.io')
+        config.setdefault('account', 'service')
+        config.setdefault('connection_string', 'sqlite://')
+        return config
+
+    def test_route_by_host(self):
+        routing, configs = account_configs(self.make_config(accounts=[
+            {'account': 'foo', 'host_domain': 'http://Foo.io:8080'},
+            {'account': 'bar', 'host_domain': 'http://bar.io',
+             'hosts': ['bar.io', 'www.bar.io'], 'redirect_cache_size': 10},
+        ]))
+        self.assertEqual(routing, ROUTE_BY_HOST)
+        self.assertEqual(
+            [(key, config['account']) for key, config in configs],
+            [('foo.io', 'foo'), ('bar.io', 'bar'), ('www.bar.io', 'bar')])
+        self.assertEqual(configs[0][1]['connection_string'], 'sqlite://')
+        self.assertFalse('accounts' in configs[0][1])
+        self.assertFalse('redirect_cache_size' in configs[0][1])
+        self.assertEqual(configs[1][1]['redirect_cache_size'], 10)
+        self.assertFalse('hosts' in configs[1][1])
+
+    def test_route_by_host_needs_host_domain(self):
+        self.assertRaises(ValueError, account_configs, self.make_config(
+            accounts=[{'account': 'foo'}]))
+
+    def test_route_by_path(self):
+        routing, configs = account_configs(self.make_config(
+            account_routing='path', accounts=[
+                {'account': 'foo'},
+                {'account': 'bar', 'host_domain': 'http://bar.io/'},
+            ]))
+        self.assertEqual(routing, ROUTE_BY_PATH)
+        self.assertEqual(
+            [(key, config['host_domain']) for key, config in configs],
+            [('foo', 'http://wtxt.io/foo/'), ('bar', 'http://bar.io/')])
+
+    def test_unknown_routing(self):
+        self.assertRaises(ValueError, account_configs, self.make_config(
+            account_routing='cookie', accounts=[]))
+
+
+class TestAccountRouter(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.foo = FakeResource('foo')
+        self.bar = FakeResource('bar')
+
+    def request(self, path, host=None):
+        request = DummyRequest(path)
+        if host is not None:
+            request.headers['host'] = host
+        return request
+
+    def test_route_by_host(self):
+        router = AccountRouter(
+            ROUTE_BY_HOST, {'foo.io': self.foo, 'bar.io': self.bar})
+        self.assertEqual(
+            router.render(self.request(['qr0'], 'foo.io:8080')), 'foo')
+        self.assertEqual(
+            router.render(self.request(['qr0'], 'BAR.io')), 'bar')
+        self.assertEqual(self.foo.requests, [([], ['qr0'])])
+
+        request = self.request(['qr0'], 'baz.io')
+        response = json.loads(router.render(request))
+        self.assertEqual(request.responseCode, 404)
+        self.assertEqual(response['error'], 'Unknown account')
+
+        request = self.request(['qr0'])
+        router.render(request)
+        self.assertEqual(request.responseCode, 404)
+
+    def test_route_by_path(self):
+        router = AccountRouter(
+            ROUTE_BY_PATH, {'foo': self.foo, 'bar': self.bar})
+        self.assertEqual(router.render(self.request(['foo', 'qr0'])), 'foo')
+        self.assertEqual(
+            router.render(self.request(['bar', 'api', 'init'])), 'bar')
+        self.assertEqual(self.foo.requests, [(['foo'], ['qr0'])])
+        self.assertEqual(self.bar.requests, [(['bar'], ['api', 'init'])])
+
+        for path in [['baz', 'qr0'], []]:
+            request = self.request(path)
+            router.render(request)
+            self.assertEqual(request.responseCode, 404)
+
+
+class TestMakeApps(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        self.config = {
+            'host_domain': 'http://wtxt.io',
+            'account': 'service',
+            'connection_string': os.environ.get(
+                "SHORTENER_TEST_CONNECTION_STRING", "sqlite://"),
+            'graphite_endpoint': 'tcp:www.example.com:80',
+            'handlers': [],
+        }
+
+    def make_apps(self):
+        resource, metrics, apps = make_apps(reactor, self.config)
+        for engine in set(app.engine for app in apps):
+            self.addCleanup(engine.stop)
+        return resource, metrics, apps
+
+    def _drop_tables(self, engine):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def test_single_account(self):
+        resource, metrics, [app] = self.make_apps()
+        self.assertEqual(app.config['account'], 'service')
+        self.assertIdentical(metrics, app.metrics)
+
+    def test_duplicate_routes(self):
+        self.config['accounts'] = [
+            {'account': 'foo', 'host_domain': 'http://foo.io'},
+            {'account': 'bar', 'host_domain': 'http://foo.io'},
+        ]
+        self.assertRaises(ValueError, make_apps, reactor, self.config)
+
+    @inlineCallbacks
+    def test_route_by_path(self):
+        self.config['account_routing'] = 'path'
+        self.config['accounts'] = [{'account': 'foo'}, {'account': 'bar'}]
+        resource, metrics, apps = self.make_apps()
+        self.assertEqual(
+            [app.config['account'] for app in apps], ['bar', 'foo'])
+        bar, foo = apps
+        self.assertIdentical(foo.engine, bar.engine)
+        self.assertEqual(
+            foo.metrics.get_metric_name('created.count'),
+            'foo.wtxtio.created.count')
+
+        self._drop_tables(foo.engine)
+        self.addCleanup(self._drop_tables, foo.engine)
+        conn = yield foo.engine.connect()
+        yield ShortenerTables('foo', conn).create_tables()
+        yield ShortenerTables('bar', conn).create_tables()
+        yield conn.close()
+
+        pool = HTTPConnectionPool(reactor, persistent=False)
+        self.addCleanup(pool.closeCachedConnections)
+        listener = reactor.listenTCP(0, Site(resource), interface='localhost')
+        self.addCleanup(listener.stopListening)
+
+        def url(path):
+            return 'http://localhost:%s%s' % (listener.getHost().port, path)
+
+        resp = yield treq.put(
+            url('/foo/api/create'),
+            data=json.dumps({'long_url': 'http://example.org/'}),
+            pool=pool)
+        result = yield treq.json_content(resp)
+        self.assertEqual(result['short_url'], 'http://wtxt.io/foo/qr0')
+
+        resp = yield treq.get(
+            url('/foo/qr0'), allow_redirects=False, pool=pool)
+        yield treq.content(resp)
+        self.assertEqual(resp.code, 301)
+        resp = yield treq.get(
+            url('/bar/qr0'), allow_redirects=False, pool=pool)
+        yield treq.content(resp)
+        self.assertEqual(resp.code, 404)
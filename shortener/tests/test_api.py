@@ -1,17 +1,26 @@
 import json
 import os
 import treq
+from functools import partial
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, gatherResults, fail
 from twisted.web.client import HTTPConnectionPool
 from twisted.trial.unittest import TestCase
 from twisted.web.server import Site
 
-from aludel.database import MetaData
-from shortener.api import ShortenerServiceApp
+from aludel.database import MetaData, TableCollection
+from shortener.api import ShortenerServiceApp, make_read_engine
+from shortener.bloom import ShortUrlFilter
+from shortener.cache import LRUCache
+from shortener.database import get_engine, ReplicaPool, LEAST_LOADED
+from shortener.hilo import IdAllocator
+from shortener.keygen import generate_token
+from shortener.migrations import SCHEMA_VERSION
 from shortener.models import ShortenerTables
+from shortener.shared_cache import MemoryCacheBackend
 from shortener.metrics import CarbonClientService
+from shortener.timing import QueryTimer
 from shortener.tests.doubles import (
     DisconnectingStringTransport, StringTransportClientEndpoint)
 
@@ -47,6 +56,7 @@ class TestShortenerServiceApp(TestCase):
             reactor=reactor,
             config=cfg
         )
+        self.addCleanup(self.service.engine.stop)
 
         self.tr = DisconnectingStringTransport()
         endpoint = StringTransportClientEndpoint(reactor, self.tr)
@@ -54,7 +64,7 @@ class TestShortenerServiceApp(TestCase):
         self.service.metrics.carbon_client.startService()
         yield self.service.metrics.carbon_client.connect_d
 
-        site = Site(self.service.app.resource())
+        site = Site(self.service.resource())
         self.listener = reactor.listenTCP(0, site, interface='localhost')
         self.listener_port = self.listener.getHost().port
         self._drop_tables()
@@ -93,6 +103,30 @@ class TestShortenerServiceApp(TestCase):
         self.assertTrue(
             self.tr.value().startswith("test-account.wtxtio.created.count 1"))
 
+    @inlineCallbacks
+    def test_create_url_timing(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        self.service.timing_metrics = self.service.metrics
+        self.service.query_timer = QueryTimer(self.service.metrics)
+        self.service.server_timing = True
+
+        resp = yield treq.put(
+            self.make_url('/api/create'),
+            data=json.dumps({'long_url': 'foo'}),
+            allow_redirects=False,
+            pool=self.pool)
+        yield treq.json_content(resp)
+        [server_timing] = resp.headers.getRawHeaders('Server-Timing')
+        self.assertTrue(server_timing.startswith('db-queue;dur='))
+        self.assertTrue('total;dur=' in server_timing)
+
+        metrics = [line.split()[0] for line in self.tr.value().splitlines()]
+        for metric in ['db.select.queue_time', 'db.select.execute_time',
+                       'db.insert.execute_time',
+                       'route.create.response_time']:
+            self.assertTrue(
+                'test-account.wtxtio.%s' % (metric,) in metrics, metric)
+
     @inlineCallbacks
     def test_create_url_no_user_token(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -111,6 +145,67 @@ class TestShortenerServiceApp(TestCase):
         self.assertTrue(
             self.tr.value().startswith("test-account.wtxtio.created.count 1"))
 
+    @inlineCallbacks
+    def test_create_url_batch(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        yield self.service.shorten_url('foo', 'bar')
+
+        payload = {
+            'urls': [
+                {'long_url': 'baz', 'user_token': 'bar'},
+                {'long_url': 'foo', 'user_token': 'bar'},
+                {'long_url': 'baz'},
+                {'long_url': 'baz', 'user_token': 'bar'},
+            ],
+        }
+        resp = yield treq.put(
+            self.make_url('/api/create/batch'),
+            data=json.dumps(payload),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 201)
+        result = yield treq.json_content(resp)
+        short_urls = result['short_urls']
+        self.assertEqual(len(short_urls), 4)
+        self.assertEqual(short_urls[1], 'http://wtxt.io/qr0')
+        self.assertEqual(short_urls[0], short_urls[3])
+        self.assertEqual(
+            set([short_urls[0], short_urls[2]]),
+            set(['http://wtxt.io/%s' % (generate_token(i),) for i in (2, 3)]))
+        conn_queue = self.tr.value().splitlines()
+        self.assertTrue(
+            conn_queue[1].startswith("test-account.wtxtio.created.count 2"))
+
+        token = str(short_urls[2]).split('/')[-1]
+        resp = yield treq.get(
+            self.make_url('/%s' % (token,)),
+            allow_redirects=False,
+            pool=self.pool)
+        self.assertEqual(resp.code, 301)
+        [location] = resp.headers.getRawHeaders('location')
+        self.assertEqual(location, 'baz')
+
+    @inlineCallbacks
+    def test_create_url_batch_invalid(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        self.service.config['max_batch_size'] = 2
+
+        for payload in [
+                {'urls': {'long_url': 'foo'}},
+                {'urls': [{'long_url': 'foo', 'extra': 'bar'}]},
+                {'urls': [{'long_url': 1}]},
+                {'urls': [{'long_url': 'a', 'user_token': 1}]},
+                {'urls': [{'long_url': 'a', 'user_token': ['b']}]},
+                {'urls': [{'long_url': 'a'}, {'long_url': 'b'},
+                          {'long_url': 'c'}]}]:
+            resp = yield treq.put(
+                self.make_url('/api/create/batch'),
+                data=json.dumps(payload),
+                allow_redirects=False,
+                pool=self.pool)
+            self.assertEqual(resp.code, 400)
+
     @inlineCallbacks
     def test_resolve_url_simple(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -129,11 +224,20 @@ class TestShortenerServiceApp(TestCase):
         self.assertEqual(resp.code, 301)
         [location] = resp.headers.getRawHeaders('location')
         self.assertEqual(location, url)
+        body = yield treq.content(resp)
+        self.assertEqual(body, '')
 
         conn_queue = self.tr.value().splitlines()
         self.assertTrue(
             conn_queue[1].startswith("test-account.wtxtio.expanded.count 1"))
 
+        # HEAD requests still go through the app's routes.
+        resp = yield treq.head(
+            self.make_url('/qr0'),
+            allow_redirects=False,
+            pool=self.pool)
+        self.assertEqual(resp.code, 301)
+
     @inlineCallbacks
     def test_resolve_url_404(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -154,6 +258,80 @@ class TestShortenerServiceApp(TestCase):
         self.assertTrue(
             conn_queue[1].startswith("test-account.wtxtio.invalid.count 1"))
 
+    @inlineCallbacks
+    def test_resolve_invalid_token(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        def fail_connect():
+            self.fail('invalid tokens should not touch the database')
+        self.patch(self.service.engine, 'connect', fail_connect)
+
+        for token in ['q', 'qr-', 'XRYq']:
+            resp = yield treq.get(
+                self.make_url('/%s' % (token,)),
+                allow_redirects=False,
+                pool=self.pool)
+            self.assertEqual(resp.code, 404)
+
+    def start_short_url_filter(self):
+        short_url_filter = ShortUrlFilter(
+            reactor, self.service.load_short_urls,
+            self.service.load_id_ceiling, 100)
+        short_url_filter.startService()
+        self.addCleanup(short_url_filter.stopService)
+        self.service.short_url_filter = short_url_filter
+        return short_url_filter.load_d
+
+    @inlineCallbacks
+    def test_resolve_url_bloom_filter(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url + '1')
+        yield self.service.shorten_url(url + '2')
+        yield self.service.shorten_url(url + '3')
+
+        yield self.start_short_url_filter()
+        # Trusted up to the last id reserved, not just the last one used.
+        counter = yield ShortenerTables(
+            self.account, self.conn).get_id_counter()
+        self.assertEqual(self.service.short_url_filter.max_id, counter)
+        yield self.service.shorten_url(url + '4')
+
+        connect = self.service.engine.connect
+        connects = []
+
+        def count_connect():
+            connects.append(True)
+            return connect()
+        self.patch(self.service.engine, 'connect', count_connect)
+
+        # Issued before and after loading.
+        for row_id in [1, 4]:
+            row = yield self.service.get_row_by_short_url(
+                generate_token(row_id))
+            self.assertEqual(row['long_url'], url + str(row_id))
+        self.assertEqual(len(connects), 2)
+
+        # Delete the second url and reload, its short url is now known
+        # not to exist.
+        urls = ShortenerTables(self.account, self.conn).urls
+        yield self.conn.execute(urls.delete().where(urls.c.id == 2))
+        yield self.start_short_url_filter()
+        del connects[:]
+
+        row = yield self.service.get_row_by_short_url(generate_token(2))
+        self.assertEqual(row, None)
+        self.assertEqual(connects, [])
+
+    @inlineCallbacks
+    def test_settled_id(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        settled = yield self.service.load_settled_id()
+        self.assertEqual(settled, None)
+        yield self.service.save_settled_id(41)
+        settled = yield self.service.load_settled_id()
+        self.assertEqual(settled, 41)
+
     @inlineCallbacks
     def test_url_shortening(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -205,6 +383,43 @@ class TestShortenerServiceApp(TestCase):
         result = yield self.service.get_row_by_short_url('qH0')
         self.assertEqual(result['long_url'], url + '4')
 
+    @inlineCallbacks
+    def test_concurrent_lookups(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+
+        connects = []
+        connect = self.service.engine.connect
+        self.patch(self.service.engine, 'connect',
+                   lambda: connects.append(1) or connect())
+        rows = yield gatherResults([
+            self.service.get_row_by_short_url('qr0') for _ in range(5)])
+        self.assertEqual([row['long_url'] for row in rows], [url] * 5)
+        self.assertEqual(len(connects), 1)
+        self.assertEqual(self.service.lookups.coalesced, 4)
+        # Every lookup is still a hit.
+        self.assertEqual(self.service.hits.pending, {1: 5})
+
+    @inlineCallbacks
+    def test_concurrent_creates(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        connects = []
+        connect = self.service.engine.connect
+        self.patch(self.service.engine, 'connect',
+                   lambda: connects.append(1) or connect())
+        short_urls = yield gatherResults(
+            [self.service.shorten_url(url) for _ in range(3)] +
+            [self.service.shorten_url(url, 'other-user')])
+        self.assertEqual(short_urls, ['http://wtxt.io/qr0'] * 3 + [
+            'http://wtxt.io/' + generate_token(2)])
+        # One for each distinct url and one to reserve a block of ids.
+        self.assertEqual(len(connects), 3)
+        self.assertEqual(self.service.creates.coalesced, 2)
+        self.assertEqual(len(self.service.creates), 0)
+        self.assertEqual(len(self.tr.value().splitlines()), 2)
+
     @inlineCallbacks
     def test_resolve_url_hits_counter(self):
         tables = ShortenerTables(self.account, self.conn)
@@ -217,9 +432,213 @@ class TestShortenerServiceApp(TestCase):
         yield self.service.get_row_by_short_url('qr0')
         result = yield self.service.get_row_by_short_url('qr0')
 
+        audit = yield tables.get_audit_row(result['id'])
+        self.assertEqual(audit['hits'], 0)
+        self.assertEqual(self.service.hits.pending, {result['id']: 3})
+
+        yield self.service.hits.flush()
         audit = yield tables.get_audit_row(result['id'])
         self.assertEqual(audit['hits'], 3)
 
+    @inlineCallbacks
+    def test_resolve_url_hits_counter_cached(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield tables.create_tables()
+        self.service.redirect_cache = LRUCache(10)
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+
+        yield self.service.get_row_by_short_url('qr0')
+        result = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(self.service.redirect_cache.hits, 2)
+
+        yield self.service.hits.flush()
+        audit = yield tables.get_audit_row(result['id'])
+        self.assertEqual(audit['hits'], 2)
+
+    @inlineCallbacks
+    def test_resolve_url_from_cache(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield tables.create_tables()
+        self.service.redirect_cache = LRUCache(10)
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+        self.assertTrue('qr0' in self.service.redirect_cache)
+
+        def fail_connect():
+            self.fail('cache hit should not touch the database')
+        self.patch(self.service.engine, 'connect', fail_connect)
+
+        resp = yield treq.get(
+            self.make_url('/qr0'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 301)
+        [location] = resp.headers.getRawHeaders('location')
+        self.assertEqual(location, url)
+        self.assertEqual(self.service.redirect_cache.hits, 1)
+
+    @inlineCallbacks
+    def test_resolve_url_fills_cache(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+        self.service.redirect_cache = LRUCache(10)
+
+        row = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(self.service.redirect_cache.misses, 1)
+        cached = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(self.service.redirect_cache.hits, 1)
+        self.assertEqual(cached['long_url'], row['long_url'])
+        self.assertEqual(cached['id'], row['id'])
+
+    @inlineCallbacks
+    def test_shared_cache(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        shared_cache = self.service.shared_cache = MemoryCacheBackend()
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+        yield self.service.shorten_urls([(url + '1', None), (url, None)])
+        self.assertEqual(shared_cache.stats()['size'], 4)
+
+        # Another process sharing the cache doesn't need the database for
+        # urls that were created or looked up by this one.
+        self.service.redirect_cache = LRUCache(10)
+
+        def fail_connect():
+            self.fail('shared cache hits should not touch the database')
+        self.patch(self.service.engine, 'connect', fail_connect)
+
+        row = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(row['long_url'], url)
+        self.assertTrue('qr0' in self.service.redirect_cache)
+        self.assertEqual(self.service.hits.pending, {row['id']: 1})
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/qr0')
+        short_urls = yield self.service.shorten_urls(
+            [(url, None), (url + '1', None)])
+        self.assertEqual(short_urls, [
+            'http://wtxt.io/qr0', 'http://wtxt.io/' + generate_token(2)])
+
+    @inlineCallbacks
+    def test_shared_cache_filled_on_lookup(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+
+        shared_cache = self.service.shared_cache = MemoryCacheBackend()
+        self.service.redirect_cache = LRUCache(10)
+        yield self.service.get_row_by_short_url('qr0')
+        shared = yield shared_cache.get_many(
+            [self.service.short_url_key('qr0')])
+        self.assertEqual(shared.values(), [
+            {'id': 1, 'short_url': 'qr0', 'long_url': url}])
+
+    @inlineCallbacks
+    def test_read_replicas(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+        yield self.service.shorten_url(url + '1')
+
+        # The replica hasn't caught up with the second url yet.
+        replica = get_engine('sqlite:///%s' % (self.mktemp(),), reactor)
+        self.addCleanup(replica.stop)
+        conn = yield replica.connect()
+        tables = ShortenerTables(self.account, conn)
+        yield tables.create_tables()
+        yield tables.get_or_create_short_url('en.wikipedia.org', '', url)
+        yield conn.close()
+
+        self.service.shards[0].read_engine = ReplicaPool([replica])
+        connects = []
+        for name, engine in [('primary', self.service.engine),
+                             ('replica', replica)]:
+            self.patch(engine, 'connect', lambda name=name, connect=(
+                engine.connect): connects.append(name) or connect())
+
+        row = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(row['long_url'], url)
+        self.assertEqual(connects, ['replica'])
+
+        del connects[:]
+        row = yield self.service.get_row_by_short_url(generate_token(2))
+        self.assertEqual(row['long_url'], url + '1')
+        self.assertEqual(connects, ['replica', 'primary'])
+
+        # Hits are still written to the primary.
+        del connects[:]
+        yield self.service.hits.flush()
+        self.assertEqual(connects, ['primary'])
+
+        # Lookups go to the primary while the replica is down.
+        self.patch(replica, 'connect', lambda: fail(ValueError('down')))
+        self.service.redirect_cache = LRUCache(10)
+        row = yield self.service.get_row_by_short_url('qr0')
+        self.assertEqual(row['long_url'], url)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_make_read_engine(self):
+        self.assertIdentical(
+            make_read_engine({}, self.service.engine, None),
+            self.service.engine)
+        read_engine = make_read_engine({
+            'read_connection_strings': ['sqlite://', 'sqlite:///replica'],
+            'read_replica_policy': LEAST_LOADED,
+        }, self.service.engine, lambda connection_string: connection_string)
+        self.assertEqual(
+            read_engine.engines, ['sqlite://', 'sqlite:///replica'])
+        self.assertEqual(read_engine.policy, LEAST_LOADED)
+
+    @inlineCallbacks
+    def test_create_cache(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        self.service.create_cache = LRUCache(10)
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url)
+        yield self.service.shorten_urls([(url + '1', 'user')])
+
+        connect = self.service.engine.connect
+
+        def fail_connect():
+            self.fail('repeated creates should not touch the database')
+        self.patch(self.service.engine, 'connect', fail_connect)
+
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/qr0')
+        short_urls = yield self.service.shorten_urls(
+            [(url, None), (url + '1', 'user')])
+        self.assertEqual(short_urls, [
+            'http://wtxt.io/qr0', 'http://wtxt.io/' + generate_token(2)])
+        self.assertEqual(self.service.create_cache.hits, 3)
+
+        # Only the urls that aren't cached are looked up.
+        self.patch(self.service.engine, 'connect', connect)
+        short_urls = yield self.service.shorten_urls(
+            [(url + '2', None), (url, None)])
+        self.assertEqual(short_urls, [
+            'http://wtxt.io/' + generate_token(3), 'http://wtxt.io/qr0'])
+
+    @inlineCallbacks
+    def test_create_cache_filled_on_lookup(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url, 'user')
+
+        self.service.create_cache = LRUCache(10)
+        yield self.service.get_row_by_short_url('qr0')
+
+        def fail_connect():
+            self.fail('looked up urls should not be looked up again')
+        self.patch(self.service.engine, 'connect', fail_connect)
+        short_url = yield self.service.shorten_url(url, 'user')
+        self.assertEqual(short_url, 'http://wtxt.io/qr0')
+
     @inlineCallbacks
     def test_short_url_sequencing(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -238,6 +657,107 @@ class TestShortenerServiceApp(TestCase):
         conn_queue = self.tr.value().splitlines()
         self.assertEqual(len(conn_queue), 9)
 
+    @inlineCallbacks
+    def test_shorten_with_reserved_ids(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield tables.create_tables()
+        shard = self.service.shards[0]
+        shard.id_allocator = IdAllocator(
+            reactor, partial(self.service.reserve_ids, shard), 10)
+        # Another process has already reserved the first block.
+        yield tables.reserve_ids(10)
+
+        def fail_update(*args, **kw):
+            self.fail('short urls should be inserted with their rows')
+        self.patch(ShortenerTables, 'update_short_url', fail_update)
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/' + generate_token(11))
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/' + generate_token(11))
+        short_urls = yield self.service.shorten_urls(
+            [(url + '1', None), (url, None)])
+        self.assertEqual(short_urls[1], 'http://wtxt.io/' + generate_token(11))
+        self.assertEqual(short_urls[0], 'http://wtxt.io/' + generate_token(12))
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 20)
+
+    @inlineCallbacks
+    def test_shorten_with_taken_reserved_ids(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield tables.create_tables()
+        shard = self.service.shards[0]
+        shard.id_allocator = IdAllocator(
+            reactor, partial(self.service.reserve_ids, shard), 2)
+        # Rows inserted with ids assigned by the database, which the counter
+        # doesn't know about.
+        for row_id in (1, 4):
+            yield tables.execute_query(tables.urls.insert().values(
+                id=row_id, domain='wiki.org', user_token='', hash=str(row_id)))
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/' + generate_token(2))
+        short_urls = yield self.service.shorten_urls(
+            [(url + '1', None), (url + '2', None)])
+        self.assertEqual(sorted(short_urls), sorted([
+            'http://wtxt.io/' + generate_token(5),
+            'http://wtxt.io/' + generate_token(6)]))
+
+    @inlineCallbacks
+    def test_shorten_with_reserved_ids_unmigrated(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield TableCollection.create_tables(tables)
+        shard = self.service.shards[0]
+        shard.id_allocator = IdAllocator(
+            reactor, partial(self.service.reserve_ids, shard), 10)
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        short_url = yield self.service.shorten_url(url)
+        self.assertEqual(short_url, 'http://wtxt.io/' + generate_token(1))
+        short_urls = yield self.service.shorten_urls([(url + '1', None)])
+        self.assertEqual(short_urls, ['http://wtxt.io/' + generate_token(2)])
+
+    @inlineCallbacks
+    def test_warm_up(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield tables.create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        for i in range(3):
+            yield self.service.shorten_url(url + str(i))
+        yield tables.update_hits({1: 1, 2: 5, 3: 3})
+
+        self.service.redirect_cache = LRUCache(2)
+        count = yield self.service.warm_up(10)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            self.service.redirect_cache.get(generate_token(2))['long_url'],
+            url + '1')
+        self.assertTrue(generate_token(3) in self.service.redirect_cache)
+        self.assertFalse(generate_token(1) in self.service.redirect_cache)
+
+        # The most recent hits are used when there are rollups.
+        yield tables.update_hit_rollups({(1, reactor.seconds()): 1})
+        self.service.redirect_cache = LRUCache(10)
+        count = yield self.service.warm_up(10, window=3600)
+        self.assertEqual(count, 1)
+        self.assertTrue(generate_token(1) in self.service.redirect_cache)
+
+        self.service.redirect_cache = LRUCache(0)
+        count = yield self.service.warm_up(10)
+        self.assertEqual(count, 0)
+
+    @inlineCallbacks
+    def test_flush_rollups_unmigrated(self):
+        tables = ShortenerTables(self.account, self.conn)
+        yield TableCollection.create_tables(tables)
+
+        def fail_update(*args, **kw):
+            self.fail('unmigrated accounts have no rollups table')
+        self.patch(ShortenerTables, 'update_hit_rollups', fail_update)
+        yield self.service.flush_rollups({(1, 0): 1})
+
     @inlineCallbacks
     def test_account_init(self):
         resp = yield treq.get(
@@ -246,3 +766,24 @@ class TestShortenerServiceApp(TestCase):
             pool=self.pool)
         result = yield treq.json_content(resp)
         self.assertTrue(result['created'])
+
+    @inlineCallbacks
+    def test_account_migrate(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        resp = yield treq.put(
+            self.make_url('/api/migrate'),
+            allow_redirects=False,
+            pool=self.pool)
+        self.assertEqual(resp.code, 200)
+        result = yield treq.json_content(resp)
+        self.assertEqual(result['from_version'], SCHEMA_VERSION)
+        self.assertEqual(result['to_version'], SCHEMA_VERSION)
+
+    @inlineCallbacks
+    def test_account_migrate_missing_account(self):
+        resp = yield treq.put(
+            self.make_url('/api/migrate'),
+            allow_redirects=False,
+            pool=self.pool)
+        self.assertEqual(resp.code, 404)
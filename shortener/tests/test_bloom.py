@@ -0,0 +1,215 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from shortener.bloom import BloomFilter, ShortUrlFilter
+from shortener.keygen import generate_token
+
+
+class TestBloomFilter(TestCase):
+    timeout = 1
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.num_bits, 9586)
+        self.assertEqual(bloom.num_hashes, 7)
+
+    def test_invalid_parameters(self):
+        self.assertRaises(ValueError, BloomFilter, 0)
+        self.assertRaises(ValueError, BloomFilter, 10, 0)
+        self.assertRaises(ValueError, BloomFilter, 10, 1)
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        tokens = [generate_token(i) for i in range(1000)]
+        for token in tokens:
+            bloom.add(token)
+        for token in tokens:
+            self.assertTrue(token in bloom)
+        self.assertTrue(u'qr0' in bloom)
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(generate_token(i))
+        false_positives = sum(
+            1 for i in range(1000, 11000) if generate_token(i) in bloom)
+        self.assertTrue(false_positives < 200, false_positives)
+
+    def test_fill_ratio(self):
+        bloom = BloomFilter(1000, 0.01)
+        self.assertEqual(bloom.fill_ratio(), 0.0)
+        bloom.add('qr0')
+        self.assertEqual(bloom.fill_ratio(), 7.0 / bloom.num_bits)
+        bloom.add('qr0')
+        self.assertEqual(bloom.fill_ratio(), 7.0 / bloom.num_bits)
+        for i in range(1000):
+            bloom.add(generate_token(i))
+        # Half the bits are set once the filter is at capacity.
+        self.assertTrue(0.45 < bloom.fill_ratio() < 0.55)
+
+
+class TestShortUrlFilter(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+        self.rows = [(i, generate_token(i)) for i in range(1, 6)]
+        self.ceiling = 5
+        self.ratios = []
+
+    def load_short_urls(self, after_id, limit):
+        rows = [row for row in self.rows
+                if after_id is None or row[0] > after_id]
+        return succeed(rows[:limit])
+
+    def load_id_ceiling(self):
+        return succeed(self.ceiling)
+
+    def make_filter(self):
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            page_size=2, report_fill_ratio=self.ratios.append,
+            report_interval=10)
+        self.addCleanup(short_url_filter.stopService)
+        return short_url_filter
+
+    def test_load(self):
+        short_url_filter = self.make_filter()
+        self.assertFalse(short_url_filter.loaded)
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(9), 9))
+
+        short_url_filter.startService()
+        self.assertTrue(short_url_filter.loaded)
+        self.assertEqual(short_url_filter.max_id, 5)
+        self.assertEqual(short_url_filter.bloom.count, 5)
+        for row_id, short_url in self.rows:
+            self.assertFalse(
+                short_url_filter.definitely_missing(short_url, row_id))
+
+    def test_only_trusted_up_to_id_ceiling(self):
+        self.rows = [row for row in self.rows if row[0] != 3]
+        short_url_filter = self.make_filter()
+        short_url_filter.startService()
+
+        self.assertTrue(
+            short_url_filter.definitely_missing(generate_token(3), 3))
+        # Newer urls may have been created by another process.
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(6), 6))
+
+    def test_empty_table(self):
+        self.rows = []
+        self.ceiling = 0
+        short_url_filter = self.make_filter()
+        short_url_filter.startService()
+        self.assertEqual(short_url_filter.max_id, 0)
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(1), 1))
+
+    def test_load_up_to_id_ceiling(self):
+        # Ids up to 8 were reserved, but 4 and 5 weren't inserted in order.
+        self.rows = [row for row in self.rows if row[0] not in (4, 5)]
+        self.ceiling = 8
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            settle_delay=30)
+        self.addCleanup(short_url_filter.stopService)
+        short_url_filter.startService()
+
+        self.rows.append((4, generate_token(4)))
+        self.clock.advance(29)
+        self.assertFalse(short_url_filter.loaded)
+        self.clock.advance(1)
+        self.assertTrue(short_url_filter.loaded)
+        self.assertEqual(short_url_filter.max_id, 8)
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(4), 4))
+        self.assertTrue(
+            short_url_filter.definitely_missing(generate_token(5), 5))
+        self.assertTrue(
+            short_url_filter.definitely_missing(generate_token(8), 8))
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(9), 9))
+
+    def test_ready_before_settling(self):
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            settle_delay=30)
+        self.addCleanup(short_url_filter.stopService)
+        short_url_filter.startService()
+        self.successResultOf(short_url_filter.ready_d)
+        self.assertFalse(short_url_filter.loaded)
+
+    def test_load_from_settled_id(self):
+        # Ids up to 3 were known to be settled, 4 is still being inserted.
+        self.rows = [row for row in self.rows if row[0] not in (2, 4)]
+        self.ceiling = 8
+        saved = []
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            settle_delay=30, load_settled_id=lambda: succeed(3),
+            save_settled_id=saved.append)
+        self.addCleanup(short_url_filter.stopService)
+        short_url_filter.startService()
+
+        self.successResultOf(short_url_filter.ready_d)
+        self.assertEqual(short_url_filter.max_id, 3)
+        self.assertTrue(
+            short_url_filter.definitely_missing(generate_token(2), 2))
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(4), 4))
+
+        self.rows.append((4, generate_token(4)))
+        self.clock.advance(30)
+        self.assertEqual(short_url_filter.max_id, 8)
+        self.assertEqual(short_url_filter.bloom.count, 5)
+        self.assertFalse(
+            short_url_filter.definitely_missing(generate_token(4), 4))
+        self.assertTrue(
+            short_url_filter.definitely_missing(generate_token(6), 6))
+        self.assertEqual(saved, [8])
+
+    def test_no_settled_id(self):
+        saved = []
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            settle_delay=30, load_settled_id=lambda: succeed(None),
+            save_settled_id=saved.append)
+        self.addCleanup(short_url_filter.stopService)
+        short_url_filter.startService()
+        self.assertFalse(short_url_filter.loaded)
+        self.clock.advance(30)
+        self.assertEqual(short_url_filter.max_id, 5)
+        self.assertEqual(saved, [5])
+
+    def test_stop_while_settling(self):
+        short_url_filter = ShortUrlFilter(
+            self.clock, self.load_short_urls, self.load_id_ceiling, 100,
+            settle_delay=30)
+        short_url_filter.startService()
+        short_url_filter.stopService()
+        self.assertFalse(short_url_filter.loaded)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_load_failure(self):
+        def fail(after_id, limit):
+            raise ValueError('boom')
+        short_url_filter = ShortUrlFilter(
+            self.clock, fail, self.load_id_ceiling, 100)
+        short_url_filter.startService()
+        short_url_filter.stopService()
+        self.assertFalse(short_url_filter.loaded)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_report_fill_ratio(self):
+        short_url_filter = self.make_filter()
+        short_url_filter.startService()
+        ratio = short_url_filter.bloom.fill_ratio()
+        self.assertEqual(self.ratios, [ratio])
+        self.clock.advance(10)
+        self.assertEqual(self.ratios, [ratio, ratio])
+        short_url_filter.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,67 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from shortener.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_get_set(self):
+        cache = LRUCache(2, clock=self.clock)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_update_existing_key(self):
+        cache = LRUCache(2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('a', 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_ttl_expiry(self):
+        cache = LRUCache(2, ttl=10, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(9)
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_disabled(self):
+        cache = LRUCache(0, clock=self.clock)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(3, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('c'), 3)
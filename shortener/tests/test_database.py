@@ -0,0 +1,251 @@
+import os
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from twisted.trial.unittest import TestCase
+from sqlalchemy import create_engine
+
+from shortener.database import (
+    get_engine, BufferedResult, ReplicaPool, LEAST_LOADED, ROUND_ROBIN,
+    POOLED_STRATEGY)
+from shortener.models import ShortenerTables
+
+
+class TestPooledEngine(TestCase):
+    timeout = 5
+
+    def make_engine(self, connection_string, pool_size):
+        engine = get_engine(connection_string, reactor, pool_size=pool_size)
+        self.addCleanup(engine.stop)
+        return engine
+
+    @inlineCallbacks
+    def test_memory_sqlite_uses_one_lane(self):
+        engine = self.make_engine('sqlite://', 4)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+        self.assertEqual(len(engine._lanes), 1)
+        yield conn1.close()
+        yield conn2.close()
+
+    @inlineCallbacks
+    def test_lane_per_connection(self):
+        engine = self.make_engine('sqlite:///%s' % (self.mktemp(),), 1)
+        conns = yield gatherResults([engine.connect() for _ in range(3)])
+        self.assertEqual(
+            [lane.connections for lane in engine._lanes], [1, 1, 1])
+        yield conns[0].close()
+        conn = yield engine.connect()
+        self.assertIdentical(conn._lane, conns[0]._lane)
+        yield gatherResults([c.close() for c in conns[1:] + [conn]])
+
+    @inlineCallbacks
+    def test_lock_wait_does_not_block_commit(self):
+        engine = self.make_engine('sqlite:///%s' % (self.mktemp(),), 1)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+        yield conn1.execute('CREATE TABLE t (x INTEGER)')
+
+        trx1 = yield conn1.begin()
+        yield conn1.execute('INSERT INTO t VALUES (1)')
+        trx2 = yield conn2.begin()
+        # Waits for the first transaction's lock.
+        inserted = conn2.execute('INSERT INTO t VALUES (2)')
+        yield trx1.commit()
+        yield inserted
+        yield trx2.commit()
+
+        result = yield conn1.execute('SELECT count(*) FROM t')
+        count = yield result.scalar()
+        self.assertEqual(count, 2)
+        yield conn1.close()
+        yield conn2.close()
+
+    @inlineCallbacks
+    def test_connections_use_separate_lanes(self):
+        engine = self.make_engine('sqlite:///%s' % (self.mktemp(),), 2)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+        self.assertNotIdentical(conn1._lane, conn2._lane)
+        self.assertEqual([lane.connections for lane in engine._lanes], [1, 1])
+
+        yield conn1.close()
+        yield conn2.close()
+        self.assertEqual([lane.connections for lane in engine._lanes], [0, 0])
+
+    @inlineCallbacks
+    def test_concurrent_queries(self):
+        engine = self.make_engine('sqlite:///%s' % (self.mktemp(),), 2)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+
+        # Block the first connection's thread; the second connection should
+        # still be able to run queries.
+        event = threading.Event()
+        blocked = conn1._lane.run(event.wait, 5)
+        result = yield conn2.execute('SELECT 1')
+        row = yield result.fetchone()
+        self.assertEqual(row[0], 1)
+        self.assertNoResult(blocked)
+
+        event.set()
+        yield blocked
+        yield conn1.close()
+        yield conn2.close()
+
+    @inlineCallbacks
+    def test_result_timings(self):
+        engine = self.make_engine('sqlite://', 1)
+        conn = yield engine.connect()
+        result = yield conn.execute('SELECT 1')
+        self.assertTrue(result.queue_time >= 0)
+        self.assertTrue(result.execute_time >= 0)
+        yield conn.close()
+
+    @inlineCallbacks
+    def test_results_unbuffered(self):
+        engine = self.make_engine('sqlite:///%s' % (self.mktemp(),), 1)
+        conn = yield engine.connect()
+        result = yield conn.execute('SELECT 1 UNION SELECT 2')
+        self.assertFalse(isinstance(result, BufferedResult))
+        self.assertTrue(result.execute_time >= 0)
+        row = yield result.fetchone()
+        self.assertEqual(row[0], 1)
+        rows = yield result.fetchall()
+        self.assertEqual([row[0] for row in rows], [2])
+        yield conn.close()
+
+    @inlineCallbacks
+    def test_tables_across_connections(self):
+        connection_string = os.environ.get(
+            "SHORTENER_TEST_CONNECTION_STRING")
+        if connection_string is None:
+            connection_string = 'sqlite:///%s' % (self.mktemp(),)
+        engine = self.make_engine(connection_string, 3)
+        conns = yield gatherResults([engine.connect() for _ in range(3)])
+
+        tables = ShortenerTables('test-account', conns[0])
+        yield tables.create_tables()
+        try:
+            rows = yield gatherResults([
+                ShortenerTables('test-account', conn).get_or_create_row(
+                    'wiki.org', 'test', 'http://wiki.org/%s' % (i,))
+                for i, conn in enumerate(conns)])
+            self.assertEqual(
+                sorted(row['long_url'] for row in rows),
+                ['http://wiki.org/0', 'http://wiki.org/1',
+                 'http://wiki.org/2'])
+        finally:
+            # NOTE: This is a blocking operation!
+            tables._metadata.drop_all(bind=engine._engine)
+            tables._collection_metadata._metadata.drop_all(
+                bind=engine._engine)
+            yield gatherResults([conn.close() for conn in conns])
+
+    @inlineCallbacks
+    def test_results_survive_other_connections(self):
+        # All connections to an in-memory SQLite database share one DBAPI
+        # connection, so another connection's commit or close must not
+        # affect results or transactions that are still open.
+        engine = self.make_engine('sqlite://', 1)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+        yield conn1.execute('CREATE TABLE t (x INTEGER)')
+        yield conn1.execute('INSERT INTO t VALUES (1)')
+
+        trx = yield conn1.begin()
+        yield conn1.execute('INSERT INTO t VALUES (2)')
+        result = yield conn1.execute('SELECT x FROM t ORDER BY x')
+        other = yield engine.connect()
+        yield other.close()
+        trx2 = yield conn2.begin()
+        yield trx2.commit()
+
+        rows = yield result.fetchall()
+        self.assertEqual([row[0] for row in rows], [1, 2])
+        yield trx.commit()
+        result = yield conn2.execute('SELECT count(*) FROM t')
+        count = yield result.scalar()
+        self.assertEqual(count, 2)
+        yield conn1.close()
+        yield conn2.close()
+
+    @inlineCallbacks
+    def test_max_connections(self):
+        engine = create_engine(
+            'sqlite:///%s' % (self.mktemp(),), reactor=reactor,
+            strategy=POOLED_STRATEGY, lanes=2, max_connections=2)
+        self.addCleanup(engine.stop)
+        conn1 = yield engine.connect()
+        conn2 = yield engine.connect()
+        d = engine.connect()
+        self.assertNoResult(d)
+        self.assertEqual((engine.connections, engine.waiting), (2, 1))
+
+        yield conn1.close()
+        conn3 = yield d
+        self.assertEqual((engine.connections, engine.waiting), (2, 0))
+        yield conn2.close()
+        yield conn3.close()
+
+
+class FakeEngine(object):
+    def __init__(self, name, connections=0, pending=0):
+        self.name = name
+        self.connections = connections
+        self.pending = pending
+        self.stopped = False
+
+    def connect(self):
+        return self.name
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestReplicaPool(TestCase):
+    timeout = 5
+
+    def make_engine(self, connection_string):
+        engine = get_engine(connection_string, reactor, pool_size=1)
+        self.addCleanup(engine.stop)
+        return engine
+
+    def test_round_robin(self):
+        pool = ReplicaPool([FakeEngine('a'), FakeEngine('b')])
+        self.assertEqual(pool.policy, ROUND_ROBIN)
+        self.assertEqual(
+            [pool.connect() for _ in range(5)], ['a', 'b', 'a', 'b', 'a'])
+
+    def test_least_loaded(self):
+        engines = [FakeEngine('a', connections=2),
+                   FakeEngine('b', connections=1, pending=3),
+                   FakeEngine('c', connections=1)]
+        pool = ReplicaPool(engines, policy=LEAST_LOADED)
+        self.assertEqual(pool.connect(), 'c')
+        engines[2].pending = 4
+        self.assertEqual(pool.connect(), 'b')
+
+    @inlineCallbacks
+    def test_least_loaded_engines(self):
+        engines = [
+            self.make_engine('sqlite:///%s' % (self.mktemp(),))
+            for _ in range(2)]
+        pool = ReplicaPool(engines, policy=LEAST_LOADED)
+        conn1 = yield pool.connect()
+        conn2 = yield pool.connect()
+        self.assertEqual(
+            [engine.connections for engine in engines], [1, 1])
+        yield conn1.close()
+        yield conn2.close()
+
+    def test_stop(self):
+        engines = [FakeEngine('a'), FakeEngine('b')]
+        ReplicaPool(engines).stop()
+        self.assertEqual([engine.stopped for engine in engines], [True, True])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ReplicaPool, [])
+        self.assertRaises(
+            ValueError, ReplicaPool, [FakeEngine('a')], policy='random')
@@ -1,21 +1,34 @@
+import csv
 import json
 import os
 import treq
+from datetime import datetime, timedelta
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, fail
+from twisted.internet.task import Clock
 from twisted.web.client import HTTPConnectionPool
 from twisted.trial.unittest import TestCase
 from twisted.web.server import Site
 
 from aludel.database import MetaData
 from shortener.api import ShortenerServiceApp
+from shortener.database import get_engine
+from shortener.handlers.base import BaseApiHandler
 from shortener.models import ShortenerTables
 from shortener.metrics import CarbonClientService
 from shortener.tests.doubles import (
     DisconnectingStringTransport, StringTransportClientEndpoint)
 
 
+class LegacyHandler(BaseApiHandler):
+    def __init__(self, config, engine):
+        super(LegacyHandler, self).__init__(config, engine)
+
+    def render(self, request):
+        return {'shards': len(self.shards)}
+
+
 class TestHandlers(TestCase):
     timeout = 5
 
@@ -40,13 +53,16 @@ class TestHandlers(TestCase):
             'graphite_endpoint': 'tcp:www.example.com:80',
             'handlers': [
                 {'dump': 'shortener.handlers.dump.Dump'},
+                {'rollups': 'shortener.handlers.rollups.Rollups'},
             ],
+            'hit_rollups': True,
         }
         self.pool = HTTPConnectionPool(reactor, persistent=False)
         self.service = ShortenerServiceApp(
             reactor=reactor,
             config=cfg
         )
+        self.addCleanup(self.service.engine.stop)
 
         self.tr = DisconnectingStringTransport()
         endpoint = StringTransportClientEndpoint(reactor, self.tr)
@@ -54,7 +70,7 @@ class TestHandlers(TestCase):
         self.service.metrics.carbon_client.startService()
         yield self.service.metrics.carbon_client.connect_d
 
-        site = Site(self.service.app.resource())
+        site = Site(self.service.resource())
         self.listener = reactor.listenTCP(0, site, interface='localhost')
         self.listener_port = self.listener.getHost().port
         self._drop_tables()
@@ -65,6 +81,26 @@ class TestHandlers(TestCase):
     def make_url(self, path):
         return 'http://localhost:%s%s' % (self.listener_port, path)
 
+    def test_handler_with_engine_only(self):
+        self.service.config['handlers'].append(
+            {'legacy': 'shortener.tests.test_handlers.LegacyHandler'})
+        self.service.load_handlers()
+        handler = self.service.handlers['legacy']
+        self.assertIdentical(handler.shards, self.service.shards)
+        self.assertIdentical(
+            handler.read_engine, self.service.shards[0].read_engine)
+        self.assertIdentical(handler.tables, self.service.tables)
+        self.assertIdentical(handler.clock, self.service.clock)
+
+    def test_rollup_buckets_use_clock(self):
+        handler = self.service.handlers['rollups']
+        handler.clock = Clock()
+        handler.clock.advance(2 * 3600 + 90)
+        self.assertEqual(handler._buckets('minute', 2), [
+            datetime(1970, 1, 1, 2, 0), datetime(1970, 1, 1, 2, 1)])
+        self.assertEqual(handler._buckets('hour', 1), [
+            datetime(1970, 1, 1, 2, 0)])
+
     @inlineCallbacks
     def test_api_dump(self):
         yield ShortenerTables(self.account, self.conn).create_tables()
@@ -75,6 +111,7 @@ class TestHandlers(TestCase):
             self.make_url('/qr0'),
             allow_redirects=False,
             pool=self.pool)
+        yield self.service.hits.flush()
 
         resp = yield treq.get(
             self.make_url('/api/handler/dump?url=qr0'),
@@ -106,3 +143,220 @@ class TestHandlers(TestCase):
             pool=self.pool)
 
         self.assertEqual(resp.code, 400)
+
+    @inlineCallbacks
+    def test_api_dump_invalid_url(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump?url=qr-'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 404)
+
+    @inlineCallbacks
+    def test_api_dump_read_replica(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url, 'test-user')
+
+        # A replica that hasn't caught up with the url yet.
+        replica = get_engine('sqlite:///%s' % (self.mktemp(),), reactor)
+        self.addCleanup(replica.stop)
+        conn = yield replica.connect()
+        yield ShortenerTables(self.account, conn).create_tables()
+        yield conn.close()
+        self.service.handlers['dump'].shards[0].read_engine = replica
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump?url=qr0'),
+            allow_redirects=False,
+            pool=self.pool)
+        self.assertEqual(resp.code, 200)
+        result = yield treq.json_content(resp)
+        self.assertEqual(result['long_url'], url)
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export'),
+            allow_redirects=False,
+            pool=self.pool)
+        body = yield treq.content(resp)
+        self.assertEqual(body, '')
+
+    @inlineCallbacks
+    def test_api_rollups(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu'
+        yield self.service.shorten_url(url, 'test-user')
+        for _ in range(3):
+            yield treq.get(
+                self.make_url('/qr0'),
+                allow_redirects=False,
+                pool=self.pool)
+        yield self.service.hits.flush()
+
+        for resolution, seconds in [('minute', 60), ('hour', 3600)]:
+            resp = yield treq.get(
+                self.make_url(
+                    '/api/handler/rollups?url=qr0&resolution=%s&buckets=2' % (
+                        resolution,)),
+                allow_redirects=False,
+                pool=self.pool)
+            self.assertEqual(resp.code, 200)
+            result = yield treq.json_content(resp)
+            self.assertEqual(result['short_url'], 'qr0')
+            self.assertEqual(result['resolution'], resolution)
+            [first, last] = result['buckets']
+            # The hits may have been counted just before a new bucket began.
+            self.assertEqual(first['hits'] + last['hits'], 3)
+            self.assertEqual(
+                datetime.strptime(last['start'], '%Y-%m-%dT%H:%M:%S') -
+                datetime.strptime(first['start'], '%Y-%m-%dT%H:%M:%S'),
+                timedelta(seconds=seconds))
+
+    @inlineCallbacks
+    def test_api_rollups_read_replica(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        yield self.service.shorten_url('http://example.org/', 'test-user')
+
+        # A replica that hasn't caught up with the url yet.
+        replica = get_engine('sqlite:///%s' % (self.mktemp(),), reactor)
+        self.addCleanup(replica.stop)
+        conn = yield replica.connect()
+        yield ShortenerTables(self.account, conn).create_tables()
+        yield conn.close()
+        shard = self.service.handlers['rollups'].shards[0]
+        shard.read_engine = replica
+
+        url = self.make_url('/api/handler/rollups?url=qr0')
+        resp = yield treq.get(url, allow_redirects=False, pool=self.pool)
+        self.assertEqual(resp.code, 200)
+
+        # Or one that's down.
+        self.patch(replica, 'connect', lambda: fail(ValueError('down')))
+        resp = yield treq.get(url, allow_redirects=False, pool=self.pool)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_api_rollups_invalid(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        yield self.service.shorten_url('http://example.org/', 'test-user')
+
+        for query, code in [('', 400),
+                            ('?url=qr0&resolution=day', 400),
+                            ('?url=qr0&buckets=0', 400),
+                            ('?url=qr0&buckets=x', 400),
+                            ('?url=qr-', 404),
+                            ('?url=qH0', 404)]:
+            resp = yield treq.get(
+                self.make_url('/api/handler/rollups' + query),
+                allow_redirects=False,
+                pool=self.pool)
+            self.assertEqual(resp.code, code, query)
+            result = yield treq.json_content(resp)
+            self.assertTrue('error' in result)
+
+    @inlineCallbacks
+    def test_api_dump_export_ndjson(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+        self.service.config['export_page_size'] = 2
+
+        urls = ['http://en.wikipedia.org/wiki/%s' % i for i in range(5)]
+        for url in urls:
+            yield self.service.shorten_url(url, 'test-user')
+        yield treq.get(
+            self.make_url('/qr0'),
+            allow_redirects=False,
+            pool=self.pool)
+        yield self.service.hits.flush()
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(
+            resp.headers.getRawHeaders('Content-Type'),
+            ['application/x-ndjson'])
+        content = yield treq.content(resp)
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['long_url'] for row in rows], urls)
+        self.assertEqual(rows[0]['short_url'], 'qr0')
+        self.assertEqual(rows[0]['hits'], 1)
+        self.assertEqual(rows[1]['hits'], 0)
+        self.assertEqual(rows[0]['user_token'], 'test-user')
+        self.assertEqual(rows[0]['domain'], 'en.wikipedia.org')
+
+    @inlineCallbacks
+    def test_api_dump_export_csv(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        url = 'http://en.wikipedia.org/wiki/Cthulhu,_Cthulhu'
+        yield self.service.shorten_url(url, 'test-user')
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export?format=csv'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 200)
+        content = yield treq.content(resp)
+        header, row = csv.reader(content.splitlines())
+        self.assertEqual(header, [
+            'domain', 'user_token', 'short_url', 'long_url', 'created_at',
+            'hits'])
+        self.assertEqual(
+            row[:4], ['en.wikipedia.org', 'test-user', 'qr0', url])
+        self.assertEqual(row[5], '0')
+
+    @inlineCallbacks
+    def test_api_dump_export_empty(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 200)
+        content = yield treq.content(resp)
+        self.assertEqual(content, '')
+
+    @inlineCallbacks
+    def test_api_dump_export_invalid_format(self):
+        yield ShortenerTables(self.account, self.conn).create_tables()
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export?format=xml'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 400)
+        result = yield treq.json_content(resp)
+        self.assertEqual(result['error'], 'format must be one of: csv, ndjson')
+
+    @inlineCallbacks
+    def test_api_dump_export_missing_account(self):
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 404)
+        result = yield treq.json_content(resp)
+        self.assertEqual(
+            result['error'], 'Account "%s" does not exist' % (self.account,))
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    @inlineCallbacks
+    def test_api_export_unknown_handler(self):
+        resp = yield treq.get(
+            self.make_url('/api/handler/foo/export'),
+            allow_redirects=False,
+            pool=self.pool)
+
+        self.assertEqual(resp.code, 404)
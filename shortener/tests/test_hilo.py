@@ -0,0 +1,111 @@
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from shortener.hilo import IdAllocator
+
+
+class TestIdAllocator(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+        self.next_id = 1
+        self.reserved = []
+
+    def reserve_ids(self, count):
+        self.reserved.append(count)
+        first_id, self.next_id = self.next_id, self.next_id + count
+        return succeed(first_id)
+
+    def test_allocate(self):
+        allocator = IdAllocator(self.clock, self.reserve_ids, block_size=3)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [1])
+        self.assertEqual(self.successResultOf(allocator.allocate(2)), [2, 3])
+        self.assertEqual(self.reserved, [3])
+        self.assertEqual(self.successResultOf(allocator.allocate()), [4])
+        self.assertEqual(self.reserved, [3, 3])
+
+    def test_allocate_more_than_block(self):
+        allocator = IdAllocator(self.clock, self.reserve_ids, block_size=3)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [1])
+        self.assertEqual(
+            self.successResultOf(allocator.allocate(5)), [2, 3, 4, 5, 6])
+        self.assertEqual(self.reserved, [3, 3])
+
+    def test_concurrent_allocations_share_reservation(self):
+        pending = []
+
+        def reserve_ids(count):
+            pending.append((count, Deferred()))
+            return pending[-1][1]
+
+        allocator = IdAllocator(self.clock, reserve_ids, block_size=4)
+        d1 = allocator.allocate(2)
+        d2 = allocator.allocate(1)
+        self.assertEqual(len(pending), 1)
+        pending[0][1].callback(1)
+        self.assertEqual(self.successResultOf(d1), [1, 2])
+        self.assertEqual(self.successResultOf(d2), [3])
+
+    def test_blocks_expire(self):
+        allocator = IdAllocator(
+            self.clock, self.reserve_ids, block_size=3, block_ttl=10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [1])
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [4])
+
+    def test_blocks_shrink_when_unused(self):
+        allocator = IdAllocator(
+            self.clock, self.reserve_ids, block_size=8, block_ttl=10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [1])
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [9])
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [13])
+        self.assertEqual(self.reserved, [8, 4, 2])
+
+        # Blocks grow back as they're used up.
+        self.assertEqual(self.successResultOf(allocator.allocate(3)),
+                         [14, 15, 16])
+        self.assertEqual(self.reserved, [8, 4, 2, 2])
+        self.assertEqual(self.successResultOf(allocator.allocate(4)),
+                         [17, 18, 19, 20])
+        self.assertEqual(self.reserved, [8, 4, 2, 2, 8])
+
+    def test_release(self):
+        allocator = IdAllocator(
+            self.clock, self.reserve_ids, block_size=3, block_ttl=10)
+        self.assertEqual(self.successResultOf(allocator.allocate(2)), [1, 2])
+        allocator.release([2, 1])
+        self.assertEqual(
+            self.successResultOf(allocator.allocate(3)), [1, 2, 3])
+
+        # Released ids expire with the block they came from.
+        self.assertEqual(self.successResultOf(allocator.allocate()), [4])
+        self.clock.advance(5)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [5])
+        allocator.release([4, 5])
+        self.clock.advance(5)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [7])
+
+    def test_unsupported(self):
+        results = [None, 1]
+
+        def reserve_ids(count):
+            self.reserved.append(count)
+            return succeed(results.pop(0))
+
+        allocator = IdAllocator(
+            self.clock, reserve_ids, block_size=3, block_ttl=10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), None)
+        self.assertEqual(self.successResultOf(allocator.allocate()), None)
+        self.assertEqual(self.reserved, [3])
+        self.clock.advance(10)
+        self.assertEqual(self.successResultOf(allocator.allocate()), [1])
+
+    def test_reserve_failure(self):
+        allocator = IdAllocator(
+            self.clock, lambda count: fail(ValueError('boom')))
+        self.failureResultOf(allocator.allocate(), ValueError)
+        self.failureResultOf(allocator.allocate(), ValueError)
@@ -0,0 +1,174 @@
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from shortener.hits import HitAggregator, UnwrittenHits
+
+
+class TestHitAggregator(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+        self.flushed = []
+
+    def flush_hits(self, hits):
+        self.flushed.append(hits)
+
+    def test_record_hit(self):
+        aggregator = HitAggregator(self.clock, self.flush_hits)
+        aggregator.record_hit(1)
+        aggregator.record_hit(1)
+        aggregator.record_hit(2, 3)
+        self.assertEqual(aggregator.pending, {1: 2, 2: 3})
+        self.assertEqual(self.flushed, [])
+
+    def test_flush(self):
+        aggregator = HitAggregator(self.clock, self.flush_hits)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(self.flushed, [])
+
+        aggregator.record_hit(1)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(self.flushed, [{1: 1}])
+        self.assertEqual(aggregator.pending, {})
+
+    def test_flush_on_max_pending(self):
+        aggregator = HitAggregator(
+            self.clock, self.flush_hits, max_pending=2)
+        aggregator.record_hit(1)
+        aggregator.record_hit(1)
+        self.assertEqual(self.flushed, [])
+        aggregator.record_hit(2)
+        self.assertEqual(self.flushed, [{1: 2, 2: 1}])
+
+    def test_no_flush_on_max_pending_while_flushing(self):
+        pending = Deferred()
+        calls = []
+
+        def flush_hits(hits):
+            calls.append(hits)
+            return pending
+        aggregator = HitAggregator(self.clock, flush_hits, max_pending=1)
+        aggregator.record_hit(1)
+        aggregator.record_hit(2)
+        self.assertEqual(calls, [{1: 1}])
+        pending.callback(None)
+        aggregator.record_hit(3)
+        self.assertEqual(calls, [{1: 1}, {2: 1, 3: 1}])
+
+    def test_no_flush_on_max_pending_after_failure(self):
+        calls = []
+
+        def flush_hits(hits):
+            calls.append(hits)
+            return fail(ValueError('boom'))
+        aggregator = HitAggregator(
+            self.clock, flush_hits, interval=5, max_pending=1)
+        aggregator.record_hit(1)
+        aggregator.record_hit(2)
+        self.assertEqual(calls, [{1: 1}])
+        self.clock.advance(5)
+        aggregator.record_hit(3)
+        self.assertEqual(calls, [{1: 1}, {1: 1, 2: 1, 3: 1}])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 2)
+
+    def test_flush_on_interval(self):
+        aggregator = HitAggregator(self.clock, self.flush_hits, interval=5)
+        aggregator.startService()
+        aggregator.record_hit(1)
+        self.clock.advance(4)
+        self.assertEqual(self.flushed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.flushed, [{1: 1}])
+        self.successResultOf(aggregator.stopService())
+
+    def test_no_flush_on_interval_while_flushing(self):
+        pending = Deferred()
+        calls = []
+
+        def flush_hits(hits):
+            calls.append(hits)
+            return pending
+        aggregator = HitAggregator(self.clock, flush_hits, interval=5)
+        aggregator.startService()
+        aggregator.record_hit(1)
+        self.clock.advance(5)
+        aggregator.record_hit(2)
+        self.clock.advance(5)
+        self.assertEqual(calls, [{1: 1}])
+
+        d = aggregator.stopService()
+        self.assertEqual(calls, [{1: 1}])
+        pending.callback(None)
+        self.successResultOf(d)
+        self.assertEqual(calls, [{1: 1}, {2: 1}])
+
+    def test_flush_on_stop(self):
+        pending = Deferred()
+        aggregator = HitAggregator(
+            self.clock, lambda hits: pending, interval=5)
+        aggregator.startService()
+        aggregator.record_hit(1)
+        d = aggregator.stopService()
+        self.assertNoResult(d)
+        pending.callback(None)
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_flush_is_retried(self):
+        aggregator = HitAggregator(
+            self.clock, lambda hits: fail(ValueError('db down')))
+        aggregator.record_hit(1)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        aggregator.record_hit(1)
+        self.assertEqual(aggregator.pending, {1: 2})
+
+    def test_rollups(self):
+        rollups = []
+        self.clock.advance(125)
+        aggregator = HitAggregator(
+            self.clock, self.flush_hits, flush_rollups=rollups.append)
+        aggregator.record_hit(1)
+        aggregator.record_hit(2, 2)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(self.flushed, [{1: 1, 2: 2}])
+        self.assertEqual(rollups, [{(1, 120): 1, (2, 120): 2}])
+
+    def test_rollups_per_minute(self):
+        rollups = []
+        aggregator = HitAggregator(
+            self.clock, self.flush_hits, interval=300,
+            flush_rollups=rollups.append)
+        aggregator.startService()
+        aggregator.record_hit(1)
+        self.clock.advance(59)
+        aggregator.record_hit(1)
+        self.clock.advance(1)
+        aggregator.record_hit(1)
+        self.clock.advance(60)
+        self.successResultOf(aggregator.stopService())
+        self.assertEqual(self.flushed, [{1: 3}])
+        self.assertEqual(rollups, [{(1, 0): 2, (1, 60): 1}])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_rollups_flush_is_retried(self):
+        aggregator = HitAggregator(
+            self.clock, self.flush_hits,
+            flush_rollups=lambda hits: fail(ValueError('db down')))
+        aggregator.record_hit(1)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.flushed, [{1: 1}])
+        self.assertEqual(aggregator.pending, {})
+        self.assertEqual(aggregator.pending_rollups, {(1, 0): 1})
+
+    def test_unwritten_hits_are_retried(self):
+        aggregator = HitAggregator(
+            self.clock, lambda hits: fail(UnwrittenHits({2: 1})))
+        aggregator.record_hit(1)
+        aggregator.record_hit(2)
+        self.successResultOf(aggregator.flush())
+        self.assertEqual(len(self.flushLoggedErrors(UnwrittenHits)), 1)
+        self.assertEqual(aggregator.pending, {2: 1})
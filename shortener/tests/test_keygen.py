@@ -1,5 +1,6 @@
-from twisted.trial.unittest import TestCase
-from shortener.keygen import generate_token
+from twisted.trial.unittest import TestCase, SkipTest
+from shortener import keygen
+from shortener.keygen import generate_token, generate_tokens, decode_token
 
 
 class TestKeygen(TestCase):
@@ -23,3 +24,57 @@ class TestKeygen(TestCase):
         self.assertEqual(generate_token(7, alphabet), '5979')
         self.assertEqual(generate_token(4000, alphabet), '1999')
         self.assertEqual(generate_token(77, alphabet), '5779')
+
+    def test_decode_token(self):
+        self.assertEqual(decode_token('q70'), 0)
+        self.assertEqual(decode_token('qr0'), 1)
+        self.assertEqual(decode_token('00x'), 4000)
+        self.assertEqual(decode_token('qYR'), 77)
+        for counter in range(0, 300000, 997):
+            self.assertEqual(decode_token(generate_token(counter)), counter)
+
+    def test_decode_token_custom_alphabet(self):
+        alphabet = '0123456789'
+        self.assertEqual(decode_token('5529', alphabet), 45)
+        self.assertEqual(decode_token('1999', alphabet), 4000)
+
+    def test_decode_invalid_token(self):
+        self.assertRaises(ValueError, decode_token, '')
+        self.assertRaises(ValueError, decode_token, 'qr-')
+        # below SHORT_URL_OFFSET
+        self.assertRaises(ValueError, decode_token, 'q')
+        # 'qYR' with a leading zero digit, which is never generated
+        self.assertRaises(ValueError, decode_token, 'XRYq')
+
+    def test_decode_token_max_counter(self):
+        self.assertEqual(decode_token('qYR', max_counter=77), 77)
+        self.assertRaises(ValueError, decode_token, 'qYR', max_counter=76)
+
+    def test_decode_long_token(self):
+        self.assertRaises(
+            ValueError, decode_token, 'q' * 16384, max_counter=2 ** 63 - 1)
+        self.assertEqual(decode_token(generate_token(10 ** 30)), 10 ** 30)
+        self.assertEqual(
+            sorted(keygen._permutations),
+            range(keygen.PRECOMPUTED_TOKEN_LENGTH + 1))
+
+    def assert_bulk_tokens(self, start, count,
+                           alphabet=keygen.DEFAULT_ALPHABET):
+        self.assertEqual(
+            generate_tokens(start, count, alphabet),
+            [generate_token(i, alphabet) for i in range(start, start + count)])
+
+    def test_generate_tokens(self):
+        if keygen.numpy is None:
+            raise SkipTest('NumPy is not installed')
+        self.assertEqual(generate_tokens(0, 3), ['q70', 'qr0', 'qQ0'])
+        self.assertEqual(generate_tokens(5, 0), [])
+        # crosses from 3 to 4 character tokens
+        self.assert_bulk_tokens(234000, 10000)
+        self.assert_bulk_tokens(0, 1000, '0123456789')
+        self.assertRaises(TypeError, generate_tokens, 1.5, 2)
+
+    def test_generate_tokens_without_numpy(self):
+        self.patch(keygen, 'numpy', None)
+        self.assertEqual(generate_tokens(0, 3), ['q70', 'qr0', 'qQ0'])
+        self.assert_bulk_tokens(234000, 100)
@@ -1,8 +1,14 @@
+import json
+import pickle
+import struct
+
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
-from shortener.metrics import CarbonClientService
+from shortener.metrics import (
+    CarbonClientService, ShortenerMetrics, MetricsFlushService, Timer)
 from shortener.tests.doubles import (
     DisconnectingStringTransport, StringTransportClientEndpoint)
 
@@ -41,3 +47,293 @@ class TestCarbonClientService(TestCase):
         self.service.startService()
         yield self.service.connect_d
         self.assertEqual(self.tr.value(), "foo 3 1394726782\n")
+
+    @inlineCallbacks
+    def test_queued_metrics_sent_in_one_write(self):
+        writes = []
+        self.patch(self.tr, 'write', writes.append)
+        self.service.publish_metric("foo", 1, 1394726782)
+        self.service.publish_metric("bar", 2, 1394726782)
+        self.service.startService()
+        yield self.service.connect_d
+        self.assertEqual(
+            writes, ["foo 1 1394726782\nbar 2 1394726782\n"])
+
+        self.service.publish_metrics([
+            ("foo", 3, 1394726783),
+            ("bar", 4, 1394726783),
+        ])
+        self.assertEqual(
+            writes[1], "foo 3 1394726783\nbar 4 1394726783\n")
+
+    @inlineCallbacks
+    def test_queue_drops_oldest(self):
+        service = CarbonClientService(
+            StringTransportClientEndpoint(reactor, self.tr), max_queue_size=2)
+        for i in range(4):
+            service.publish_metric("foo", i, 1394726782)
+        self.assertEqual(service.dropped, 2)
+        service.startService()
+        yield service.connect_d
+        self.assertEqual(
+            self.tr.value(), "foo 2 1394726782\nfoo 3 1394726782\n")
+
+    @inlineCallbacks
+    def test_queue_drops_newest(self):
+        service = CarbonClientService(
+            StringTransportClientEndpoint(reactor, self.tr), max_queue_size=2,
+            drop_policy='newest')
+        for i in range(4):
+            service.publish_metric("foo", i, 1394726782)
+        self.assertEqual(service.dropped, 2)
+        service.startService()
+        yield service.connect_d
+        self.assertEqual(
+            self.tr.value(), "foo 0 1394726782\nfoo 1 1394726782\n")
+
+    def test_invalid_drop_policy(self):
+        self.assertRaises(
+            ValueError, CarbonClientService,
+            StringTransportClientEndpoint(reactor, self.tr),
+            drop_policy='random')
+
+    def test_invalid_max_queue_size(self):
+        for max_queue_size in (0, -1):
+            self.assertRaises(
+                ValueError, CarbonClientService,
+                StringTransportClientEndpoint(reactor, self.tr),
+                max_queue_size=max_queue_size)
+
+    @inlineCallbacks
+    def test_pickle_protocol(self):
+        service = CarbonClientService(
+            StringTransportClientEndpoint(reactor, self.tr), use_pickle=True)
+        service.startService()
+        yield service.connect_d
+        service.publish_metrics([
+            ("foo", 1, 1394726782),
+            ("bar", 2, 1394726783),
+        ])
+
+        data = self.tr.value()
+        [length] = struct.unpack('!L', data[:4])
+        self.assertEqual(length, len(data) - 4)
+        self.assertEqual(pickle.loads(data[4:]), [
+            ("foo", (1394726782, 1)),
+            ("bar", (1394726783, 2)),
+        ])
+
+
+class TestTimer(TestCase):
+    timeout = 1
+
+    def test_summary(self):
+        timer = Timer()
+        for value in range(1, 101):
+            timer.record(value)
+        self.assertEqual(timer.summary(), {
+            'count': 100,
+            'sum': 5050,
+            'min': 1,
+            'max': 100,
+            'p50': 50,
+            'p95': 95,
+            'p99': 99,
+        })
+
+    def test_bounded_samples(self):
+        timer = Timer(max_samples=10)
+        for value in range(1000):
+            timer.record(value)
+        self.assertEqual(len(timer.samples), 10)
+        self.assertEqual(timer.count, 1000)
+        self.assertEqual(timer.min, 0)
+        self.assertEqual(timer.max, 999)
+
+    def test_merge(self):
+        timer = Timer(max_samples=10)
+        for i in range(30):
+            timer.record(i)
+        other = Timer(max_samples=10)
+        for i in range(100, 110):
+            other.record(i)
+        timer.merge(other.to_dict())
+        self.assertEqual(timer.count, 40)
+        self.assertEqual(timer.sum, sum(range(30)) + sum(range(100, 110)))
+        self.assertEqual(timer.min, 0)
+        self.assertEqual(timer.max, 109)
+        self.assertEqual(len(timer.samples), 10)
+        # Samples are kept in proportion to the values each timer recorded.
+        self.assertEqual(len([v for v in timer.samples if v >= 100]), 2)
+
+    def test_merge_empty(self):
+        timer = Timer()
+        timer.merge(Timer().to_dict())
+        self.assertEqual(timer.count, 0)
+        self.assertEqual(timer.min, None)
+
+
+class TestShortenerMetrics(TestCase):
+    timeout = 1
+
+    @inlineCallbacks
+    def make_metrics(self, **config):
+        config.update({
+            'host_domain': 'http://wtxt.io',
+            'account': 'test-account',
+            'graphite_endpoint': 'tcp:www.example.com:80',
+        })
+        metrics = ShortenerMetrics(reactor, config)
+        self.tr = DisconnectingStringTransport()
+        endpoint = StringTransportClientEndpoint(reactor, self.tr)
+        metrics.carbon_client = CarbonClientService(endpoint)
+        metrics.carbon_client.startService()
+        self.addCleanup(metrics.carbon_client.stopService)
+        yield metrics.carbon_client.connect_d
+        returnValue(metrics)
+
+    def lines(self):
+        return [line.rsplit(' ', 1)[0]
+                for line in self.tr.value().splitlines()]
+
+    @inlineCallbacks
+    def test_publish_immediately(self):
+        metrics = yield self.make_metrics()
+        self.assertFalse(metrics.aggregating)
+        metrics.publish_created_url_metrics()
+        metrics.timing('expanded.latency', 0.25)
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.created.count 1',
+            'test-account.wtxtio.expanded.latency 250.0',
+        ])
+
+    @inlineCallbacks
+    def test_aggregated_counters(self):
+        metrics = yield self.make_metrics(metrics_interval=10)
+        self.assertTrue(metrics.aggregating)
+        metrics.publish_created_url_metrics()
+        metrics.publish_created_url_metrics(2)
+        metrics.publish_expanded_url_metrics()
+        self.assertEqual(self.tr.value(), '')
+
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.created.count 3',
+            'test-account.wtxtio.expanded.count 1',
+        ])
+        self.tr.clear()
+        metrics.flush()
+        self.assertEqual(self.tr.value(), '')
+
+    @inlineCallbacks
+    def test_aggregated_timers(self):
+        metrics = yield self.make_metrics(metrics_interval=10)
+        metrics.timing('expanded.latency', 0.002)
+        metrics.timing('expanded.latency', 0.001)
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.expanded.latency.count 2',
+            'test-account.wtxtio.expanded.latency.max 2.0',
+            'test-account.wtxtio.expanded.latency.min 1.0',
+            'test-account.wtxtio.expanded.latency.p50 1.0',
+            'test-account.wtxtio.expanded.latency.p95 2.0',
+            'test-account.wtxtio.expanded.latency.p99 2.0',
+            'test-account.wtxtio.expanded.latency.sum 3.0',
+        ])
+
+    @inlineCallbacks
+    def test_gauges(self):
+        metrics = yield self.make_metrics()
+        metrics.publish_bloom_fill_ratio(0.25)
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.bloom.fill_ratio 0.25',
+        ])
+
+    @inlineCallbacks
+    def test_aggregated_gauges(self):
+        metrics = yield self.make_metrics(metrics_interval=10)
+        metrics.publish_bloom_fill_ratio(0.25)
+        metrics.publish_bloom_fill_ratio(0.5)
+        self.assertEqual(self.tr.value(), '')
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.bloom.fill_ratio 0.5',
+        ])
+
+    @inlineCallbacks
+    def test_for_account(self):
+        metrics = yield self.make_metrics(metrics_interval=10)
+        other = metrics.for_account({
+            'host_domain': 'http://other.io', 'account': 'other-account'})
+        metrics.publish_created_url_metrics()
+        other.publish_created_url_metrics(2)
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'other-account.otherio.created.count 2',
+            'test-account.wtxtio.created.count 1',
+        ])
+        self.tr.clear()
+        other.publish_expanded_url_metrics()
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'other-account.otherio.expanded.count 1',
+        ])
+
+    @inlineCallbacks
+    def test_snapshot_and_merge(self):
+        worker = yield self.make_metrics(metrics_interval=10)
+        metrics = yield self.make_metrics(metrics_interval=10)
+        worker.publish_created_url_metrics(2)
+        worker.publish_bloom_fill_ratio(0.5)
+        worker.timing('expanded.latency', 0.001)
+        metrics.publish_created_url_metrics()
+        metrics.timing('expanded.latency', 0.003)
+
+        snapshot = json.loads(json.dumps(worker.snapshot()))
+        self.assertEqual(worker.counters, {})
+        self.assertEqual(worker.timers, {})
+        metrics.merge(snapshot)
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.created.count 3',
+            'test-account.wtxtio.bloom.fill_ratio 0.5',
+            'test-account.wtxtio.expanded.latency.count 2',
+            'test-account.wtxtio.expanded.latency.max 3.0',
+            'test-account.wtxtio.expanded.latency.min 1.0',
+            'test-account.wtxtio.expanded.latency.p50 1.0',
+            'test-account.wtxtio.expanded.latency.p95 3.0',
+            'test-account.wtxtio.expanded.latency.p99 3.0',
+            'test-account.wtxtio.expanded.latency.sum 4.0',
+        ])
+
+    @inlineCallbacks
+    def test_flush_service(self):
+        clock = Clock()
+        metrics = yield self.make_metrics(metrics_interval=10)
+        flusher = MetricsFlushService(clock, metrics)
+        flusher.startService()
+
+        metrics.publish_invalid_url_metrics()
+        clock.advance(10)
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.invalid.count 1',
+        ])
+
+        metrics.publish_invalid_url_metrics()
+        flusher.stopService()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.invalid.count 1',
+            'test-account.wtxtio.invalid.count 1',
+        ])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_flush_reports_dropped_metrics(self):
+        metrics = yield self.make_metrics(metrics_interval=10)
+        metrics.carbon_client.dropped = 3
+        metrics.flush()
+        self.assertEqual(self.lines(), [
+            'test-account.wtxtio.carbon.dropped 3',
+        ])
+        metrics.flush()
+        self.assertEqual(len(self.lines()), 1)
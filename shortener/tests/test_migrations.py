@@ -0,0 +1,227 @@
+import os
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.trial.unittest import TestCase
+
+from aludel.database import get_engine, MetaData, TableCollection
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+
+from shortener.migrations import (
+    migrate, get_schema_version, SCHEMA_VERSION, SCHEMA_VERSION_KEY,
+    ID_COUNTER_GAP)
+from shortener.models import ShortenerTables, index_name
+
+
+class FakePostgresEngine(object):
+    dialect = postgresql.dialect()
+
+
+class FakePostgresConnection(object):
+    def __init__(self):
+        self._engine = FakePostgresEngine()
+        self.statements = []
+
+    def _record(self, statement, autocommit):
+        if not isinstance(statement, basestring):
+            statement = str(statement.compile(dialect=self._engine.dialect))
+        self.statements.append((statement, autocommit))
+        return succeed(None)
+
+    def execute(self, statement):
+        return self._record(statement, False)
+
+    def execute_autocommit(self, statement):
+        return self._record(statement, True)
+
+
+class TestMigrations(TestCase):
+    timeout = 5
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+        assert self.engine._engine.table_names() == []
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "SHORTENER_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.conn.close()
+        self._drop_tables()
+
+    def get_index_names(self, tables):
+        # NOTE: This is a blocking operation!
+        inspector = inspect(self.engine._engine)
+        return sorted(
+            index['name']
+            for table in (tables.urls, tables.audit)
+            for index in inspector.get_indexes(table.name))
+
+    @inlineCallbacks
+    def test_create_tables(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        version = yield get_schema_version(tables)
+        self.assertEqual(version, SCHEMA_VERSION)
+        self.assertEqual(
+            self.get_index_names(tables),
+            sorted(index.name for index in tables.indexes()))
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 0)
+
+    @inlineCallbacks
+    def test_unique_url_index(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        row = {'domain': 'wiki.org', 'user_token': 'test', 'hash': 'abc'}
+        yield tables.execute_query(tables.urls.insert().values(**row))
+        yield self.assertFailure(
+            tables.execute_query(tables.urls.insert().values(**row)),
+            IntegrityError)
+
+    @inlineCallbacks
+    def test_migrate_unversioned_tables(self):
+        tables = ShortenerTables('test-account', self.conn)
+        # Accounts created before schema versioning have no indexes and no
+        # version in their metadata.
+        yield TableCollection.create_tables(tables)
+        self.assertEqual(self.get_index_names(tables), [])
+
+        versions = yield migrate(tables)
+        self.assertEqual(versions, (0, SCHEMA_VERSION))
+        self.assertTrue(
+            'ix_ShortenerTables_test-account_audit_url_id'
+            in self.get_index_names(tables))
+        [unique_index] = [
+            index for index in tables.indexes() if index.unique]
+        self.assertTrue(unique_index.name in self.get_index_names(tables))
+        version = yield get_schema_version(tables)
+        self.assertEqual(version, SCHEMA_VERSION)
+
+        versions = yield migrate(tables)
+        self.assertEqual(versions, (SCHEMA_VERSION, SCHEMA_VERSION))
+
+    def test_index_names_for_long_accounts(self):
+        dialect = postgresql.dialect()
+        for account in ('praekelt-mobisite-prod', 'a' * 40):
+            tables = ShortenerTables(account, self.conn)
+            for index in tables.indexes():
+                # Raises an IdentifierError if an explicit name is too long.
+                ddl = str(CreateIndex(index).compile(dialect=dialect))
+                name = index_name(index, dialect)
+                self.assertTrue(len(name) <= 63)
+                self.assertTrue(' %s ON ' % (name,) in ddl.replace('"', ''))
+
+    @inlineCallbacks
+    def test_create_index_concurrently(self):
+        conn = FakePostgresConnection()
+        tables = ShortenerTables('test-account', conn)
+        [index] = [index for index in tables.indexes() if index.unique]
+        yield tables.create_index(index, concurrently=True)
+        # Copies of the tables share their indexes, which are unchanged.
+        yield tables.with_connection(conn).create_index(index)
+        [(concurrent, autocommit), (plain, in_transaction)] = conn.statements
+        self.assertTrue(
+            concurrent.startswith('CREATE UNIQUE INDEX CONCURRENTLY '))
+        self.assertTrue(autocommit)
+        self.assertTrue(plain.startswith('CREATE UNIQUE INDEX ix_'))
+        self.assertFalse(in_transaction)
+
+    @inlineCallbacks
+    def test_migrate_duplicate_urls(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield TableCollection.create_tables(tables)
+        row = {'domain': 'wiki.org', 'user_token': 'test', 'hash': 'abc'}
+        for row_id in (3, 1, 2):
+            yield tables.execute_query(tables.urls.insert().values(
+                id=row_id, short_url='s%s' % (row_id,), **row))
+
+        yield migrate(tables)
+        rows = yield tables.execute_query(
+            tables.urls.select().order_by(tables.urls.c.id))
+        rows = yield rows.fetchall()
+        self.assertEqual(
+            [(r['id'], r['short_url'], r['hash']) for r in rows],
+            [(1, 's1', 'abc'), (2, 's2', None), (3, 's3', None)])
+        self.assertEqual(
+            self.get_index_names(tables),
+            sorted(index.name for index in tables.indexes()))
+
+    @inlineCallbacks
+    def test_migrate_existing_indexes(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield TableCollection.create_tables(tables)
+        # An earlier migration that was interrupted part way through.
+        [index] = [index for index in tables.indexes()
+                   if index.name.endswith('audit_url_id')]
+        yield tables.create_index(index)
+
+        versions = yield migrate(tables)
+        self.assertEqual(versions, (0, SCHEMA_VERSION))
+        self.assertEqual(
+            self.get_index_names(tables),
+            sorted(index.name for index in tables.indexes()))
+
+    @inlineCallbacks
+    def test_migrate_id_counter(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield TableCollection.create_tables(tables)
+        yield tables.execute_query(tables.urls.insert().values(
+            id=5, domain='wiki.org', user_token='test', hash='abc'))
+
+        yield migrate(tables)
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 5 + ID_COUNTER_GAP)
+        first_id = yield tables.reserve_ids(10)
+        self.assertEqual(first_id, 6 + ID_COUNTER_GAP)
+
+    @inlineCallbacks
+    def test_migrate_id_counter_behind(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        # An account created at version 3 and served without reserving ids.
+        yield tables.execute_query(tables.urls.insert().values(
+            id=5, domain='wiki.org', user_token='test', hash='abc'))
+        metadata = yield tables.get_metadata()
+        metadata[SCHEMA_VERSION_KEY] = 3
+        yield tables.set_metadata(metadata)
+
+        yield migrate(tables)
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 5 + ID_COUNTER_GAP)
+
+        # Counters that are already ahead aren't moved.
+        metadata[SCHEMA_VERSION_KEY] = 3
+        yield tables.set_metadata(metadata)
+        yield migrate(tables)
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 5 + ID_COUNTER_GAP)
+
+    @inlineCallbacks
+    def test_migrate_hit_rollups(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        # An account created at version 2, before there were rollups.
+        tables.hit_rollups.drop(self.engine._engine)
+        metadata = yield tables.get_metadata()
+        metadata[SCHEMA_VERSION_KEY] = 2
+        yield tables.set_metadata(metadata)
+
+        versions = yield migrate(tables)
+        self.assertEqual(versions, (2, SCHEMA_VERSION))
+        self.assertTrue(
+            tables.hit_rollups.name in self.engine._engine.table_names())
+        yield tables.update_hit_rollups({(1, 0): 1})
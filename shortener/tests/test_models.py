@@ -1,11 +1,13 @@
 import os
+from datetime import datetime
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.trial.unittest import TestCase
 
 from aludel.database import get_engine, MetaData
 from aludel.tests.doubles import FakeReactorThreads
-from shortener.models import ShortenerTables
+from shortener.keygen import generate_token
+from shortener.models import ShortenerTables, ShortenerDBError, MAX_ROW_ID
 
 
 class TestShortenerServiceApp(TestCase):
@@ -36,6 +38,25 @@ class TestShortenerServiceApp(TestCase):
         tables = ShortenerTables('test-account', self.conn)
         self.successResultOf(tables.create_tables())
 
+    @inlineCallbacks
+    def test_with_connection(self):
+        template = ShortenerTables('test-account', None)
+        tables = template.with_connection(self.conn)
+        exists = yield tables.exists()
+        self.assertFalse(exists)
+        yield tables.create_tables()
+
+        # Collections not known to exist are checked again.
+        tables = template.with_connection(self.conn)
+        self.assertIdentical(tables.urls, template.urls)
+        exists = yield tables.exists()
+        self.assertTrue(exists)
+
+        row = yield tables.get_or_create_row(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(template._conn, None)
+
     @inlineCallbacks
     def test_get_or_create_row(self):
         tables = ShortenerTables('test-account', self.conn)
@@ -102,3 +123,314 @@ class TestShortenerServiceApp(TestCase):
 
         audit = yield tables.get_audit_row(1)
         self.assertEqual(audit['hits'], 11)
+
+    @inlineCallbacks
+    def test_get_row_by_id(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        yield tables.get_or_create_row(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        yield tables.update_short_url(1, 'aaa')
+
+        row = yield tables.get_row_by_id(1)
+        self.assertEqual(row['short_url'], 'aaa')
+        row = yield tables.get_row_by_id(1, 'aaa', increment=False)
+        self.assertEqual(row['long_url'], 'http://wiki.org/test/')
+        row = yield tables.get_row_by_id(1, 'bbb')
+        self.assertEqual(row, None)
+        row = yield tables.get_row_by_id(2)
+        self.assertEqual(row, None)
+
+        audit = yield tables.get_audit_row(1)
+        self.assertEqual(audit['hits'], 1)
+
+    @inlineCallbacks
+    def test_update_hits(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        for i in range(3):
+            yield tables.get_or_create_row(
+                'wiki.org', 'test', 'http://wiki.org/test/%s' % (i,))
+
+        yield tables.update_hits({1: 5, 3: 2})
+        yield tables.update_hits({1: 1})
+
+        audit = yield tables.get_audit_row(1)
+        self.assertEqual(audit['hits'], 6)
+        audit = yield tables.get_audit_row(2)
+        self.assertEqual(audit['hits'], 0)
+        audit = yield tables.get_audit_row(3)
+        self.assertEqual(audit['hits'], 2)
+
+    @inlineCallbacks
+    def test_update_hits_in_chunks(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        rows, _ = yield tables.get_or_create_short_urls([
+            ('wiki.org', 'test', 'http://wiki.org/test/%s' % (i,))
+            for i in range(5)])
+
+        execute_query = tables.execute_query
+        queries = []
+
+        def count_queries(query, *args, **kw):
+            queries.append(query)
+            return execute_query(query, *args, **kw)
+        self.patch(tables, 'execute_query', count_queries)
+        self.patch(tables, '_max_bind_params', lambda: 6)
+        yield tables.update_hits(dict((i, i * 10) for i in range(1, 6)))
+        # Two urls per statement.
+        self.assertEqual(len(queries), 3)
+
+        for i in range(1, 6):
+            audit = yield tables.get_audit_row(i)
+            self.assertEqual(audit['hits'], i * 10)
+
+    @inlineCallbacks
+    def test_update_hit_rollups(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        hour = 1400000400
+        yield tables.update_hit_rollups({(1, hour): 5, (1, hour + 60): 1})
+        yield tables.update_hit_rollups({(1, hour + 60): 2, (2, hour): 3})
+
+        since = datetime.utcfromtimestamp(hour)
+        until = datetime.utcfromtimestamp(hour + 3600)
+        minutes = yield tables.get_hit_rollups(1, 60, since, until)
+        self.assertEqual(minutes, [
+            (since, 5), (datetime.utcfromtimestamp(hour + 60), 3)])
+        hours = yield tables.get_hit_rollups(1, 3600, since, until)
+        self.assertEqual(hours, [(since, 8)])
+        hours = yield tables.get_hit_rollups(2, 3600, since, until)
+        self.assertEqual(hours, [(since, 3)])
+
+    @inlineCallbacks
+    def test_get_hot_urls(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        for i in range(4):
+            yield tables.get_or_create_short_url(
+                'wiki.org', 'test', 'http://wiki.org/test/%s' % (i,))
+        yield tables.update_hits({1: 5, 2: 10, 3: 1})
+        hour = 1400000400
+        yield tables.update_hit_rollups({
+            (1, hour - 3600): 8, (1, hour): 1, (3, hour): 2})
+
+        rows = yield tables.get_hot_urls(2)
+        self.assertEqual([row['id'] for row in rows], [2, 1])
+        self.assertEqual(rows[0]['short_url'], generate_token(2))
+        self.assertEqual(rows[0]['long_url'], 'http://wiki.org/test/1')
+        self.assertEqual(rows[0]['hits'], 10)
+        rows = yield tables.get_hot_urls(10, datetime.utcfromtimestamp(hour))
+        self.assertEqual([(row['id'], row['hits']) for row in rows],
+                         [(3, 2), (1, 1)])
+
+    @inlineCallbacks
+    def test_get_or_create_short_url(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        self.assertTrue(created)
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(row['short_url'], 'qr0')
+        self.assertEqual(row['long_url'], 'http://wiki.org/test/')
+
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        self.assertFalse(created)
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(row['short_url'], 'qr0')
+
+        row = yield tables.get_row_by_id(1, 'qr0', increment=False)
+        self.assertEqual(row['long_url'], 'http://wiki.org/test/')
+        audit = yield tables.get_audit_row(1)
+        self.assertEqual(audit['hits'], 0)
+
+    @inlineCallbacks
+    def test_get_or_create_short_url_with_row_id(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        def fail_update(row_id, short_url):
+            self.fail('reserved ids should be inserted with their short url')
+        self.patch(tables, 'update_short_url', fail_update)
+
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/', 42)
+        self.assertTrue(created)
+        self.assertEqual(row['id'], 42)
+        self.assertEqual(row['short_url'], generate_token(42))
+
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/', 43)
+        self.assertFalse(created)
+        self.assertEqual(row['id'], 42)
+
+        row = yield tables.get_row_by_id(
+            42, generate_token(42), increment=False)
+        self.assertEqual(row['long_url'], 'http://wiki.org/test/')
+        audit = yield tables.get_audit_row(42)
+        self.assertEqual(audit['hits'], 0)
+
+    @inlineCallbacks
+    def test_reserve_ids(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        first_id = yield tables.reserve_ids(10)
+        self.assertEqual(first_id, 1)
+        first_id = yield tables.reserve_ids(5)
+        self.assertEqual(first_id, 11)
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, 15)
+
+        yield tables.reserve_ids(MAX_ROW_ID - 15)
+        yield self.assertFailure(tables.reserve_ids(1), ShortenerDBError)
+        counter = yield tables.get_id_counter()
+        self.assertEqual(counter, MAX_ROW_ID)
+
+    @inlineCallbacks
+    def test_settled_id(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        settled = yield tables.get_settled_id()
+        self.assertEqual(settled, None)
+        yield tables.set_settled_id(10)
+        yield tables.set_settled_id(5)
+        settled = yield tables.get_settled_id()
+        self.assertEqual(settled, 10)
+        yield tables.set_settled_id(20)
+        settled = yield tables.get_settled_id()
+        self.assertEqual(settled, 20)
+
+    @inlineCallbacks
+    def test_get_or_create_short_url_for_existing_row(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        yield tables.get_or_create_row(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        self.assertTrue(created)
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(row['short_url'], 'qr0')
+
+        audit = yield tables.get_audit_row(1)
+        self.assertEqual(audit['hits'], 0)
+
+    @inlineCallbacks
+    def test_get_or_create_short_url_concurrent_insert(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+
+        # Miss the existing row once, as if another connection inserted it
+        # after the select.
+        select_by_hash = tables._select_by_hash
+        misses = ['nope']
+
+        def racy_select_by_hash(domain, user_token, hashkey):
+            if misses:
+                hashkey = misses.pop()
+            return select_by_hash(domain, user_token, hashkey)
+        self.patch(tables, '_select_by_hash', racy_select_by_hash)
+
+        row, created = yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        self.assertFalse(created)
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(row['short_url'], 'qr0')
+
+    @inlineCallbacks
+    def test_get_or_create_short_url_rolls_back(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        def fail_update(row_id, short_url):
+            raise ValueError('boom')
+        self.patch(tables, 'update_short_url', fail_update)
+
+        d = tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/test/')
+        yield self.assertFailure(d, ValueError)
+
+        row = yield tables.get_row_by_id(1, increment=False)
+        self.assertEqual(row, None)
+        audit = yield tables.get_audit_row(1)
+        self.assertEqual(audit, None)
+
+    @inlineCallbacks
+    def test_get_or_create_short_urls(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+
+        yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/0')
+        yield tables.get_or_create_row(
+            'wiki.org', 'test', 'http://wiki.org/1')
+
+        urls = [('wiki.org', 'test', 'http://wiki.org/%s' % (i,))
+                for i in [3, 0, 2, 1, 3]]
+        rows, created = yield tables.get_or_create_short_urls(urls)
+        self.assertEqual(created, 3)
+        self.assertEqual(
+            [row['long_url'] for row in rows], [url for _, _, url in urls])
+        self.assertEqual(rows[0], rows[4])
+        self.assertEqual(rows[1]['id'], 1)
+        self.assertEqual(rows[1]['short_url'], 'qr0')
+        self.assertEqual(rows[3]['id'], 2)
+        self.assertEqual(len(set(row['short_url'] for row in rows)), 4)
+
+        for row in rows:
+            stored = yield tables.get_row_by_id(
+                row['id'], row['short_url'], increment=False)
+            self.assertEqual(stored['long_url'], row['long_url'])
+            audit = yield tables.get_audit_row(row['id'])
+            self.assertEqual(audit['hits'], 0)
+
+        rows, created = yield tables.get_or_create_short_urls(urls)
+        self.assertEqual(created, 0)
+
+    @inlineCallbacks
+    def test_get_or_create_short_urls_chunks(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        self.patch(tables, '_max_bind_params', lambda: 7)
+
+        urls = [('wiki.org', 'test', 'http://wiki.org/%s' % (i,))
+                for i in range(20)]
+        rows, created = yield tables.get_or_create_short_urls(urls)
+        self.assertEqual(created, 20)
+        self.assertEqual(sorted(row['id'] for row in rows), range(1, 21))
+
+    @inlineCallbacks
+    def test_get_or_create_short_urls_with_row_ids(self):
+        tables = ShortenerTables('test-account', self.conn)
+        yield tables.create_tables()
+        yield tables.get_or_create_short_url(
+            'wiki.org', 'test', 'http://wiki.org/0')
+
+        urls = [('wiki.org', 'test', 'http://wiki.org/%s' % (i,))
+                for i in [2, 0, 1, 2]]
+        rows, created = yield tables.get_or_create_short_urls(
+            urls, [10, 11, 12, 13])
+        self.assertEqual(created, 2)
+        self.assertEqual(rows[0], rows[3])
+        self.assertEqual(rows[1]['id'], 1)
+        self.assertEqual(sorted([rows[0]['id'], rows[2]['id']]), [10, 11])
+        for row in rows:
+            self.assertEqual(row['short_url'], generate_token(row['id']))
+
+        for row in rows:
+            stored = yield tables.get_row_by_id(
+                row['id'], row['short_url'], increment=False)
+            self.assertEqual(stored['long_url'], row['long_url'])
+            audit = yield tables.get_audit_row(row['id'])
+            self.assertEqual(audit['hits'], 0)
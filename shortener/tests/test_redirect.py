@@ -0,0 +1,105 @@
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from shortener.redirect import RedirectResource
+
+
+class FakeFallback(Resource):
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append(request)
+        return 'fallback'
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.clock = Clock()
+        self.timing_metrics = None
+        self.server_timing = False
+        self.cache = {}
+        self.fetches = []
+
+    def get_cached_row(self, short_url):
+        return self.cache.get(short_url)
+
+    def fetch_row(self, short_url, timer=None):
+        d = Deferred()
+        self.fetches.append((short_url, d))
+        return d
+
+    def set_redirect(self, request, row):
+        if row:
+            request.setResponseCode(301)
+            request.setHeader('location', row['long_url'])
+        else:
+            request.setResponseCode(404)
+
+
+class TestRedirectResource(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.app = FakeApp()
+        self.fallback = FakeFallback()
+        self.resource = RedirectResource(self.app, self.fallback)
+
+    def test_cached(self):
+        self.app.cache['qr0'] = {'long_url': 'http://example.org/'}
+        request = DummyRequest(['qr0'])
+        self.assertEqual(self.resource.render(request), '')
+        self.assertEqual(request.responseCode, 301)
+        self.assertEqual(
+            request.outgoingHeaders['location'], 'http://example.org/')
+        self.assertEqual(self.app.fetches, [])
+
+    def test_fetched(self):
+        request = DummyRequest(['qr0'])
+        self.assertEqual(self.resource.render(request), NOT_DONE_YET)
+        [(short_url, d)] = self.app.fetches
+        self.assertEqual(short_url, 'qr0')
+        d.callback({'long_url': 'http://example.org/'})
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, 301)
+        self.assertEqual(request.written, [''])
+
+    def test_not_found(self):
+        request = DummyRequest(['qr0'])
+        self.resource.render(request)
+        self.app.fetches[0][1].callback(None)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, 404)
+
+    def test_client_gone(self):
+        request = DummyRequest(['qr0'])
+        self.resource.render(request)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.app.fetches[0][1].callback(None)
+        self.assertEqual(request.finished, 0)
+
+    def test_failure(self):
+        self.app.fetch_row = lambda short_url, timer: fail(ValueError('boom'))
+        request = DummyRequest(['qr0'])
+        self.resource.render(request)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_fallback(self):
+        for path, method in [(['api', 'init'], 'GET'),
+                             (['qr0'], 'PUT'),
+                             (['qr0', ''], 'GET'),
+                             ([''], 'GET')]:
+            request = DummyRequest(path)
+            request.method = method
+            self.assertEqual(self.resource.render(request), 'fallback')
+        self.assertEqual(len(self.fallback.requests), 4)
+        self.assertEqual(self.app.fetches, [])
@@ -0,0 +1,271 @@
+import json
+import treq
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, fail, succeed
+from twisted.trial.unittest import TestCase
+from twisted.web.client import HTTPConnectionPool
+from twisted.web.server import Site
+
+from shortener.api import ShortenerServiceApp, make_shards
+from shortener.cache import LRUCache
+from shortener.hits import UnwrittenHits
+from shortener.keygen import decode_token
+from shortener.models import ShortenerTables
+from shortener.sharding import Shard, shard_for_hash, shard_for_id
+
+
+class TestShard(TestCase):
+    timeout = 1
+
+    def test_row_ids(self):
+        shards = [Shard(index, 3, None) for index in range(3)]
+        self.assertEqual([shard.row_id(5) for shard in shards], [15, 16, 17])
+        self.assertEqual([shard.sequence(16) for shard in shards], [5, 5, 5])
+        for row_id in range(30):
+            shard = shard_for_id(shards, row_id)
+            self.assertEqual(shard.row_id(shard.sequence(row_id)), row_id)
+
+    def test_shard_for_hash(self):
+        shards = [Shard(index, 3, None) for index in range(3)]
+        self.assertIdentical(shard_for_hash(shards, 'ff'), shards[0])
+        self.assertIdentical(shard_for_hash(shards, '0a'), shards[1])
+
+    def test_unsharded(self):
+        shard = Shard(0, 1, 'engine')
+        self.assertEqual(shard.read_engine, 'engine')
+        self.assertEqual((shard.row_id(7), shard.sequence(7)), (7, 7))
+
+    def test_read(self):
+        calls = []
+
+        class Engine(object):
+            def __init__(self, name, result):
+                self.name = name
+                self.result = result
+
+            def connect(self):
+                return succeed(self)
+
+            def close(self):
+                return succeed(None)
+
+        def f(conn, arg):
+            calls.append((conn.name, arg))
+            if isinstance(conn.result, Exception):
+                raise conn.result
+            return conn.result
+
+        primary = Engine('primary', 'row')
+        shard = Shard(0, 1, primary)
+        self.assertEqual(self.successResultOf(shard.read(f, 1)), 'row')
+        self.assertEqual(calls, [('primary', 1)])
+
+        for replica_result in ['replica row', None, ValueError('down')]:
+            del calls[:]
+            shard = Shard(0, 1, primary, Engine('replica', replica_result))
+            result = self.successResultOf(shard.read(f, 2))
+            if replica_result == 'replica row':
+                self.assertEqual(result, 'replica row')
+                self.assertEqual(calls, [('replica', 2)])
+            else:
+                self.assertEqual(result, 'row')
+                self.assertEqual(calls, [('replica', 2), ('primary', 2)])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_make_shards(self):
+        shards = make_shards({
+            'shards': [
+                'sqlite:///a',
+                {'connection_string': 'sqlite:///b',
+                 'read_connection_strings': ['sqlite:///b1']},
+            ],
+            'read_replica_policy': 'least_loaded',
+        }, lambda connection_string: connection_string)
+        self.assertEqual(
+            [(shard.index, shard.count, shard.engine) for shard in shards],
+            [(0, 2, 'sqlite:///a'), (1, 2, 'sqlite:///b')])
+        self.assertEqual(shards[0].read_engine, 'sqlite:///a')
+        self.assertEqual(shards[1].read_engine.engines, ['sqlite:///b1'])
+        self.assertEqual(shards[1].read_engine.policy, 'least_loaded')
+
+        [shard] = make_shards(
+            {'connection_string': 'sqlite://'}, lambda cs: cs)
+        self.assertEqual((shard.index, shard.count), (0, 1))
+
+
+class TestShardedApp(TestCase):
+    timeout = 5
+
+    @inlineCallbacks
+    def setUp(self):
+        self.account = 'test-account'
+        self.service = ShortenerServiceApp(reactor=reactor, config={
+            'host_domain': 'http://wtxt.io',
+            'account': self.account,
+            'shards': ['sqlite:///%s' % (self.mktemp(),) for _ in range(3)],
+            'graphite_endpoint': 'tcp:www.example.com:80',
+            'id_block_size': 2,
+            'handlers': [
+                {'dump': 'shortener.handlers.dump.Dump'},
+            ],
+        })
+        for shard in self.service.shards:
+            self.addCleanup(shard.engine.stop)
+            conn = yield shard.engine.connect()
+            yield ShortenerTables(self.account, conn).create_tables()
+            yield conn.close()
+
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        site = Site(self.service.resource())
+        self.listener = reactor.listenTCP(0, site, interface='localhost')
+        self.addCleanup(self.listener.loseConnection)
+        self.addCleanup(self.pool.closeCachedConnections)
+
+    def make_url(self, path):
+        return 'http://localhost:%s%s' % (
+            self.listener.getHost().port, path)
+
+    @inlineCallbacks
+    def get_tables(self, shard, f):
+        conn = yield shard.engine.connect()
+        try:
+            result = yield f(ShortenerTables(self.account, conn))
+        finally:
+            yield conn.close()
+        returnValue(result)
+
+    @inlineCallbacks
+    def shorten(self, count):
+        short_urls = []
+        for i in range(count):
+            short_url = yield self.service.shorten_url(
+                'http://en.wikipedia.org/wiki/%s' % (i,))
+            short_urls.append(short_url.rsplit('/', 1)[1])
+        returnValue(short_urls)
+
+    @inlineCallbacks
+    def test_create_and_resolve(self):
+        short_urls = yield self.shorten(12)
+        shards_used = set()
+        for short_url in short_urls:
+            row_id = decode_token(short_url)
+            shard = shard_for_id(self.service.shards, row_id)
+            shards_used.add(shard.index)
+            row = yield self.get_tables(
+                shard, lambda tables: tables.get_row_by_id(
+                    row_id, increment=False))
+            self.assertEqual(row['short_url'], short_url)
+        self.assertEqual(shards_used, set([0, 1, 2]))
+
+        for i, short_url in enumerate(short_urls):
+            row = yield self.service.get_row_by_short_url(short_url)
+            self.assertEqual(
+                row['long_url'], 'http://en.wikipedia.org/wiki/%s' % (i,))
+
+        # Shortening a url again finds it on its shard.
+        again = yield self.shorten(12)
+        self.assertEqual(again, short_urls)
+
+    @inlineCallbacks
+    def test_batch(self):
+        urls = ['http://en.wikipedia.org/wiki/%s' % (i,) for i in range(9)]
+        short_urls = yield self.service.shorten_urls(
+            [(url, None) for url in urls + urls[:2]])
+        self.assertEqual(short_urls[9:], short_urls[:2])
+        self.assertEqual(len(set(short_urls)), 9)
+        again = yield self.shorten(9)
+        self.assertEqual(
+            ['http://wtxt.io/' + short_url for short_url in again],
+            short_urls[:9])
+
+    @inlineCallbacks
+    def test_flush_hits(self):
+        short_urls = yield self.shorten(6)
+        for short_url in short_urls:
+            yield self.service.get_row_by_short_url(short_url)
+        yield self.service.hits.flush()
+        for short_url in short_urls:
+            row_id = decode_token(short_url)
+            audit = yield self.get_tables(
+                shard_for_id(self.service.shards, row_id),
+                lambda tables: tables.get_audit_row(row_id))
+            self.assertEqual(audit['hits'], 1)
+
+    @inlineCallbacks
+    def test_flush_hits_partial_failure(self):
+        shards = self.service.shards
+        self.patch(shards[1].engine, 'connect',
+                   lambda: fail(ValueError('shard down')))
+        hits = {3: 1, 4: 2, 7: 3, 5: 4}
+        failure = yield self.assertFailure(
+            self.service.flush_hits(hits), UnwrittenHits)
+        self.assertEqual(failure.counts, {4: 2, 7: 3})
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @inlineCallbacks
+    def test_load_short_urls(self):
+        short_urls = yield self.shorten(8)
+        rows = yield self.service.load_short_urls(None, 5)
+        expected = sorted(
+            (decode_token(short_url), short_url) for short_url in short_urls)
+        self.assertEqual(rows, expected[:5])
+        rows = yield self.service.load_short_urls(rows[-1][0], 5)
+        self.assertEqual(rows, expected[5:])
+
+    @inlineCallbacks
+    def test_load_id_ceiling(self):
+        shards = self.service.shards
+        for shard, count in zip(shards, [5, 3, 4]):
+            yield self.get_tables(
+                shard, lambda tables: tables.reserve_ids(count))
+        # Sequence 3 is the last that every shard has reserved.
+        ceiling = yield self.service.load_id_ceiling()
+        self.assertEqual(ceiling, 11)
+
+    @inlineCallbacks
+    def test_settled_id(self):
+        settled = yield self.service.load_settled_id()
+        self.assertEqual(settled, None)
+        yield self.service.save_settled_id(11)
+        settled = yield self.service.load_settled_id()
+        self.assertEqual(settled, 11)
+
+    @inlineCallbacks
+    def test_warm_up(self):
+        short_urls = yield self.shorten(6)
+        row_ids = [decode_token(short_url) for short_url in short_urls]
+        for i, row_id in enumerate(row_ids):
+            yield self.get_tables(
+                shard_for_id(self.service.shards, row_id),
+                lambda tables: tables.update_hits({row_id: i}))
+        self.service.redirect_cache = LRUCache(2)
+        count = yield self.service.warm_up(10)
+        self.assertEqual(count, 2)
+        for short_url in short_urls[4:]:
+            self.assertTrue(short_url in self.service.redirect_cache)
+
+    @inlineCallbacks
+    def test_dump(self):
+        short_urls = yield self.shorten(5)
+        for short_url in short_urls:
+            resp = yield treq.get(
+                self.make_url('/api/handler/dump?url=%s' % (short_url,)),
+                pool=self.pool)
+            result = yield treq.json_content(resp)
+            self.assertEqual(result['short_url'], short_url)
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export?format=csv'),
+            pool=self.pool)
+        body = yield treq.content(resp)
+        lines = body.splitlines()
+        self.assertTrue(lines[0].startswith('domain,'))
+        self.assertEqual(len(lines), 6)
+
+        resp = yield treq.get(
+            self.make_url('/api/handler/dump/export'), pool=self.pool)
+        body = yield treq.content(resp)
+        exported = [
+            json.loads(line)['short_url'] for line in body.splitlines()]
+        self.assertEqual(sorted(exported), sorted(short_urls))
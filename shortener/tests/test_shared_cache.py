@@ -0,0 +1,148 @@
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, TimeoutError
+from twisted.internet.endpoints import TCP4ClientEndpoint, clientFromString
+from twisted.internet.task import Clock, deferLater
+from twisted.trial.unittest import TestCase
+
+from shortener.shared_cache import (
+    MemoryCacheBackend, MemcachedBackend, cache_key, make_shared_cache)
+from shortener.tests.doubles import FakeMemcachedFactory
+
+
+class TestCacheKey(TestCase):
+    timeout = 1
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('account', 'short', 'qr0'),
+                         'account:short:qr0')
+        self.assertEqual(cache_key(u'acc\xf6unt', 'short', 'qr0'),
+                         'acc\xc3\xb6unt:short:qr0')
+
+    def test_unsafe_keys_hashed(self):
+        for key in [cache_key('my account', 'short', 'qr0'),
+                    cache_key('account', 'short', 'q' * 250)]:
+            self.assertEqual(len(key), 40)
+            self.assertFalse(' ' in key)
+
+
+class TestMemoryCacheBackend(TestCase):
+    timeout = 1
+
+    def test_get_set(self):
+        clock = Clock()
+        cache = MemoryCacheBackend(10, 60, clock=clock)
+        self.assertEqual(self.successResultOf(cache.get_many(['a'])), {})
+        cache.set_many({'a': {'id': 1}, 'b': {'id': 2}})
+        self.assertEqual(
+            self.successResultOf(cache.get_many(['a', 'c'])),
+            {'a': {'id': 1}})
+        clock.advance(60)
+        self.assertEqual(self.successResultOf(cache.get_many(['a'])), {})
+
+
+class TestMemcachedBackend(TestCase):
+    timeout = 5
+
+    def listen(self):
+        factory = FakeMemcachedFactory()
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        endpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', port.getHost().port)
+        return factory, endpoint
+
+    @inlineCallbacks
+    def start(self, backend):
+        backend.startService()
+        self.addCleanup(backend.stopService)
+        while not all(client.protocol_instance is not None
+                      for client in backend):
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def test_get_set(self):
+        factory, endpoint = self.listen()
+        backend = MemcachedBackend([endpoint], pool_size=2, ttl=60)
+        yield self.start(backend)
+        self.assertEqual(len(factory.connections), 2)
+
+        values = yield backend.get_many(['a', 'b'])
+        self.assertEqual(values, {})
+        yield backend.set_many({'a': {'id': 1}, 'b': {'id': 2}})
+        values = yield backend.get_many(['a', 'b', 'c'])
+        self.assertEqual(values, {'a': {'id': 1}, 'b': {'id': 2}})
+        self.assertEqual(backend.stats(),
+                         {'hits': 2, 'misses': 3, 'errors': 0})
+
+        # Each lookup was a single multi-get.
+        gets = [c for c in factory.commands if c.startswith('get ')]
+        self.assertEqual(sorted(gets[0].split()), ['a', 'b', 'get'])
+        self.assertEqual(sorted(gets[1].split()), ['a', 'b', 'c', 'get'])
+        self.assertTrue('set a 0 60 9' in factory.commands)
+
+    @inlineCallbacks
+    def test_servers(self):
+        servers = [self.listen() for _ in xrange(2)]
+        backend = MemcachedBackend(
+            [endpoint for factory, endpoint in servers], pool_size=1)
+        yield self.start(backend)
+
+        keys = ['key%s' % (i,) for i in xrange(20)]
+        yield backend.set_many(dict((key, i) for i, key in enumerate(keys)))
+        for factory, endpoint in servers:
+            self.assertTrue(0 < len(factory.values) < 20)
+        values = yield backend.get_many(keys)
+        self.assertEqual(values, dict((key, i) for i, key in enumerate(keys)))
+
+    @inlineCallbacks
+    def test_disconnected(self):
+        factory, endpoint = self.listen()
+        backend = MemcachedBackend([endpoint])
+        values = yield backend.get_many(['a'])
+        self.assertEqual(values, {})
+        yield backend.set_many({'a': 1})
+        self.assertEqual(factory.commands, [])
+
+    @inlineCallbacks
+    def test_timeout(self):
+        factory, endpoint = self.listen()
+        backend = MemcachedBackend([endpoint], pool_size=1, timeout=0.05)
+        yield self.start(backend)
+        factory.silent = True
+
+        values = yield backend.get_many(['a'])
+        self.assertEqual(values, {})
+        self.assertEqual(backend.errors, 1)
+        self.assertEqual(len(self.flushLoggedErrors(TimeoutError)), 1)
+
+    @inlineCallbacks
+    def test_memcached(self):
+        server = os.environ.get('SHORTENER_TEST_MEMCACHED_ENDPOINT')
+        if not server:
+            self.skipTest('SHORTENER_TEST_MEMCACHED_ENDPOINT is not set')
+        backend = MemcachedBackend([clientFromString(reactor, server)])
+        yield self.start(backend)
+        key = cache_key('test-account', 'short', os.urandom(8).encode('hex'))
+        yield backend.set_many({key: {'id': 1}})
+        values = yield backend.get_many([key])
+        self.assertEqual(values, {key: {'id': 1}})
+
+
+class TestMakeSharedCache(TestCase):
+    timeout = 1
+
+    def test_make_shared_cache(self):
+        self.assertEqual(make_shared_cache(reactor, {}), None)
+        cache = make_shared_cache(reactor, {'shared_cache': 'memory'})
+        self.assertTrue(isinstance(cache, MemoryCacheBackend))
+        cache = make_shared_cache(reactor, {
+            'shared_cache': 'memcached',
+            'memcached_servers': ['tcp:localhost:11211', 'tcp:other:11211'],
+            'memcached_pool_size': 3,
+        })
+        self.assertTrue(isinstance(cache, MemcachedBackend))
+        self.assertEqual(len(list(cache)), 6)
+        self.assertRaises(ValueError, make_shared_cache, reactor, {
+            'shared_cache': 'redis'})
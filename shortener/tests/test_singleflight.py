@@ -0,0 +1,73 @@
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.trial.unittest import TestCase
+
+from shortener.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    timeout = 1
+
+    def test_coalesce(self):
+        flights = SingleFlight()
+        calls = []
+
+        def f(key):
+            calls.append(key)
+            d = Deferred()
+            calls.append(d)
+            return d
+
+        d1 = flights.run('a', f, 'a')
+        d2 = flights.run('a', f, 'a')
+        d3 = flights.run('b', f, 'b')
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(flights), 2)
+        self.assertTrue('a' in flights)
+        self.assertEqual(flights.coalesced, 1)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        calls[1].callback('row')
+        self.assertEqual(self.successResultOf(d1), 'row')
+        self.assertEqual(self.successResultOf(d2), 'row')
+        self.assertNoResult(d3)
+        self.assertFalse('a' in flights)
+
+        # Once a call is done, the next one for its key starts afresh.
+        d4 = flights.run('a', f, 'a')
+        self.assertEqual(len(calls), 6)
+        calls[5].callback('new row')
+        self.assertEqual(self.successResultOf(d4), 'new row')
+
+    def test_failure(self):
+        flights = SingleFlight()
+        waiting = Deferred()
+        d1 = flights.run('a', lambda: waiting)
+        d2 = flights.run('a', lambda: succeed('unused'))
+        waiting.errback(ValueError('boom'))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        self.assertEqual(len(flights), 0)
+
+    def test_cancel(self):
+        flights = SingleFlight()
+        waiting = Deferred()
+        d1 = flights.run('a', lambda: waiting)
+        d2 = flights.run('a', lambda: succeed('unused'))
+        d1.cancel()
+        self.failureResultOf(d1, CancelledError)
+        self.assertNoResult(d2)
+        self.assertFalse(waiting.called)
+
+        waiting.callback('row')
+        self.assertEqual(self.successResultOf(d2), 'row')
+        self.assertEqual(len(flights), 0)
+
+    def test_synchronous(self):
+        flights = SingleFlight()
+        self.assertEqual(
+            self.successResultOf(flights.run('a', lambda: 'row')), 'row')
+        self.assertEqual(len(flights), 0)
+        self.failureResultOf(flights.run('a', lambda: 1 / 0),
+                             ZeroDivisionError)
+        self.assertEqual(len(flights), 0)
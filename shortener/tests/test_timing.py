@@ -0,0 +1,129 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from shortener.models import ShortenerTables
+from shortener.timing import (
+    QueryTimer, RequestTimer, statement_type, get_request_timer, timed)
+
+
+class FakeMetrics(object):
+    def __init__(self):
+        self.timings = []
+
+    def timing(self, metric, seconds):
+        self.timings.append((metric, seconds))
+
+
+class FakeResult(object):
+    def __init__(self, queue_time, execute_time):
+        self.queue_time = queue_time
+        self.execute_time = execute_time
+
+
+class TestQueryTimer(TestCase):
+    timeout = 1
+
+    def test_statement_type(self):
+        tables = ShortenerTables('test-account', None)
+        self.assertEqual(statement_type(tables.urls.select()), 'select')
+        self.assertEqual(statement_type(tables.urls.insert()), 'insert')
+        self.assertEqual(statement_type(tables.audit.update()), 'update')
+        self.assertEqual(statement_type('SELECT 1'), 'text')
+
+    def test_record_query(self):
+        metrics = FakeMetrics()
+        timer = QueryTimer(metrics)
+        timer.record_query('SELECT 1', FakeResult(0.25, 0.5), 1.0)
+        self.assertEqual(metrics.timings, [
+            ('db.text.queue_time', 0.25),
+            ('db.text.execute_time', 0.5),
+        ])
+
+    def test_record_query_unpooled(self):
+        metrics = FakeMetrics()
+        timer = QueryTimer(metrics)
+        timer.record_query('SELECT 1', object(), 1.0)
+        self.assertEqual(metrics.timings, [
+            ('db.text.queue_time', 0),
+            ('db.text.execute_time', 1.0),
+        ])
+
+
+class TestRequestTimer(TestCase):
+    timeout = 1
+
+    def test_request(self):
+        clock = Clock()
+        metrics = FakeMetrics()
+        timer = RequestTimer(metrics, 'create', clock)
+        timer.record_query('SELECT 1', FakeResult(0.001, 0.002), 0.004)
+        timer.record_query('SELECT 1', FakeResult(0.003, 0.004), 0.008)
+        self.assertEqual(
+            timer.server_timing(),
+            'db-queue;dur=4.000, db-execute;dur=6.000;desc="2 queries"')
+
+        clock.advance(0.5)
+        timer.finish()
+        self.assertEqual(
+            metrics.timings[-1], ('route.create.response_time', 0.5))
+        self.assertEqual(
+            timer.server_timing(),
+            'db-queue;dur=4.000, db-execute;dur=6.000;desc="2 queries", '
+            'total;dur=500.000')
+
+    def test_no_metrics(self):
+        timer = RequestTimer(None, 'create', Clock())
+        timer.record_query('SELECT 1', FakeResult(0.001, 0.002), 0.004)
+        timer.finish()
+        self.assertEqual(timer.queries, 1)
+
+
+class FakeApp(object):
+    def __init__(self, timing_metrics, server_timing):
+        self.clock = Clock()
+        self.timing_metrics = timing_metrics
+        self.server_timing = server_timing
+        self.response = Deferred()
+
+    @timed('test')
+    def handle(self, request):
+        self.timer = get_request_timer(request)
+        return self.response
+
+
+class TestTimed(TestCase):
+    timeout = 1
+
+    def test_timed(self):
+        metrics = FakeMetrics()
+        app = FakeApp(metrics, True)
+        request = DummyRequest([''])
+        d = app.handle(request)
+        app.clock.advance(2)
+        app.response.callback('done')
+
+        self.assertEqual(self.successResultOf(d), 'done')
+        self.assertEqual(metrics.timings, [('route.test.response_time', 2)])
+        self.assertEqual(
+            request.outgoingHeaders['server-timing'],
+            app.timer.server_timing())
+
+    def test_timed_failure(self):
+        metrics = FakeMetrics()
+        app = FakeApp(metrics, False)
+        request = DummyRequest([''])
+        d = app.handle(request)
+        app.response.errback(ValueError('boom'))
+
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(metrics.timings, [('route.test.response_time', 0)])
+        self.assertFalse('server-timing' in request.outgoingHeaders)
+
+    def test_not_timed(self):
+        app = FakeApp(None, False)
+        request = DummyRequest([''])
+        d = app.handle(request)
+        self.assertIdentical(d, app.response)
+        self.assertEqual(app.timer, None)
@@ -0,0 +1,99 @@
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from shortener.warmup import WarmUpService, warm_up_service
+
+
+class FakeFilter(object):
+    def __init__(self):
+        self.ready_d = Deferred()
+
+
+class FakeApp(object):
+    def __init__(self, account, warmed_up, short_url_filter=None):
+        self.config = {'account': account}
+        self.warmed_up = warmed_up
+        self.short_url_filter = short_url_filter
+        self.warm_ups = []
+
+    def warm_up(self, count, window=None):
+        self.warm_ups.append((count, window))
+        return self.warmed_up
+
+
+class TestWarmUpService(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+        self.listener = Service()
+
+    def make_service(self, apps, **kw):
+        warm_up = WarmUpService(self.clock, apps, 100, **kw)
+        self.listener.setServiceParent(warm_up)
+        return warm_up
+
+    def test_warm_up(self):
+        warmed_up = Deferred()
+        short_url_filter = FakeFilter()
+        apps = [FakeApp('foo', warmed_up, short_url_filter),
+                FakeApp('bar', succeed(3))]
+        warm_up = self.make_service(apps, window=3600)
+        warm_up.startService()
+        self.assertEqual(apps[0].warm_ups, [(100, 3600)])
+        self.assertEqual(apps[1].warm_ups, [(100, 3600)])
+        self.assertFalse(self.listener.running)
+
+        warmed_up.callback(5)
+        self.assertFalse(self.listener.running)
+        short_url_filter.ready_d.callback('ready')
+        self.assertTrue(warm_up.ready)
+        self.assertTrue(self.listener.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # The filter's own result isn't changed.
+        self.assertEqual(self.successResultOf(short_url_filter.ready_d),
+                         'ready')
+
+        self.successResultOf(warm_up.stopService())
+        self.assertFalse(self.listener.running)
+
+    def test_timeout(self):
+        warmed_up = Deferred()
+        warm_up = self.make_service([FakeApp('foo', warmed_up)], timeout=10)
+        warm_up.startService()
+        self.clock.advance(9)
+        self.assertFalse(self.listener.running)
+        self.clock.advance(1)
+        self.assertTrue(self.listener.running)
+        warmed_up.callback(5)
+        self.assertTrue(self.listener.running)
+
+    def test_failure(self):
+        warm_up = self.make_service([FakeApp('foo', fail(ValueError('boom')))])
+        warm_up.startService()
+        self.assertTrue(self.listener.running)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_stop_while_warming_up(self):
+        warmed_up = Deferred()
+        warm_up = self.make_service([FakeApp('foo', warmed_up)])
+        warm_up.startService()
+        warm_up.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        warmed_up.callback(5)
+        self.assertFalse(self.listener.running)
+
+    def test_warm_up_service(self):
+        apps = [FakeApp('foo', succeed(0))]
+        self.assertIdentical(
+            warm_up_service(self.clock, {}, apps, self.listener),
+            self.listener)
+        warm_up = warm_up_service(self.clock, {
+            'warmup_urls': 10,
+            'warmup_timeout': 5,
+        }, apps, self.listener)
+        self.assertEqual(
+            (warm_up.count, warm_up.window, warm_up.timeout), (10, None, 5))
+        self.assertEqual(list(warm_up), [self.listener])
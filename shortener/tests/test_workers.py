@@ -0,0 +1,179 @@
+import json
+import os
+import sys
+
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+
+from shortener import workers
+from shortener.metrics import ShortenerMetrics
+from shortener.workers import (
+    WorkerSupervisor, WorkerMetricsService, LISTENING_FD)
+
+
+class FakePort(object):
+    addressFamily = 2
+
+    def fileno(self):
+        return 7
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class FakeProcessReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        protocol.makeConnection(FakeProcessTransport())
+        self.processes.append((protocol, executable, args, env, childFDs))
+        return protocol.transport
+
+
+class TestWorkerSupervisor(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.config = {
+            'host_domain': 'http://wtxt.io',
+            'account': 'test-account',
+            'graphite_endpoint': 'tcp:www.example.com:80',
+        }
+
+    def make_supervisor(self, num_workers=2):
+        supervisor = WorkerSupervisor(
+            self.reactor, '/etc/shortener.yaml', self.config, num_workers,
+            executable='/usr/bin/python')
+        supervisor.port = FakePort()
+        supervisor.running = 1
+        return supervisor
+
+    def end(self, protocol, reason=ProcessDone(0)):
+        protocol.processEnded(Failure(reason))
+
+    def test_spawn_worker(self):
+        supervisor = self.make_supervisor()
+        protocol = supervisor.spawn_worker(1)
+        [(spawned, executable, args, env, child_fds)] = self.reactor.processes
+        self.assertIdentical(spawned, protocol)
+        self.assertEqual(executable, '/usr/bin/python')
+        self.assertEqual(args, [
+            '/usr/bin/python', '-m', 'shortener.workers',
+            '--config', '/etc/shortener.yaml',
+            '--family', '2',
+            '--worker-id', '1',
+        ])
+        self.assertEqual(env['PYTHONPATH'], os.pathsep.join(sys.path))
+        self.assertEqual(child_fds, {0: 'w', 1: 'r', 2: 'r', LISTENING_FD: 7})
+        self.assertEqual(supervisor.workers, {1: protocol})
+
+    def test_workers_aggregate_metrics(self):
+        supervisor = self.make_supervisor()
+        self.assertTrue(supervisor.metrics.aggregating)
+        worker0 = supervisor.spawn_worker(0)
+        worker1 = supervisor.spawn_worker(1)
+        name = 'test-account.wtxtio.expanded.count'
+        snapshot = {'counters': {name: 2}, 'gauges': {}, 'timers': {}}
+        line = json.dumps(snapshot) + '\n'
+        worker0.childDataReceived(1, line[:10])
+        worker1.childDataReceived(1, line)
+        self.assertEqual(supervisor.metrics.counters, {name: 2})
+        worker0.childDataReceived(1, line[10:])
+        self.assertEqual(supervisor.metrics.counters, {name: 4})
+
+    def test_worker_logs(self):
+        supervisor = self.make_supervisor()
+        worker = supervisor.spawn_worker(3)
+        logged = []
+        self.patch(workers.log, 'msg', logged.append)
+        worker.childDataReceived(2, 'hello\nwor')
+        worker.childDataReceived(2, 'ld\n')
+        worker.childDataReceived(1, 'not json\n')
+        self.assertEqual(logged, [
+            '[worker 3] hello', '[worker 3] world', '[worker 3] not json'])
+
+    def test_restart_dead_worker(self):
+        supervisor = self.make_supervisor()
+        protocol = supervisor.spawn_worker(0)
+        self.end(protocol, ProcessTerminated(signal=9))
+        self.assertEqual(supervisor.workers, {})
+        self.reactor.advance(supervisor.restart_delay)
+        self.assertEqual(len(self.reactor.processes), 2)
+        restarted = supervisor.workers[0]
+        self.assertNotIdentical(restarted, protocol)
+        self.assertEqual(restarted.worker_id, 0)
+
+    def test_stop_workers(self):
+        supervisor = self.make_supervisor()
+        worker0 = supervisor.spawn_worker(0)
+        worker1 = supervisor.spawn_worker(1)
+        supervisor.running = 0
+        d = supervisor.stop_workers()
+        self.assertEqual(worker0.transport.signals, ['TERM'])
+        self.assertEqual(worker1.transport.signals, ['TERM'])
+        self.assertNoResult(d)
+
+        self.end(worker0)
+        self.assertNoResult(d)
+        self.end(worker1)
+        self.successResultOf(d)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+        self.assertEqual(len(self.reactor.processes), 2)
+
+    def test_stop_workers_timeout(self):
+        supervisor = self.make_supervisor()
+        worker = supervisor.spawn_worker(0)
+        supervisor.running = 0
+        d = supervisor.stop_workers()
+        self.reactor.advance(supervisor.shutdown_timeout)
+        self.assertEqual(worker.transport.signals, ['TERM', 'KILL'])
+        self.end(worker, ProcessTerminated(signal=9))
+        self.successResultOf(d)
+
+    def test_stop_cancels_restarts(self):
+        supervisor = self.make_supervisor()
+        self.end(supervisor.spawn_worker(0), ProcessTerminated(signal=9))
+        supervisor.running = 0
+        self.successResultOf(supervisor.stop_workers())
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+class TestWorkerMetricsService(TestCase):
+    timeout = 1
+
+    def test_send_metrics(self):
+        clock = Clock()
+        metrics = ShortenerMetrics(clock, {
+            'host_domain': 'http://wtxt.io',
+            'account': 'test-account',
+            'graphite_endpoint': 'tcp:www.example.com:80',
+            'metrics_interval': 10,
+        })
+        transport = StringTransport()
+        service = WorkerMetricsService(clock, metrics, transport)
+        service.startService()
+
+        metrics.publish_created_url_metrics()
+        clock.advance(10)
+        metrics.publish_created_url_metrics()
+        service.stopService()
+
+        lines = [json.loads(line) for line in transport.value().splitlines()]
+        self.assertEqual(lines, [{
+            'counters': {'test-account.wtxtio.created.count': 1},
+            'gauges': {},
+            'timers': {},
+        }] * 2)
+        self.assertEqual(metrics.counters, {})
+        self.assertEqual(clock.getDelayedCalls(), [])
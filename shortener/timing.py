@@ -0,0 +1,155 @@
+# -*- test-case-name: shortener.tests.test_timing -*-
+"""
+Latency instrumentation for database statements and API routes.
+
+Every statement run through :meth:`shortener.models.ShortenerTables.
+execute_query` is passed to a :class:`QueryTimer`, which publishes how long
+it waited for a database thread and how long it took to run, per statement
+type. Handlers wrapped with :func:`timed` get a :class:`RequestTimer` that
+does the same and also times the whole request, optionally describing it in
+a ``Server-Timing`` response header.
+"""
+from functools import wraps
+
+from twisted.internet.defer import maybeDeferred
+
+
+def statement_type(query):
+    # SQLAlchemy constructs are named after what they compile to, like
+    # select, insert, update or create_index. Raw SQL strings aren't.
+    return getattr(query, '__visit_name__', 'text')
+
+
+class QueryTimer(object):
+    """
+    Publishes ``db.<statement type>.queue_time`` and
+    ``db.<statement type>.execute_time`` timers for each statement.
+
+    Results from :class:`shortener.database.PooledConnection` say how long
+    the statement was queued for its connection's thread. Other results
+    don't, and their whole round trip counts as execution time. Nothing is
+    published if ``metrics`` is ``None``.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def timing(self, metric, seconds):
+        if self.metrics is not None:
+            self.metrics.timing(metric, seconds)
+
+    def record_query(self, query, result, elapsed):
+        name = statement_type(query)
+        queue_time = getattr(result, 'queue_time', None)
+        execute_time = getattr(result, 'execute_time', None)
+        if execute_time is None:
+            queue_time, execute_time = 0, elapsed
+        self.timing('db.%s.queue_time' % (name,), queue_time)
+        self.timing('db.%s.execute_time' % (name,), execute_time)
+        return queue_time, execute_time
+
+
+class RequestTimer(QueryTimer):
+    """
+    Times one request to ``route``: its statements like :class:`QueryTimer`,
+    and the whole request as ``route.<route>.response_time`` when
+    :meth:`finish` is called.
+    """
+
+    def __init__(self, metrics, route, clock):
+        QueryTimer.__init__(self, metrics)
+        self.route = route
+        self.clock = clock
+        self.started = clock.seconds()
+        self.queries = 0
+        self.queue_time = 0
+        self.execute_time = 0
+        self.response_time = None
+
+    def record_query(self, query, result, elapsed):
+        queue_time, execute_time = QueryTimer.record_query(
+            self, query, result, elapsed)
+        self.queries += 1
+        self.queue_time += queue_time
+        self.execute_time += execute_time
+        return queue_time, execute_time
+
+    def finish(self):
+        self.response_time = self.clock.seconds() - self.started
+        self.timing(
+            'route.%s.response_time' % (self.route,), self.response_time)
+
+    def server_timing(self):
+        """
+        Returns a ``Server-Timing`` header value with the request's total
+        database queue and execution times, and its response time if it has
+        finished, all in milliseconds.
+        """
+        metrics = [
+            'db-queue;dur=%.3f' % (self.queue_time * 1000,),
+            'db-execute;dur=%.3f;desc="%s queries"' % (
+                self.execute_time * 1000, self.queries),
+        ]
+        if self.response_time is not None:
+            metrics.append('total;dur=%.3f' % (self.response_time * 1000,))
+        return ', '.join(metrics)
+
+
+def set_request_timer(request, timer):
+    # Kept on the request itself, like aludel's request ids.
+    request.__request_timer = timer
+
+
+def get_request_timer(request):
+    try:
+        return request.__request_timer
+    except AttributeError:
+        return None
+
+
+def start_request_timer(app, request, route):
+    """
+    Starts timing a request to ``route`` for ``app``, a
+    :class:`shortener.api.ShortenerServiceApp`. Returns the
+    :class:`RequestTimer`, which the handler can also get with
+    :func:`get_request_timer`, or ``None`` if neither ``timing_metrics`` nor
+    ``server_timing`` is configured.
+    """
+    if app.timing_metrics is None and not app.server_timing:
+        return None
+    timer = RequestTimer(app.timing_metrics, route, app.clock)
+    set_request_timer(request, timer)
+    return timer
+
+
+def finish_request_timer(app, request, timer):
+    """
+    Publishes the request's response time, and with ``server_timing``
+    configured, adds its timings to the response as a ``Server-Timing``
+    header.
+    """
+    timer.finish()
+    if app.server_timing:
+        request.setHeader('Server-Timing', timer.server_timing())
+
+
+def timed(route):
+    """
+    Decorator for handler methods of :class:`shortener.api.
+    ShortenerServiceApp` that times their requests to ``route``, see
+    :func:`start_request_timer`.
+    """
+    def deco(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kw):
+            timer = start_request_timer(self, request, route)
+            if timer is None:
+                return func(self, request, *args, **kw)
+
+            def finish(result):
+                finish_request_timer(self, request, timer)
+                return result
+            d = maybeDeferred(func, self, request, *args, **kw)
+            return d.addBoth(finish)
+        return wrapper
+    return deco
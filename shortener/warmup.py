@@ -0,0 +1,114 @@
+# -*- test-case-name: shortener.tests.test_warmup -*-
+from twisted.application.service import MultiService, Service
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
+from twisted.python import log
+
+DEFAULT_WARMUP_TIMEOUT = 30
+
+
+def _wait_for(d):
+    """
+    Returns a Deferred that fires with ``None`` once ``d`` has fired,
+    without changing ``d``'s result.
+    """
+    waiting = Deferred()
+
+    def fired(result):
+        waiting.callback(None)
+        return result
+    d.addBoth(fired)
+    return waiting
+
+
+class WarmUpService(MultiService):
+    """
+    Holds back its children, the service listening for requests, until the
+    apps have warmed up.
+
+    When the service starts, each app loads its ``count`` hottest urls into
+    its redirect cache with
+    :meth:`shortener.api.ShortenerServiceApp.warm_up`, and apps with a
+    short url filter wait for it to be ready, but not for it to settle. The
+    children are started once every app is done, or after ``timeout``
+    seconds, whichever comes first. :attr:`ready` tells whether they have
+    been. Apps that fail to warm up are logged and served anyway.
+    """
+
+    def __init__(self, clock, apps, count, window=None,
+                 timeout=DEFAULT_WARMUP_TIMEOUT):
+        MultiService.__init__(self)
+        self.clock = clock
+        self.apps = apps
+        self.count = count
+        self.window = window
+        self.timeout = timeout
+        self.ready = False
+        self._timeout_call = None
+
+    def _warm_up(self, app):
+        d = maybeDeferred(app.warm_up, self.count, self.window)
+        d.addErrback(self._warm_up_failed, app)
+        short_url_filter = app.short_url_filter
+        if short_url_filter is not None and short_url_filter.ready_d:
+            loaded = _wait_for(short_url_filter.ready_d)
+            d.addCallback(lambda count: loaded.addCallback(lambda _: count))
+        return d
+
+    def _warm_up_failed(self, failure, app):
+        log.err(failure, 'Failed to warm up %s, serving it anyway.' % (
+            app.config['account'],))
+        return 0
+
+    def startService(self):
+        # The children are started by _start_children().
+        Service.startService(self)
+        started = self.clock.seconds()
+        self._timeout_call = self.clock.callLater(
+            self.timeout, self._timed_out)
+        d = gatherResults([self._warm_up(app) for app in self.apps])
+        d.addCallback(self._warmed_up, started)
+
+    def _warmed_up(self, counts, started):
+        log.msg('Warmed up %s urls in %.3f seconds.' % (
+            sum(counts), self.clock.seconds() - started))
+        self._start_children()
+
+    def _timed_out(self):
+        self._timeout_call = None
+        log.msg('Still warming up after %s seconds, serving anyway.' % (
+            self.timeout,))
+        self._start_children()
+
+    def _start_children(self):
+        if self.ready or not self.running:
+            return
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+        self._timeout_call = None
+        self.ready = True
+        for service in self:
+            service.startService()
+
+    def stopService(self):
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+        self._timeout_call = None
+        if not self.ready:
+            return Service.stopService(self)
+        self.ready = False
+        return MultiService.stopService(self)
+
+
+def warm_up_service(clock, config, apps, listener):
+    """
+    Returns ``listener``, the service listening for requests, in a
+    :class:`WarmUpService` if ``config`` asks for warming up.
+    """
+    count = config.get('warmup_urls')
+    if not count:
+        return listener
+    warm_up = WarmUpService(
+        clock, apps, count, window=config.get('warmup_window'),
+        timeout=config.get('warmup_timeout', DEFAULT_WARMUP_TIMEOUT))
+    listener.setServiceParent(warm_up)
+    return warm_up
@@ -0,0 +1,310 @@
+# -*- test-case-name: shortener.tests.test_workers -*-
+"""
+Serving from several worker processes.
+
+The supervisor listens on the configured port, but never accepts on it.
+Instead it hands the listening socket to each worker it spawns, so the
+kernel spreads connections across the workers. Each worker is a complete
+service with its own database engine. Workers don't talk to carbon. They
+send their aggregated metrics to the supervisor over stdout, and the
+supervisor combines them and publishes one set for the whole host. Worker
+logs are written to stderr and relayed into the supervisor's log.
+"""
+import json
+import os
+import sys
+
+from twisted.application import service
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import Factory, ProcessProtocol, Protocol
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall
+from twisted.python import log, usage
+from twisted.web import server
+
+from shortener.accounts import make_apps
+from shortener.metrics import ShortenerMetrics, MetricsFlushService
+from shortener.service import DEFAULT_PORT, add_app_services, load_config
+from shortener.warmup import warm_up_service
+
+DEFAULT_WORKER_METRICS_INTERVAL = 10
+DEFAULT_WORKER_RESTART_DELAY = 1
+DEFAULT_WORKER_SHUTDOWN_TIMEOUT = 30
+
+# File descriptor the listening socket is passed to workers on.
+LISTENING_FD = 3
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """
+    The supervisor's end of one worker process.
+    """
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = Deferred()
+        self._buffers = {1: '', 2: ''}
+
+    def _lines(self, fd, data):
+        lines = (self._buffers[fd] + data).split('\n')
+        self._buffers[fd] = lines.pop()
+        return lines
+
+    def childDataReceived(self, fd, data):
+        if fd not in self._buffers:
+            return
+        for line in self._lines(fd, data):
+            if fd == 1:
+                self.supervisor.metrics_received(self.worker_id, line)
+            else:
+                log.msg('[worker %s] %s' % (self.worker_id, line))
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.MultiService):
+    """
+    Runs ``num_workers`` worker processes sharing the listening port,
+    restarting any that die, and publishes their combined metrics.
+
+    Its child services are the ones publishing metrics to carbon. They are
+    only stopped once every worker has exited and sent its final metrics.
+    """
+
+    def __init__(self, reactor, config_file, config, num_workers,
+                 executable=sys.executable):
+        service.MultiService.__init__(self)
+        self.reactor = reactor
+        self.config_file = config_file
+        self.config = config
+        self.num_workers = num_workers
+        self.executable = executable
+        self.restart_delay = config.get(
+            'worker_restart_delay', DEFAULT_WORKER_RESTART_DELAY)
+        self.shutdown_timeout = config.get(
+            'worker_shutdown_timeout', DEFAULT_WORKER_SHUTDOWN_TIMEOUT)
+        self.port = None
+        self.workers = {}
+        self._restarts = {}
+
+        # Worker metrics are always aggregated so they can be combined.
+        self.config.setdefault(
+            'metrics_interval', DEFAULT_WORKER_METRICS_INTERVAL)
+        self.metrics = ShortenerMetrics(reactor, self.config)
+        self.metrics.carbon_client.setServiceParent(self)
+        MetricsFlushService(reactor, self.metrics).setServiceParent(self)
+
+    def listen(self):
+        endpoint = serverFromString(
+            self.reactor, self.config.get('port', DEFAULT_PORT))
+        return endpoint.listen(Factory())
+
+    def _listening(self, port):
+        self.port = port
+        # The workers accept connections, the supervisor just keeps the
+        # socket open.
+        port.stopReading()
+
+    def privilegedStartService(self):
+        d = self.listen()
+        d.addCallback(self._listening)
+        service.MultiService.privilegedStartService(self)
+        return d
+
+    def startService(self):
+        service.MultiService.startService(self)
+        for worker_id in range(self.num_workers):
+            self.spawn_worker(worker_id)
+
+    def spawn_worker(self, worker_id):
+        self._restarts.pop(worker_id, None)
+        protocol = WorkerProcessProtocol(self, worker_id)
+        args = [
+            self.executable, '-m', 'shortener.workers',
+            '--config', self.config_file,
+            '--family', str(self.port.addressFamily),
+            '--worker-id', str(worker_id),
+        ]
+        # The workers import the same modules the supervisor did.
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.reactor.spawnProcess(
+            protocol, self.executable, args, env=env,
+            childFDs={
+                0: 'w', 1: 'r', 2: 'r',
+                LISTENING_FD: self.port.fileno(),
+            })
+        self.workers[worker_id] = protocol
+        return protocol
+
+    def worker_ended(self, protocol, reason):
+        if self.workers.get(protocol.worker_id) is protocol:
+            del self.workers[protocol.worker_id]
+        if self.running:
+            log.msg('Worker %s exited (%s), restarting in %s seconds.' % (
+                protocol.worker_id, reason.value, self.restart_delay))
+            self._restarts[protocol.worker_id] = self.reactor.callLater(
+                self.restart_delay, self.spawn_worker, protocol.worker_id)
+
+    def metrics_received(self, worker_id, line):
+        try:
+            snapshot = json.loads(line)
+        except ValueError:
+            log.msg('[worker %s] %s' % (worker_id, line))
+        else:
+            self.metrics.merge(snapshot)
+
+    def _kill_workers(self):
+        for protocol in self.workers.values():
+            protocol.transport.signalProcess('KILL')
+
+    def stop_workers(self):
+        """
+        Asks every worker to shut down, killing any still running after
+        ``shutdown_timeout`` seconds. Returns a Deferred that fires once
+        they have all exited.
+        """
+        for delayed in self._restarts.values():
+            delayed.cancel()
+        self._restarts.clear()
+        if not self.workers:
+            return succeed(None)
+        ended = [protocol.ended for protocol in self.workers.values()]
+        for protocol in self.workers.values():
+            protocol.transport.signalProcess('TERM')
+        timeout = self.reactor.callLater(
+            self.shutdown_timeout, self._kill_workers)
+
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        return DeferredList(ended).addBoth(cancel_timeout)
+
+    def stopService(self):
+        self.running = 0
+        d = self.stop_workers()
+        d.addCallback(lambda _: service.MultiService.stopService(self))
+        if self.port is not None:
+            d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+
+class AdoptedPortService(service.Service):
+    """
+    Serves ``factory`` on a listening socket inherited from the supervisor.
+    """
+
+    def __init__(self, reactor, fileno, family, factory):
+        self.reactor = reactor
+        self.fileno = fileno
+        self.family = family
+        self.factory = factory
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = self.reactor.adoptStreamPort(
+            self.fileno, self.family, self.factory)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            return self.port.stopListening()
+
+
+class WorkerMetricsService(service.Service):
+    """
+    Sends the worker's aggregated metrics to the supervisor every
+    ``metrics.flush_interval`` seconds and once more when stopped, as one
+    line of JSON per snapshot.
+    """
+
+    def __init__(self, clock, metrics, transport):
+        self.clock = clock
+        self.metrics = metrics
+        self.transport = transport
+        self._loop = None
+
+    def send_metrics(self):
+        self.transport.write(json.dumps(self.metrics.snapshot()) + '\n')
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop = LoopingCall(self.send_metrics)
+        self._loop.clock = self.clock
+        self._loop.start(self.metrics.flush_interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.send_metrics()
+
+
+def makeWorkerService(reactor, config, fileno, family, metrics_transport):
+    config.setdefault('metrics_interval', DEFAULT_WORKER_METRICS_INTERVAL)
+    resource, metrics, apps = make_apps(reactor, config)
+    site = server.Site(resource)
+
+    main_service = service.MultiService()
+    WorkerMetricsService(
+        reactor, metrics, metrics_transport).setServiceParent(main_service)
+    for app in apps:
+        add_app_services(app, main_service)
+    port_service = AdoptedPortService(reactor, fileno, family, site)
+    warm_up_service(reactor, config, apps, port_service).setServiceParent(
+        main_service)
+    return main_service
+
+
+class WorkerOptions(usage.Options):
+    optParameters = [
+        ["config", "c", None, "The service config file"],
+        ["family", None, None, "Address family of the listening socket", int],
+        ["worker-id", None, 0, "This worker's number", int],
+    ]
+
+
+class SupervisorProtocol(Protocol):
+    """
+    The worker's end of its stdio pipes to the supervisor. The worker stops
+    when the supervisor goes away.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def connectionLost(self, reason):
+        if self.reactor.running:
+            self.reactor.stop()
+
+
+def main(argv=None):
+    from twisted.internet import reactor
+
+    options = WorkerOptions()
+    options.parseOptions(argv)
+    # stdout carries metrics, so the log goes to stderr.
+    log.startLogging(sys.stderr)
+    log.msg('Worker %s starting.' % (options['worker-id'],))
+
+    config = load_config(options['config'])
+    metrics_protocol = SupervisorProtocol(reactor)
+    StandardIO(metrics_protocol, reactor=reactor)
+    main_service = makeWorkerService(
+        reactor, config, LISTENING_FD, options['family'],
+        metrics_protocol.transport)
+
+    reactor.callWhenRunning(main_service.startService)
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', main_service.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()